@@ -0,0 +1,175 @@
+"""
+Benchmarks of Table operations across record sizes and table fill levels.
+
+    python bench.py [--sizes 64,1024,16384] [--fills 0,0.5,0.9] [--ops 10000] [--out results.jsonl]
+
+Every (record size, fill) case creates a table, fills it with records of that size to that fraction of its capacity
+(or as far as they fit, which is reported as filled) and then runs each workload for --ops operations. A JSON object
+per case and workload is written with the ops/s and the p50/p99/p999 latencies in microseconds; operations that fail
+(e.g. NoSpace in a full table) are counted as errors and not timed. The workloads run in a fixed order on the same
+table:
+
+  insert         inserts new records, which delete removes again at the end
+  lookup         looks up random records
+  update_grow    updates random records with a 50% longer value, which makes them chain
+  update_shrink  updates random records with a value half as long
+  mixed          60% lookups, 20% same size updates, 10% inserts and 10% deletes
+  churn          deletes a random record and inserts one of between half and twice the size, fragmenting the table
+  delete         deletes the records insert added
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+
+import db48
+
+WORKLOADS = ('insert', 'lookup', 'update_grow', 'update_shrink', 'mixed', 'churn', 'delete')
+_RECORD_OVERHEAD = db48._FLS_HEADER_SZ + 2 * db48._FIELD_HEADER_SZ + 4 + 2  # a record's bytes besides its value
+
+
+def _fls(i, length):
+    return db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),
+                               db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * max(length - _RECORD_OVERHEAD, 0))))
+
+
+def _percentile(latencies, p):
+    if not latencies:
+        return None
+    return latencies[min(int(len(latencies) * p), len(latencies) - 1)] / 1000.0
+
+
+class _Case(object):
+    """ A table filled to a fraction of its capacity with records of one size, and the workloads run on it """
+
+    def __init__(self, path, size, fill, rng, durability):
+        self.size = size
+        self.rng = rng
+        self.table = db48.Table(durability=durability)
+        self.table.create(path)
+        self.live = []  # rec_addrs of the records filled in or inserted by workloads other than insert
+        self.inserted = []  # rec_addrs of the records insert added, for delete to remove
+        target = int(fill * self.table.num_regions * db48._REGION_USABLE_SZ) // size
+        try:
+            while len(self.live) < target:
+                count = min(1000, target - len(self.live))
+                self.live.extend(self.table.insert_many([_fls(len(self.live) + i, size) for i in range(count)]))
+        except db48.NoSpace:
+            pass  # large records leave space in every region they cannot use
+        self.filled = round(len(self.live) * size / (self.table.num_regions * db48._REGION_USABLE_SZ), 3)
+
+    def run(self, workload, ops):
+        step = getattr(self, '_' + workload)
+        if workload == 'delete':
+            ops = min(ops, len(self.inserted))
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        for i in range(ops):
+            t0 = time.perf_counter_ns()
+            try:
+                step(i)
+            except db48.NoSpace:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter_ns() - t0)
+        seconds = time.perf_counter() - start
+        latencies.sort()
+        return {'ops': ops, 'errors': errors, 'seconds': round(seconds, 6),
+                'ops_per_sec': round(len(latencies) / seconds, 1) if seconds else None,
+                'p50_us': _percentile(latencies, 0.5), 'p99_us': _percentile(latencies, 0.99),
+                'p999_us': _percentile(latencies, 0.999)}
+
+    def _random(self):
+        # the records insert added are read and updated as well, so workloads on empty tables have records to use
+        i = self.rng.randrange(len(self.live) + len(self.inserted))
+        return self.live[i] if i < len(self.live) else self.inserted[i - len(self.live)]
+
+    def _pop_random(self):
+        i = self.rng.randrange(len(self.live))
+        self.live[i], self.live[-1] = self.live[-1], self.live[i]
+        return self.live.pop()
+
+    def _insert(self, i):
+        self.inserted.append(self.table.insert(_fls(i, self.size)))
+
+    def _lookup(self, i):
+        self.table.lookup(self._random())
+
+    def _update_grow(self, i):
+        self.table.update(self._random(), _fls(i, self.size * 3 // 2))
+
+    def _update_shrink(self, i):
+        self.table.update(self._random(), _fls(i, self.size // 2))
+
+    def _mixed(self, i):
+        r = self.rng.random()
+        if r < 0.6:
+            self.table.lookup(self._random())
+        elif r < 0.8:
+            self.table.update(self._random(), _fls(i, self.size))
+        elif r < 0.9:
+            self.live.append(self.table.insert(_fls(i, self.size)))
+        elif self.live:
+            self.table.delete(self._pop_random())
+
+    def _churn(self, i):
+        if self.live:
+            self.table.delete(self._pop_random())
+        self.live.append(self.table.insert(_fls(i, self.rng.randint(self.size // 2, self.size * 2))))
+
+    def _delete(self, i):
+        self.table.delete(self.inserted.pop())
+
+    def close(self):
+        self.table.close()
+
+
+def run(sizes, fills, ops, path='/tmp/db48-bench', workloads=WORKLOADS, durability=db48.DURABILITY_NONE, seed=0):
+    """ Yields a result dict per (size, fill, workload) """
+    for size in sizes:
+        for fill in fills:
+            for old_path in glob.glob(path + '*'):
+                os.unlink(old_path)
+            case = _Case(path, size, fill, random.Random(seed), durability)
+            try:
+                for workload in workloads:
+                    result = {'workload': workload, 'record_size': size, 'fill': fill, 'filled': case.filled,
+                              'durability': durability}
+                    result.update(case.run(workload, ops))
+                    yield result
+            finally:
+                case.close()
+                for old_path in glob.glob(path + '*'):
+                    os.unlink(old_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench')
+    parser.add_argument('--sizes', default='64,1024,16384', help='comma separated record sizes in bytes')
+    parser.add_argument('--fills', default='0,0.5,0.9', help='comma separated fractions of the table to fill first')
+    parser.add_argument('--ops', type=int, default=10000, help='operations per workload')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    parser.add_argument('--durability', choices=(db48.DURABILITY_NONE, db48.DURABILITY_PERIODIC,
+                                                 db48.DURABILITY_BATCH), default=db48.DURABILITY_NONE)
+    parser.add_argument('--path', default='/tmp/db48-bench', help='where the table files are created')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='file to append the results to as JSON lines, stdout by default')
+    args = parser.parse_args(argv)
+    out = open(args.out, 'a') if args.out else sys.stdout
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        fills = [float(fill) for fill in args.fills.split(',')]
+        for result in run(sizes, fills, args.ops, args.path, args.workloads.split(','), args.durability, args.seed):
+            out.write(json.dumps(result, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,44 @@
 import os
+import sys
+import math
+import queue
+import socket
+import hashlib
+import threading
+import contextlib
+import functools
+import collections
 import mmap
+import array
+import bisect
+import glob
+import operator
+import signal
+import asyncio
+import argparse
+import concurrent.futures
 import struct
 import time
+import zlib
 import logging
 
+try:
+    import numpy
+except ImportError:  # only Table.to_columns and from_columns need it
+    numpy = None
+
 _TABLE_NUM_REGIONS = 1024
 _TABLE_HEADER_SZ = 4096 + _TABLE_NUM_REGIONS
 _TABLE_MAGIC_OFF = 0
 _TABLE_MAGIC = 0xdb48beef
-_TABLE_CSUM_OFF = 4
+_TABLE_CSUM_OFF = 4  # crc32 of the region checksums when the file was closed cleanly, 0 while it is open
+_TABLE_FLAGS_OFF = 8
+_TABLE_FLAG_LAZY_REGIONS = 1  # regions are initialized on first write, files without it have all regions initialized
+_TABLE_FLAG_COMPACT_RECORDS = 2  # new records are written in the compact format, set in the first segment only
+_TABLE_REGION_INIT_OFF = 16  # a bit per region that is set once it is initialized
+_TABLE_REGION_FRAG_OFF = 144  # a bit per region freed into since it was last compacted
+_TABLE_REGION_LEAK_OFF = 272  # a bit per region that leaked space freed while its FMEs were full
+_TABLE_REGION_CSUM_OFF = 2048  # a 16 bit checksum per region, current when the file was closed cleanly
 _TABLE_REGION_SUMMARY_OFF = 4096
 _TABLE_EPOCH = 1364768380
 
@@ -19,6 +49,8 @@ _REGION_HEADER_SZ = _REGION_NUM_FMES * _REGION_FME_SZ
 _REGION_USABLE_SZ = _REGION_SZ - _REGION_HEADER_SZ
 
 _TABLE_SZ = _TABLE_HEADER_SZ + _REGION_SZ * _TABLE_NUM_REGIONS
+_REGION_CSUMS = struct.Struct(">%dH" % _TABLE_NUM_REGIONS)
+_REGION_ZERO_CSUM = zlib.crc32(bytes(_REGION_SZ)) & 0xffff  # the checksum of a region that is not initialized
 
 _FLS_MAGIC_OFF = 0
 _FLS_MAGIC = 0x0ff537
@@ -26,6 +58,19 @@ _FLS_LEN_OFF = 4
 _FLS_NEXT_OFF = 6
 _FLS_HEADER_SZ = 8
 
+# A record that outgrows its space continues in extension segments. The head keeps the FieldList magic and its next
+# slot is 0 for an unchained record, the in-region offset + 1 of the next segment, or _FLS_NEXT_FAR when the segment
+# ends with an 8 byte rec_addr of the next one (included in its length). Extension segments have their own magic and
+# the rec_addr of the previous segment after the header, so walks skip them.
+_FLS_EXT_MAGIC = 0x0ff538
+_FLS_EXT_PREV_OFF = 8
+_FLS_EXT_HEADER_SZ = 16
+_FLS_NEXT_FAR = 0xffff
+_FLS_NEXT_SZ = 8
+_FLS_NEXT_MORE = 1  # on the wire: the record continues in the next FieldList
+_FLS_HEAD_CAPACITY = _REGION_USABLE_SZ - _FLS_HEADER_SZ - _FLS_NEXT_SZ
+_FLS_EXT_CAPACITY = _REGION_USABLE_SZ - _FLS_EXT_HEADER_SZ - _FLS_NEXT_SZ
+
 _FIELD_MAGIC_OFF = 0
 _FIELD_MAGIC = 0x48
 _FIELD_TYPE_OFF = 1
@@ -35,6 +80,76 @@ _FIELD_HEADER_SZ = 8
 
 FL_TYPE_INT = 1
 FL_TYPE_BYTES = 2
+FL_TYPE_BYTES_CONT = 3  # the continuation of the preceding BYTES value with the same key
+FL_TYPE_INT64 = 4  # signed 64 bits, compact records only
+FL_TYPE_FLOAT = 5  # a double, compact records only
+_NUMERIC_TYPES = (FL_TYPE_INT, FL_TYPE_INT64, FL_TYPE_FLOAT)
+_FIXED_TYPES = (FL_TYPE_INT, FL_TYPE_BYTES, FL_TYPE_BYTES_CONT)  # the types fixed format records can store
+
+# Records are stored in one of two formats, and every segment says which in its magic so tables can hold both:
+# the fixed format above, and the compact format of RECORD_FORMAT_COMPACT tables. A compact segment has the usual
+# header (with its own magic) followed by the base timestamp of its fields as a varint, and then fields of a tag byte
+# (_FIELD_TAG | type, | _FIELD_ZLIB if the value is zlib compressed), the key and the ts - base as varints, and the
+# value: a varint for INT, a zigzag varint for INT64, 8 bytes for FLOAT, or a varint length and the bytes. Compact
+# timestamps are the full milliseconds since _TABLE_EPOCH, which the fixed format keeps the low 32 bits of.
+RECORD_FORMAT_FIXED = 1
+RECORD_FORMAT_COMPACT = 2
+_FLS_COMPACT_MAGIC = 0x0ff539
+_FLS_EXT_COMPACT_MAGIC = 0x0ff53a
+_HEAD_MAGICS = (_FLS_MAGIC, _FLS_COMPACT_MAGIC)
+_EXT_MAGICS = (_FLS_EXT_MAGIC, _FLS_EXT_COMPACT_MAGIC)
+_SEGMENT_MAGICS = _HEAD_MAGICS + _EXT_MAGICS
+_FIELD_TAG = 0xc0
+_FIELD_TAG_MASK = 0xf0
+_FIELD_ZLIB = 0x08
+_FIELD_TYPE_MASK = 0x07
+_COMPRESS_MIN_LEN = 1024  # shorter BYTES values are not worth compressing
+
+_FLS_HEADER = struct.Struct(">IHH")
+_FLS_MAGIC_RAW = struct.pack(">I", _FLS_MAGIC)
+_FIELD_HEADER = struct.Struct(">BBHI")
+_INT = struct.Struct(">I")
+_DOUBLE = struct.Struct(">d")
+_REC_ADDR = struct.Struct(">Q")
+_TS = struct.Struct(">Q")  # a change feed timestamp, see _get_ts
+_MAX_REC_ADDR = (1 << 64) - 1
+_BYTES_LEN = struct.Struct(">H")
+_NEXT = struct.Struct(">H")
+_MAX_BYTES_LEN = 0xffff
+_MIN_FRAGMENT = 64  # BYTES values are not split into fragments smaller than this
+
+_COMPACT_MIN_WASTE = 4096
+
+DURABILITY_NONE = 'none'  # writes reach the disk whenever the OS writes the pages back
+DURABILITY_PERIODIC = 'periodic'  # a background thread commits the WAL and checkpoints every sync_interval seconds
+DURABILITY_BATCH = 'batch'  # every write operation (or Table.batch block) is committed before it returns
+CHANGE_INSERT = 1
+CHANGE_UPDATE = 2
+CHANGE_DELETE = 3  # key is _CHANGE_ALL_KEYS
+CHANGE_MOVE = 4  # compaction moved the record to new_rec_addr, key is _CHANGE_ALL_KEYS
+_CHANGE_ALL_KEYS = 0xffff
+Change = collections.namedtuple('Change', ['ts', 'kind', 'rec_addr', 'key', 'new_rec_addr'])
+
+# the columns of Table.to_columns and from_columns: the values (uint32 for INT fields, int64 for INT64 and float64 for
+# FLOAT), or the values concatenated (uint8 data with value i at data[offsets[i]:offsets[i + 1]]), and a bool array of
+# whether each record has the field
+IntColumn = collections.namedtuple('IntColumn', ['values', 'present'])
+FloatColumn = collections.namedtuple('FloatColumn', ['values', 'present'])
+BytesColumn = collections.namedtuple('BytesColumn', ['offsets', 'data', 'present'])
+
+# A Snapshot.export stream is a header (_SNAPSHOT_MAGIC, number of segments) followed by entries of (segment, region
+# in the segment or _SNAPSHOT_HEADER_ENTRY for the segment header, crc32 and length of the zlib compressed data) and
+# the data: the live regions of each segment and then its header. An entry for segment _SNAPSHOT_END ends it.
+_SNAPSHOT_MAGIC = 0xdb48c0de
+_SNAPSHOT_HEADER = struct.Struct(">IH")
+_SNAPSHOT_ENTRY = struct.Struct(">HHII")
+_SNAPSHOT_HEADER_ENTRY = 0xffff
+_SNAPSHOT_END = 0xffff
+
+_SYNC_CHUNK_SZ = 64 * 1024  # granularity of the dirty tracking for msync, a multiple of the page size
+_WAL_CHECKPOINT_SZ = 64 * 1024 * 1024
+
+_DEBUG = 'DEBUG' in os.environ  # enables (slow) consistency checks
 
 
 def get_logger(name):
@@ -48,98 +163,2408 @@ def get_logger(name):
     logger.addHandler(handler)
     return logger
 _logger = get_logger(__name__)
+_perf_counter_ns = time.perf_counter_ns
+
+
+def _timed_op(method):
+    # counts and times a Table method for Table.metrics and calls the on_op hooks
+    name = method.__name__
+
+    @functools.wraps(method)
+    def timed_op(self, *args, **kwargs):
+        if not self.metrics_enabled:
+            return method(self, *args, **kwargs)
+        start = _perf_counter_ns()
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            self._record_op(name, _perf_counter_ns() - start, True)
+            raise
+        ns = _perf_counter_ns() - start
+        stats = self._op_stats.get(name)
+        if stats is None:
+            stats = self._op_stats[name] = _OpStats()
+        # _OpStats.record inlined as this runs for every operation
+        stats.count += 1
+        stats.total_ns += ns
+        stats.buckets[ns.bit_length()] += 1
+        if ns > stats.max_ns:
+            stats.max_ns = ns
+        for hook in self._op_hooks:
+            hook(name, ns, False)
+        return result
+    return timed_op
+
+
+def _write_op(method):
+    # runs a Table method under the write latch as one operation, see Table.batch
+    @functools.wraps(method)
+    def write_op(self, *args, **kwargs):
+        self._begin_op()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._end_op()
+    return _timed_op(write_op)
 
 
 class Table(object):
 
-    def __init__(self):
+    #
+    # A table is a chain of segment files that each hold a header and _TABLE_NUM_REGIONS regions: the first segment
+    # is the file at path, the following ones are path.seg1, path.seg2, ... Regions are numbered across segments so
+    # a rec_addr still maps to its region with a division. With max_segments > 1 (None for no limit) a segment is
+    # added whenever no region has space for a record.
+    #
+    # Deletes and updates leave holes. compact slides a region's records together; with auto_compact an insert
+    # that finds no free extent large enough compacts a region with enough free space in total first.
+    #
+    # Segment files are created sparse and their regions initialized when they are first written, so creating a
+    # table only writes its header.
+    #
+    # With cache_bytes lookup keeps up to that many bytes of the most recently looked up records decoded, see
+    # _RecordCache. The cached FieldLists are returned as they are and must not be modified.
+    #
+    # Records are written in record_format, RECORD_FORMAT_FIXED or RECORD_FORMAT_COMPACT (see the comment at the
+    # FieldList magics), which is kept in the table header and defaults to the table's format on open and to the fixed
+    # format on create. Opening a table with another format changes the format of the records written from then on;
+    # each record keeps the format it was written in, including updates, and is read in it.
+    #
+    # With change_feed every inserted, updated or deleted field and every record compaction moves is logged, see
+    # _ChangeFeed, so replicas can catch up with changes_since instead of comparing whole tables.
+    #
+    # With durability other than DURABILITY_NONE the writes of each operation are logged to a write-ahead log at
+    # path.wal, see _WriteAheadLog. DURABILITY_BATCH commits every operation before it returns, unless group_commit
+    # is set: then the owner (e.g. the Server) calls commit for many operations at once. DURABILITY_PERIODIC commits
+    # from a background thread every sync_interval seconds, so up to that much acknowledged work can be lost.
+    # Overwrites of existing records also log the bytes they overwrite, unsynced until the next commit, see
+    # _WriteAheadLog for what that covers.
+    #
+    # A table can be used from many threads. Writers take the table's write latch for the duration of an operation
+    # (or batch), so writes are serialized: the free space index, WAL, indexes and change feed are shared by every
+    # region, and the GIL would serialize the Python code of finer grained writers anyway. The latch is released
+    # before a DURABILITY_BATCH commit, so other writers run during the fsync and one fsync commits the operations
+    # of every thread waiting for it. Readers do not take the latch: each region has a version (a seqlock) that a
+    # writer makes odd before it first writes to the region in an operation and even again when the operation ends.
+    # lookup, lookup_raw and scan read a region's records and keep the result if the version was even and did not
+    # change meanwhile, otherwise they read again under the latch, as they do for chained records, whose segments
+    # are in other regions. RecordViews from view decode from the mapped file when their fields are accessed, so
+    # they are not protected against concurrent writes. Index queries and checkpoints take the latch, and close must
+    # not race with other calls.
+    #
+
+    def __init__(self, max_segments=1, auto_compact=False, durability=DURABILITY_NONE, sync_interval=1.0,
+                 preallocate=False, change_feed=False, metrics=True, cache_bytes=0, record_format=None):
+        assert durability in (DURABILITY_NONE, DURABILITY_PERIODIC, DURABILITY_BATCH)
+        assert record_format in (None, RECORD_FORMAT_FIXED, RECORD_FORMAT_COMPACT)
         self.initialized = False
-        self._fd = None
+        self.record_format = record_format  # of new records, None until create or open unless given
+        self.max_segments = max_segments
+        self.change_feed = change_feed  # log the changes to path.changes for changes_since
+        self._changes = None
+        self.preallocate = preallocate  # allocate the disk space of segment files up front instead of sparse files
+        self.auto_compact = auto_compact
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.group_commit = False
+        self._wal = None
+        self._op_depth = 0
+        self._latch = threading.RLock()  # held by writers, see above
+        self._sync_lock = threading.Lock()
+        self._sync_thread = None
+        self._stop_sync = None
+        self._segments = []
         self._mmap = None
+        self._free_index = None
+        self._next_region = 0
+        self._regions = None
+        self._indexes = {}
+        self._fragmented = set()  # regions freed into since they were compacted, kept in the segment headers
+        self._relocate_callbacks = []
+        self._snapshots = []  # open Snapshots
+        self._next_snapshot = 0
+        self.metrics_enabled = metrics  # count and time operations, see metrics
+        self._op_stats = {}  # op name: _OpStats
+        self._counters = collections.Counter()
+        self._op_hooks = []
+        self._cache = _RecordCache(cache_bytes) if cache_bytes else None
+        self.path = None
+        self.readonly = False
+        self.clean = True  # False if a segment file was not closed cleanly, see verify
+
+    @property
+    def num_regions(self):
+        return len(self._segments) * _TABLE_NUM_REGIONS
 
     def create(self, path):
         assert not self.initialized
-        self._fd = os.open(path, os.O_RDWR | os.O_CREAT)
-        os.lseek(self._fd, _TABLE_SZ-1, os.SEEK_SET)
-        os.write(self._fd, b'\x00')
-        self._mmap = mmap.mmap(self._fd, _TABLE_SZ)
-        self._mmap[_TABLE_MAGIC_OFF:_TABLE_MAGIC_OFF+4] = struct.pack(">I", _TABLE_MAGIC)
-        self._mmap[_TABLE_CSUM_OFF:_TABLE_CSUM_OFF+4] = struct.pack(">I", 0)
-        for i in range(_TABLE_NUM_REGIONS):
-            self._mmap[i+_TABLE_CSUM_OFF:i+_TABLE_CSUM_OFF+1] = struct.pack("B", 0)
-        for i in range(_TABLE_NUM_REGIONS):
-            r = Region(self, i)
-            r.create()
+        self.path = path
+        self.readonly = False
+        self._regions = []
+        self._free_index = _FreeSpaceIndex(0)
+        self._add_segment()
+        self.record_format = self.record_format or RECORD_FORMAT_FIXED
+        self._segments[0].set_flag(_TABLE_FLAG_COMPACT_RECORDS, self.record_format == RECORD_FORMAT_COMPACT)
+        self._next_region = 0
         self.initialized = True
+        if self.durability != DURABILITY_NONE:
+            self._open_wal(truncate=True)
+        if self.change_feed:
+            self._changes = _ChangeFeed(path + '.changes', truncate=True)
 
-    def open(self, path):
+    def open(self, path, readonly=False):
+        # a readonly table maps the files read-only and does not open its indexes
         assert not self.initialized
-        self._fd = os.open(path, os.O_RDWR)
-        self._mmap = mmap.mmap(self._fd, _TABLE_SZ)
-        magic = struct.unpack(">I", self._mmap[_TABLE_MAGIC_OFF:_TABLE_MAGIC_OFF+4])[0]
-        assert magic == _TABLE_MAGIC
+        self.path = path
+        self.readonly = readonly
+        self._regions = []
+        self._free_index = _FreeSpaceIndex(0)
+        segments = []
+        while True:
+            segment_path = self._segment_path(len(segments))
+            if segments and not os.path.exists(segment_path):
+                break
+            segment = _Segment(len(segments), segment_path)
+            segment.open(readonly)
+            segments.append(segment)
+        if not readonly and os.path.exists(path + '.wal'):
+            # redo the operations committed since the last checkpoint before the summaries are read
+            wal = _WriteAheadLog(path + '.wal')
+            num_ops = wal.replay(segments)
+            if num_ops:
+                _logger.info('%s: replayed %d operations from the write-ahead log', path, num_ops)
+            for segment in segments:
+                segment.sync(full=True)
+            wal.truncate()
+            wal.close()
+        for segment in segments:
+            self._attach_segment(segment)
+        stored_format = (RECORD_FORMAT_COMPACT if segments[0].flags() & _TABLE_FLAG_COMPACT_RECORDS
+                         else RECORD_FORMAT_FIXED)
+        if self.record_format is None or readonly:
+            self.record_format = stored_format
+        elif self.record_format != stored_format:
+            _logger.info('%s: writing records in format %d from now on', path, self.record_format)
+            segments[0].set_flag(_TABLE_FLAG_COMPACT_RECORDS, self.record_format == RECORD_FORMAT_COMPACT)
+        self.clean = all(segment.clean for segment in segments)
+        if not self.clean and not readonly:
+            _logger.warning('%s was not closed cleanly, Table.verify(repair=True) rebuilds its free space maps', path)
+        self._next_region = 0
         self.initialized = True
+        if readonly:
+            return
+        if self.durability != DURABILITY_NONE:
+            self._open_wal()
+        if self.change_feed:
+            self._changes = _ChangeFeed(path + '.changes')
+        for index_path in glob.glob(glob.escape(path) + '.idx*.*'):
+            key, _, type_ = index_path[len(path)+4:].partition('.')
+            if key.isdigit() and type_.isdigit():
+                index = Index(self, int(key), int(type_))
+                index.open(index_path)
+                self._indexes[index.key] = index
 
+    @_write_op
     def insert(self, fls):
         assert self.initialized
         rec_addr = self._insert(fls)
+        for index in self._indexes.values():
+            index.add(rec_addr, fls)
+        if self._changes is not None:
+            self._changes.append(CHANGE_INSERT, rec_addr, [fl.key for fl in fls.fls])
         return rec_addr
 
-    def _insert(self, fls):
+    def _insert(self, fls, moves=None):
+        fls = self._in_format(fls)
         space = fls.length()
-        region = self._find_region_with_space(space)
-        rec_addr = region.insert(fls, space)
-        return rec_addr
+        if space > _REGION_USABLE_SZ:
+            return self._insert_chained(fls)
+        while True:
+            region = self._find_region_with_space(space, compact=True, moves=moves)
+            try:
+                rec_addr = region.insert(fls, space)
+            except NoSpace:
+                # the summary over-estimated the largest free extent, region.insert has corrected it so retry
+                continue
+            self._next_region = region.ndx
+            return rec_addr
 
+    def _insert_chained(self, fls):
+        # a record larger than a region is split into a head and extension segments linked by far pointers
+        fls = self._in_format(fls)
+        chunks = _pack_fields(fls.fls, _FLS_HEAD_CAPACITY, _FLS_EXT_CAPACITY, fls.base())
+        rec_addrs = [self._alloc(size) for size in _segment_sizes(chunks, True)]
+        _logger.debug('inserting record in %d segments', len(rec_addrs))
+        self._write_chain(rec_addrs, chunks, True, compact=fls.compact)
+        return rec_addrs[0]
+
+    def _in_format(self, fls):
+        # fls to be encoded in the format new records of the table are written in
+        compact = self.record_format == RECORD_FORMAT_COMPACT
+        return fls if fls.compact == compact else FieldList(fls.fls, compact)
+
+    @_write_op
     def update(self, rec_addr, fls):
+        """
+        Updates the fields of fls in the record. Records keep their rec_addr: a record that grows gets the updated
+        fields appended in an extension segment. Returns rec_addr.
+        """
         assert self.initialized
-        existing_fls, region = self._lookup(rec_addr)
-        new_length, old_length = existing_fls.update(fls)
-        if new_length > old_length:
-            _logger.debug('will need %d extra bytes' % (new_length - old_length))
-            self._delete(rec_addr, region)
-            return self._insert(existing_fls)
-        else:
-            return region.update(rec_addr, existing_fls, new_length, old_length)
+        existing_fls = self._update(rec_addr, fls)
+        for index in self._indexes.values():
+            index.update(rec_addr, rec_addr, existing_fls)
+        return rec_addr
+
+    @_write_op
+    def merge(self, rec_addr, fls):
+        """
+        Like update but keeps the timestamps of the fields of fls, and a field only replaces the stored one with the
+        same key if it is newer (see FieldList.merge), e.g. to reconcile replicas. Nothing is written if no field
+        is newer. Returns rec_addr.
+        """
+        assert self.initialized
+        existing_fls = self._update(rec_addr, fls, merge=True)
+        for index in self._indexes.values():
+            index.update(rec_addr, rec_addr, existing_fls)
+        return rec_addr
 
+    @_write_op
     def delete(self, rec_addr):
         assert self.initialized
         self._delete(rec_addr)
+        for index in self._indexes.values():
+            index.remove(rec_addr)
 
-    def _delete(self, rec_addr, region=None):
-        if region is None:
-            region = self._find_region_with_rec(rec_addr)
+    @_write_op
+    def insert_many(self, fls_list):
+        """
+        Inserts the FieldLists, packing consecutive records contiguously into the largest free extents and writing
+        each region's FMEs once. Returns the rec_addrs in input order.
+        """
+        assert self.initialized
+        fls_list = list(fls_list)
+        rec_addrs = [None] * len(fls_list)
+        stored = [self._in_format(fls) for fls in fls_list]
+        small = [i for i, fls in enumerate(stored) if fls.length() <= _REGION_USABLE_SZ]
+        for i, rec_addr in zip(small, self._insert_many([stored[i].as_raw() for i in small])):
+            rec_addrs[i] = rec_addr
+        if len(small) < len(fls_list):
+            for i, fls in enumerate(fls_list):
+                if rec_addrs[i] is None:
+                    rec_addrs[i] = self._insert_chained(fls)
+        for index in self._indexes.values():
+            for rec_addr, fls in zip(rec_addrs, fls_list):
+                index.add(rec_addr, fls)
+        if self._changes is not None:
+            for rec_addr, fls in zip(rec_addrs, fls_list):
+                self._changes.append(CHANGE_INSERT, rec_addr, [fl.key for fl in fls.fls])
+        return rec_addrs
+
+    @_write_op
+    def insert_raw(self, raws):
+        """
+        Like insert_many but takes FieldLists already in their stored encoding, e.g. straight off the network. A
+        record may be sent as several FieldLists, see FieldList.as_raw_chunks.
+        """
+        assert self.initialized
+        raws = [bytes(raw) for raw in raws]
+        chunked = {}  # position -> FieldList of records that have to be decoded
+        for i, raw in enumerate(raws):
+            if not _is_raw_field_list(raw):
+                chunked[i] = _decode_record(raw)
+        return self._insert_raw(raws, chunked)
+
+    def _insert_raw(self, raws, chunked):
+        rec_addrs = [None] * len(raws)
+        simple = [i for i in range(len(raws)) if i not in chunked]
+        for i, rec_addr in zip(simple, self._insert_many([raws[i] for i in simple])):
+            rec_addrs[i] = rec_addr
+        moves = {}
+        for i, fls in chunked.items():
+            rec_addrs[i] = self._insert(fls, moves)
+            if moves:
+                # an auto compaction moved records placed earlier in the call
+                rec_addrs = [moves.get(rec_addr, rec_addr) for rec_addr in rec_addrs]
+                moves.clear()
+        if self._indexes:
+            for i, rec_addr in enumerate(rec_addrs):
+                fls = chunked[i] if i in chunked else FieldList.load(0, raws[i])
+                for index in self._indexes.values():
+                    index.add(rec_addr, fls)
+        if self._changes is not None:
+            for i, rec_addr in enumerate(rec_addrs):
+                keys = [fl.key for fl in chunked[i].fls] if i in chunked else RecordView(raws[i], 0).keys()
+                self._changes.append(CHANGE_INSERT, rec_addr, keys)
+        return rec_addrs
+
+    def _insert_many(self, raws):
+        if any(len(raw) > _REGION_USABLE_SZ for raw in raws):
+            raise NoSpace()
+        rec_addrs = []
+        moves = {}
+        while len(rec_addrs) < len(raws):
+            region = self._find_region_with_space(len(raws[len(rec_addrs)]), compact=True, moves=moves)
+            if moves:
+                # an auto compaction moved records placed earlier in the batch
+                rec_addrs = [moves.get(rec_addr, rec_addr) for rec_addr in rec_addrs]
+                moves.clear()
+            rec_addrs.extend(region.insert_many(raws, len(rec_addrs)))
+            self._next_region = region.ndx
+        return rec_addrs
+
+    @_write_op
+    def update_many(self, updates):
+        """
+        Applies a sequence of (rec_addr, fls) updates grouped by region, the rec_addrs must be distinct. Records that
+        shrink or keep their size are rewritten with each region's FMEs written once, records that grow are extended
+        as in update. Returns the rec_addrs in input order.
+        """
+        assert self.initialized
+        return self._update_many(list(updates), False)
+
+    @_write_op
+    def merge_many(self, merges):
+        """ Applies a sequence of (rec_addr, fls) merges as merge does, batched by region as in update_many """
+        assert self.initialized
+        return self._update_many(list(merges), True)
+
+    def _update_many(self, updates, merge):
+        existing = [None] * len(updates)
+        grown = []  # (position, chain, changed fields) of unchained records that grew or changed format
+        chained = []
+        for region, positions in self._group_by_region([rec_addr for rec_addr, _ in updates]):
+            region._defer_fmes()
+            try:
+                for i in positions:
+                    rec_addr, fls = updates[i]
+                    offset = region.offset + _REGION_HEADER_SZ + rec_addr % _REGION_USABLE_SZ
+                    _, old_length, next_ = _FLS_HEADER.unpack_from(region.mmap, offset)
+                    if next_:
+                        chained.append(i)
+                        continue
+                    existing_fls = existing[i] = FieldList.load(offset, region.mmap)
+                    new_length, _, changed = self._apply(existing_fls, fls, merge)
+                    if not changed:
+                        continue
+                    existing[i] = self._stored_format(existing_fls, changed)
+                    self._log_update(rec_addr, changed)
+                    if new_length > old_length or existing[i] is not existing_fls:
+                        grown.append((i, [_ChainSegment(rec_addr, region, offset, _HEAD_MAGICS)], changed))
+                    else:
+                        region.update(rec_addr, existing_fls, new_length, old_length)
+            finally:
+                region._flush_fmes()
+        for i, chain, changed in grown:
+            if existing[i].compact and not chain[0].compact:
+                self._rewrite(chain, existing[i])
+            else:
+                self._extend(chain, existing[i], changed)
+        for i in chained:
+            existing[i] = self._update(updates[i][0], updates[i][1], merge)
+        for index in self._indexes.values():
+            for i, (rec_addr, _) in enumerate(updates):
+                index.update(rec_addr, rec_addr, existing[i])
+        return [rec_addr for rec_addr, _ in updates]
+
+    @_write_op
+    def delete_many(self, rec_addrs):
+        """ Deletes the records grouped by region, writing each region's FMEs once """
+        assert self.initialized
+        rec_addrs = list(rec_addrs)
+        for region, positions in self._group_by_region(rec_addrs):
+            region._defer_fmes()
+            try:
+                for i in positions:
+                    self._delete(rec_addrs[i])
+            finally:
+                region._flush_fmes()
+        for index in self._indexes.values():
+            for rec_addr in rec_addrs:
+                index.remove(rec_addr)
+
+    def _group_by_region(self, rec_addrs):
+        # yields (region, positions in rec_addrs of the records in the region)
+        by_region = {}
+        for i, rec_addr in enumerate(rec_addrs):
+            by_region.setdefault(rec_addr // _REGION_USABLE_SZ, []).append(i)
+        for ndx in sorted(by_region):
+            yield self._region(ndx), by_region[ndx]
+
+    def _update(self, rec_addr, fls, merge=False):
+        region, offset = self._locate(rec_addr)
+        _, old_length, next_ = _FLS_HEADER.unpack_from(region.mmap, offset)
+        if next_ == 0:
+            # old_length is the stored length, a compact record written elsewhere may have been encoded differently
+            existing_fls = FieldList.load(offset, region.mmap)
+            new_length, _, changed = self._apply(existing_fls, fls, merge)
+            if not changed:
+                return existing_fls
+            stored_fls = self._stored_format(existing_fls, changed)
+            self._log_update(rec_addr, changed)
+            if new_length <= old_length and stored_fls is existing_fls:
+                region.update(rec_addr, existing_fls, new_length, old_length)
+                return existing_fls
+            chain = [_ChainSegment(rec_addr, region, offset, _HEAD_MAGICS)]
+        else:
+            chain = self._chain(rec_addr)
+            existing_fls = self._load_chain(chain)
+            changed = self._apply(existing_fls, fls, merge)[2]
+            if not changed:
+                return existing_fls
+            stored_fls = self._stored_format(existing_fls, changed)
+            self._log_update(rec_addr, changed)
+        if stored_fls is not existing_fls:
+            # converted to the compact format, which the extensions of a fixed format head cannot be
+            self._rewrite(chain, stored_fls)
+            return stored_fls
+        self._extend(chain, existing_fls, changed)
+        return existing_fls
+
+    def _stored_format(self, fls, changed):
+        """
+        Returns fls (as updated with changed) in the format to write it back in, checked before anything is logged
+        or written. Fixed format records only store the _FIXED_TYPES: one that gets another type is converted to
+        the compact format if that is the table's format, otherwise this raises ValueError.
+        """
+        if fls.compact:
+            return fls
+        for fl in changed:
+            if fl.type not in _FIXED_TYPES:
+                if self.record_format != RECORD_FORMAT_COMPACT:
+                    raise ValueError('field type %d needs the compact record format' % fl.type)
+                return FieldList(fls.fls, True)
+        return fls
+
+    def _log_update(self, rec_addr, changed):
+        # every update that changes a record passes here
+        if self._cache is not None:
+            self._invalidate(rec_addr)
+        if self._changes is not None:
+            self._changes.append(CHANGE_UPDATE, rec_addr, [fl.key for fl in changed])
+
+    def _invalidate(self, rec_addr):
+        # the region is marked as written first, so a lookup that read the record before cannot cache it after
+        ndx = rec_addr // _REGION_USABLE_SZ
+        self._segments[ndx // _TABLE_NUM_REGIONS].begin_write(ndx % _TABLE_NUM_REGIONS)
+        self._cache.invalidate(rec_addr)
+
+    @staticmethod
+    def _apply(existing_fls, fls, merge):
+        # updates or merges fls into existing_fls, returns (new length, old length, the fields written)
+        if merge:
+            return existing_fls.merge(fls)
+        if not fls.fls:
+            return existing_fls.length(), existing_fls.length(), []
+        return existing_fls.update(fls) + (fls.fls, )
+
+    def _extend(self, chain, fls, changed):
+        """
+        Appends the changed fields of fls (as updated) to its chain in extension segments. The tail has no room for
+        a far pointer so the first extension goes in its region, linked with an in-region offset. When that region
+        is full, or when the chain would hold more superseded data than live data, the record is rewritten instead.
+        """
+        tail = chain[-1]
+        room = tail.region._free_map().max_extent() - _FLS_EXT_HEADER_SZ - _FLS_NEXT_SZ
+        if room >= 0:
+            base = None if not fls.compact else min(fl.ts for fl in changed)
+            chunks = _pack_fields(changed, min(room, _FLS_EXT_CAPACITY), _FLS_EXT_CAPACITY, base)
+            sizes = _segment_sizes(chunks, False)
+            if sum(segment.length for segment in chain) + sum(sizes) <= 2 * fls.length():
+                _logger.debug('extending record at %d', chain[0].rec_addr)
+                self._counters['extended'] += 1
+                rec_addrs = [self._alloc(sizes[0], tail.region.ndx)]
+                rec_addrs.extend(self._alloc(size) for size in sizes[1:])
+                self._write_chain(rec_addrs, chunks, False, tail.rec_addr, compact=fls.compact)
+                # linked last so the record stays readable until the extensions are complete
+                tail.region.segment.write(tail.offset + _FLS_NEXT_OFF, _NEXT.pack(rec_addrs[0] % _REGION_USABLE_SZ + 1))
+                return
+        self._rewrite(chain, fls)
+
+    def _rewrite(self, chain, fls):
+        # rewrites the record from its head, which keeps its space (and so the rec_addr), into new extensions
+        head = chain[0]
+        _logger.debug('rewriting record at %d', head.rec_addr)
+        self._counters['rewritten'] += 1
+        length = fls.length()
+        if length > head.length and head.length < _FLS_HEADER_SZ + _FLS_NEXT_SZ:
+            # no room for a far pointer in the head
+            raise NoSpace()
+        for segment in chain[1:]:
+            self._free_segment(segment)
+        if length <= head.length:
+            head.region.segment.write(head.offset, fls.as_raw())
+            if length < head.length:
+                head.region._free_up_space(head.rec_addr % _REGION_USABLE_SZ + length, head.length - length)
+        else:
+            # the few bytes the head's fields leave unused are padding rather than another fragment in the region
+            chunks = _pack_fields(fls.fls, head.length - _FLS_HEADER_SZ - _FLS_NEXT_SZ, _FLS_EXT_CAPACITY, fls.base())
+            sizes = _segment_sizes(chunks, True)
+            rec_addrs = [head.rec_addr] + [self._alloc(size) for size in sizes[1:]]
+            self._write_chain(rec_addrs, chunks, True, head_length=head.length, compact=fls.compact)
+
+    def _write_chain(self, rec_addrs, chunks, head, prev_addr=None, head_length=None, compact=False):
+        # writes the chunks to the segments at rec_addrs, linked with far pointers and the last one first; the
+        # first segment is the head of a record (zero padded to head_length) if head, otherwise an extension
+        # following the one at prev_addr. The chunks are in the compact format if compact, see _pack_fields
+        if compact:
+            head_magic, ext_magic = _FLS_COMPACT_MAGIC, _FLS_EXT_COMPACT_MAGIC
+        else:
+            head_magic, ext_magic = _FLS_MAGIC, _FLS_EXT_MAGIC
+        for i in reversed(range(len(chunks))):
+            raw_fls = b"".join(chunks[i])
+            trailer = _REC_ADDR.pack(rec_addrs[i+1]) if i < len(chunks) - 1 else b""
+            next_ = _FLS_NEXT_FAR if trailer else 0
+            if i == 0 and head:
+                if head_length is not None:
+                    raw_fls += bytes(head_length - _FLS_HEADER_SZ - len(raw_fls) - len(trailer))
+                header = _FLS_HEADER.pack(head_magic, _FLS_HEADER_SZ + len(raw_fls) + len(trailer), next_)
+            else:
+                header = (_FLS_HEADER.pack(ext_magic, _FLS_EXT_HEADER_SZ + len(raw_fls) + len(trailer), next_) +
+                          _REC_ADDR.pack(rec_addrs[i-1] if i > 0 else prev_addr))
+            raw = header + raw_fls + trailer
+            region, offset = self._locate(rec_addrs[i])
+            region.segment.write(offset, raw)
+
+    def _free_segment(self, segment):
+        # zeroes the length (the magic stays so walks tell heads from extensions) and frees the space
+        segment.region.segment.write(segment.offset + _FLS_LEN_OFF, struct.pack(">HH", 0, 0))
+        segment.region._free_up_space(segment.rec_addr % _REGION_USABLE_SZ, segment.length)
+
+    def _alloc(self, space, ndx=None):
+        # allocates space in region ndx, None if it has no room, or without ndx in the next region with room
+        if ndx is not None:
+            return self._region(ndx).alloc(space)
+        while True:
+            rec_addr = self._find_region_with_space(space).alloc(space)
+            if rec_addr is not None:
+                self._next_region = rec_addr // _REGION_USABLE_SZ
+                return rec_addr
+
+    def _delete(self, rec_addr):
+        region, offset = self._locate(rec_addr)
+        if _FLS_HEADER.unpack_from(region.mmap, offset)[2]:
+            for segment in self._chain(rec_addr)[1:]:
+                self._free_segment(segment)
         region.delete(rec_addr)
+        if self._cache is not None:
+            self._invalidate(rec_addr)
+        if self._changes is not None:
+            self._changes.append(CHANGE_DELETE, rec_addr)
 
+    @_timed_op
     def lookup(self, rec_addr):
         assert self.initialized
-        fls, _ = self._lookup(rec_addr)
+        if self._cache is None:
+            return self._read(rec_addr // _REGION_USABLE_SZ, self._load, rec_addr)[0]
+        fls = self._cache.get(rec_addr)
+        if fls is None:
+            fls, version = self._read(rec_addr // _REGION_USABLE_SZ, self._load, rec_addr)
+            self._cache.put(rec_addr, fls, self._versions(rec_addr // _REGION_USABLE_SZ), version)
         return fls
 
-    def _lookup(self, rec_addr):
+    @_timed_op
+    def lookup_raw(self, rec_addr):
+        """ Returns the record in its stored encoding, or as FieldList.as_raw_chunks if it is chained """
+        assert self.initialized
+        return self._read(rec_addr // _REGION_USABLE_SZ, self._load_raw, rec_addr)[0]
+
+    def _load_raw(self, rec_addr):
+        region, offset = self._locate(rec_addr)
+        if _FLS_HEADER.unpack_from(region.mmap, offset)[2] == 0:
+            return region.read_raw(rec_addr)
+        return b"".join(self._load(rec_addr).as_raw_chunks())
+
+    def _read(self, ndx, read, arg):
+        """
+        Returns read(arg) and the version of region ndx it was read at: without the latch if no write to the
+        region was in progress or made meanwhile, otherwise read again under the latch.
+        """
+        versions = self._segments[ndx // _TABLE_NUM_REGIONS].versions
+        i = ndx % _TABLE_NUM_REGIONS
+        version = versions[i]
+        if not version & 1:
+            try:
+                result = read(arg)
+            except Exception:
+                # a write may have left the region inconsistent for the moment
+                if versions[i] == version:
+                    raise
+            else:
+                if versions[i] == version:
+                    return result, version
+        with self._latch:
+            return read(arg), versions[i]
+
+    def _versions(self, ndx):
+        # (the versions of ndx's segment, ndx's index in them)
+        return self._segments[ndx // _TABLE_NUM_REGIONS].versions, ndx % _TABLE_NUM_REGIONS
+
+    @_timed_op
+    def view(self, rec_addr):
+        """ Returns a RecordView that decodes the record's fields on demand """
+        assert self.initialized
+        region, offset = self._locate(rec_addr)
+        if _FLS_HEADER.unpack_from(region.mmap, offset)[2] == 0:
+            return region.view(rec_addr)
+        return _ChainedRecordView(self._load(rec_addr))
+
+    def _load(self, rec_addr):
+        region, offset = self._locate(rec_addr)
+        if _FLS_HEADER.unpack_from(region.mmap, offset)[2] == 0:
+            return FieldList.load(offset, region.mmap)
+        with self._latch:  # the version of the head's region does not cover the rest of the chain
+            return self._load_chain(self._chain(rec_addr))
+
+    def _chain(self, rec_addr):
+        # the segments of the record at rec_addr, head first
+        region, offset = self._locate(rec_addr)
+        chain = [_ChainSegment(rec_addr, region, offset, _HEAD_MAGICS)]
+        next_addr = chain[-1].next_rec_addr()
+        while next_addr is not None:
+            region, offset = self._locate(next_addr)
+            chain.append(_ChainSegment(next_addr, region, offset, _EXT_MAGICS))
+            next_addr = chain[-1].next_rec_addr()
+        return chain
+
+    @staticmethod
+    def _load_chain(chain):
+        return FieldList(_merge_fields([fl for segment in chain for fl in segment.fields()]), chain[0].compact)
+
+    def _locate(self, rec_addr):
+        # (region, offset in its mmap) of rec_addr
         region = self._find_region_with_rec(rec_addr)
-        fls = region.read(rec_addr)
-        return fls, region
+        return region, region.offset + _REGION_HEADER_SZ + rec_addr % _REGION_USABLE_SZ
+
+    @_write_op
+    def create_index(self, key, type_):
+        """ Creates a persistent secondary index on the values of field key (of type_) and fills it """
+        assert self.initialized
+        assert type_ in (FL_TYPE_INT, FL_TYPE_BYTES, )
+        if key in self._indexes:
+            raise IndexExists(key)
+        index = Index(self, key, type_)
+        index.create('%s.idx%d.%d' % (self.path, key, type_))
+        for rec_addr, _, _ in self._walk():
+            index.add(rec_addr, self._load(rec_addr))
+        self._indexes[key] = index
+        return index
+
+    def drop_index(self, key):
+        assert self.initialized
+        with self._latch:
+            index = self._indexes.pop(key)
+        index.close()
+        os.unlink(index.path)
+        if os.path.exists(index.path + '.wal'):
+            os.unlink(index.path + '.wal')
+
+    @_timed_op
+    def index_lookup(self, key, value):
+        """ Returns the rec_addrs of the records whose field key equals value """
+        assert self.initialized
+        with self._latch:
+            return self._indexes[key].lookup(value)
+
+    @_timed_op
+    def index_range(self, key, lo=None, hi=None):
+        """ Returns the rec_addrs of the records whose field key is in [lo, hi), in order of value """
+        assert self.initialized
+        with self._latch:
+            return self._indexes[key].range(lo, hi)
+
+    def scan(self, fields=None, where=None, batch_size=None):
+        """
+        Streams (rec_addr, FieldList) for every record, region by region.
+
+        fields limits the decoded fields to the given keys. where is a sequence of (key, op, value) predicates, with
+        op one of == != < <= > >=, that are all evaluated on the stored bytes before anything is decoded. An int or
+        float value is compared with INT, INT64 and FLOAT fields, a bytes value with BYTES fields; a record without
+        the key or with a field of the other kind does not match. With batch_size lists of up to
+        batch_size results are yielded instead. Records written during the scan may or may not be seen.
+        """
+        assert self.initialized
+        scan_filter = _ScanFilter(fields, where)
+        results = self._scan(range(self.num_regions), scan_filter)
+        if batch_size is not None:
+            results = _batched(results, batch_size)
+        return results
+
+    def aggregate(self, key=None, group_by=None, where=None, workers=None):
+        """
+        Computes count, sum, min and max of the values of field key (sum only for INT, INT64 and FLOAT fields) over
+        the records matching where, optionally grouped by the value of field group_by. Without key only records are
+        counted.
+
+        The regions are split across a pool of worker processes that each map the table read-only and aggregate
+        their share. workers defaults to the number of CPUs, with workers=1 the scan runs in this process.
+        Returns {'count': .., 'sum': .., 'min': .., 'max': ..}, or a dict of those by group value with group_by.
+        """
+        assert self.initialized
+        groups = {}
+        for chunk_groups in self._map_regions(_aggregate_regions, (key, group_by, where), workers):
+            for group, partial in chunk_groups.items():
+                if group in groups:
+                    groups[group].merge(partial)
+                else:
+                    groups[group] = partial
+        if group_by is None:
+            return groups.get(None, _Aggregate()).as_dict()
+        return dict((group, partial.as_dict()) for group, partial in groups.items())
+
+    @_timed_op
+    def to_columns(self, keys):
+        """
+        Returns the rec_addrs of the records and the values of their fields keys as NumPy arrays, {'rec_addr': uint64
+        array, key: IntColumn, FloatColumn or BytesColumn, ...}, in rec_addr order. A key's column has the type of its
+        fields, which must all have the same type; a key no record has gets an IntColumn with nothing present. The
+        fields of a segment's fixed format records are parsed together, a field at a time for all of them, while
+        chained and compact records are decoded one by one. Holds the write latch, and needs numpy.
+        """
+        assert self.initialized
+        if numpy is None:
+            raise ImportError('Table.to_columns needs numpy')
+        keys = list(keys)
+        with self._latch:
+            parts = [self._segment_columns(segment, keys) for segment in self._segments]
+        columns = {'rec_addr': numpy.concatenate([rec_addrs for rec_addrs, _, _ in parts]).astype(numpy.uint64)}
+        for key in keys:
+            types = set()
+            for _, found, decoded in parts:
+                types.update(numpy.unique(found[key][1]).tolist())
+                types.update(fl.type for fls in decoded.values() for fl in fls.fls if fl.key == key)
+            if len(types) > 1:
+                raise ValueError('field %d has values of several types' % key)
+            if types == {FL_TYPE_BYTES}:
+                columns[key] = _bytes_column(parts, key)
+            elif types == {FL_TYPE_INT64}:
+                columns[key] = _int_column(parts, key, numpy.int64)
+            elif types == {FL_TYPE_FLOAT}:
+                columns[key] = FloatColumn(*_int_column(parts, key, numpy.float64))
+            else:
+                columns[key] = _int_column(parts, key)
+        return columns
+
+    def _segment_columns(self, segment, keys):
+        # (rec_addrs, _parse_fields of keys, {row: FieldList} of the chained and compact records) of a segment's
+        # records
+        heads = []
+        for i in range(_TABLE_NUM_REGIONS):
+            if segment.region_initialized(i):
+                heads.extend(offset for _, offset in self._region(segment.first_region + i).walk())
+        heads = numpy.array(heads, dtype=numpy.int64)
+        in_regions = heads - _TABLE_HEADER_SZ
+        rec_addrs = ((segment.first_region + in_regions // _REGION_SZ) * _REGION_USABLE_SZ +
+                     in_regions % _REGION_SZ - _REGION_HEADER_SZ)
+        buf = numpy.frombuffer(segment.mmap, dtype=numpy.uint8)
+        try:
+            decoded_rows = numpy.flatnonzero((_get_uint(buf, heads + _FLS_NEXT_OFF, 2) != 0) |
+                                             (_get_uint(buf, heads, 4) != _FLS_MAGIC))
+            decoded = dict((row, self._load(int(rec_addrs[row]))) for row in decoded_rows.tolist())
+            ends = heads + _get_uint(buf, heads + _FLS_LEN_OFF, 2)
+            ends[decoded_rows] = 0
+            return rec_addrs, _parse_fields(buf, heads + _FLS_HEADER_SZ, ends, keys), decoded
+        finally:
+            del buf  # the mmap cannot be closed while it is exported
+
+    @_write_op
+    def from_columns(self, columns):
+        """
+        Inserts a record per row of columns, {key: IntColumn, BytesColumn or a sequence of ints}, with the fields
+        present in its row, and returns their rec_addrs. The records are encoded together with NumPy (which this
+        needs) in the fixed format and inserted like insert_raw; records too large for a region are encoded one by
+        one and chained.
+        """
+        assert self.initialized
+        if numpy is None:
+            raise ImportError('Table.from_columns needs numpy')
+        columns = dict((key, column if isinstance(column, (IntColumn, FloatColumn, BytesColumn))
+                        else IntColumn(numpy.asarray(column), numpy.ones(len(column), dtype=bool)))
+                       for key, column in columns.items())
+        ts = _get_ts()
+        raws, large = _encode_columns(columns, ts)
+        return self._insert_raw(raws, dict((row, _row_field_list(columns, row, ts)) for row in large))
+
+    def changes_since(self, ts):
+        """
+        Iterates over the Changes logged at or after ts (in _get_ts units) in the order they were made. A Change
+        has the ts of the change, its kind (CHANGE_INSERT, ...), the rec_addr and field key it applies to and for
+        CHANGE_MOVE the new rec_addr. The current values are read from the table, merge applies them with their ts.
+        """
+        assert self.initialized and self._changes is not None
+        return self._changes.since(ts)
+
+    def trim_changes(self, ts):
+        """ Drops the Changes logged before ts """
+        assert self.initialized and self._changes is not None
+        with self._latch:
+            self._changes.trim(ts)
+
+    def snapshot(self):
+        """
+        Freezes the table's current contents, returns a Snapshot to export them with. The regions written while it
+        is open are copied first, so close it when done (it is a context manager). Not allowed inside a batch.
+        """
+        assert self.initialized
+        with self._latch:
+            assert self._op_depth == 0  # the image has to be taken between operations
+            snapshot = Snapshot(self, self._next_snapshot)
+            self._next_snapshot += 1
+            for segment in self._segments:
+                segment.snapshots.append(snapshot)
+            self._snapshots.append(snapshot)
+        return snapshot
+
+    def restore(self, path, stream):
+        """
+        Writes the segment files of a Snapshot.export stream read from the binary file object stream to path, which
+        must not exist yet, and opens the table. Indexes are not part of snapshots and have to be created again.
+        """
+        assert not self.initialized
+        self.path = path
+        magic, num_segments = _SNAPSHOT_HEADER.unpack(_read_exactly(stream, _SNAPSHOT_HEADER.size))
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError('not a snapshot')
+        fds = []
+        try:
+            for num in range(num_segments):
+                fds.append(os.open(self._segment_path(num), os.O_RDWR | os.O_CREAT | os.O_EXCL))
+                os.ftruncate(fds[-1], _TABLE_SZ)
+            while True:
+                num, i, crc, length = _SNAPSHOT_ENTRY.unpack(_read_exactly(stream, _SNAPSHOT_ENTRY.size))
+                if num == _SNAPSHOT_END:
+                    break
+                try:
+                    data = zlib.decompress(_read_exactly(stream, length))
+                except zlib.error:
+                    data = b""
+                size = _TABLE_HEADER_SZ if i == _SNAPSHOT_HEADER_ENTRY else _REGION_SZ
+                if num >= num_segments or (i != _SNAPSHOT_HEADER_ENTRY and i >= _TABLE_NUM_REGIONS) or \
+                        len(data) != size or zlib.crc32(data) != crc:
+                    raise ValueError('corrupt snapshot entry for segment %d region %d' % (num, i))
+                os.pwrite(fds[num], data, 0 if i == _SNAPSHOT_HEADER_ENTRY else _TABLE_HEADER_SZ + i*_REGION_SZ)
+            for fd in fds:
+                os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        _fsync_dir(path)
+        self.open(path)
+
+    def _map_regions(self, func, args, workers):
+        # returns func(table, ndxs, *args) for chunks of the regions in order, computed by worker processes that map
+        # the table read-only unless workers is 1
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            return [func(self, range(self.num_regions), *args)]
+        # several chunks per worker so uneven regions balance out
+        num_regions = self.num_regions
+        num_chunks = min(num_regions, workers * 4)
+        chunks = [range(num_regions * i // num_chunks, num_regions * (i + 1) // num_chunks) for i in range(num_chunks)]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(func, self.path, chunk, *args) for chunk in chunks]
+            return [future.result() for future in futures]
+
+    def verify(self, repair=False, workers=None):
+        """
+        Checks every region against the segments found in it by their magics, ignoring its FMEs: the FMEs must only
+        cover space between segments, the region summary must match them and, if the table was closed cleanly, the
+        region checksum must match for the regions not written since. Chained records must link up. The regions are
+        checked by worker processes as in aggregate.
+
+        With repair the FMEs of bad regions are rebuilt from the space between the segments, summaries rewritten,
+        extension segments no record links to freed and all the region checksums stored. Returns a dict of counts
+        and the ndxs (or rec_addrs) of the problems found.
+        """
+        assert self.initialized and not (repair and self.readonly)
+        report = {'records': 0, 'segments': 0, 'leaked': 0, 'bad_fmes': [], 'bad_summaries': [],
+                  'bad_checksums': [], 'orphans': [], 'broken_chains': []}
+        checks = [check for chunk in self._map_regions(_verify_regions, (), workers) for check in chunk]
+        heads = []  # (rec_addr, next rec_addr) of chained heads
+        exts = {}  # rec_addr -> (prev rec_addr, next rec_addr) of extension segments
+        for check in checks:
+            report['records'] += check.records
+            report['segments'] += check.segments
+            report['leaked'] += check.leaked
+            if check.free is not None:
+                report['bad_fmes'].append(check.ndx)
+            elif not check.summary_ok:
+                report['bad_summaries'].append(check.ndx)
+            segment = self._segments[check.ndx // _TABLE_NUM_REGIONS]
+            i = check.ndx % _TABLE_NUM_REGIONS
+            if segment.clean and i not in segment.stale and segment.checksums()[i] != check.checksum:
+                report['bad_checksums'].append(check.ndx)
+            for rec_addr, magic, prev_addr, next_addr in check.links:
+                if magic in _HEAD_MAGICS:
+                    heads.append((rec_addr, next_addr))
+                else:
+                    exts[rec_addr] = (prev_addr, next_addr)
+        linked = set()
+        for rec_addr, next_addr in heads:
+            prev_addr = rec_addr
+            while next_addr is not None:
+                if next_addr not in exts or exts[next_addr][0] != prev_addr or next_addr in linked:
+                    report['broken_chains'].append(rec_addr)
+                    break
+                linked.add(next_addr)
+                prev_addr, next_addr = next_addr, exts[next_addr][1]
+        report['orphans'] = sorted(set(exts) - linked)
+        if report['bad_fmes'] or report['bad_summaries'] or report['bad_checksums'] or report['orphans']:
+            _logger.warning('%s: %d bad FMEs, %d bad summaries, %d bad checksums, %d orphaned segments',
+                            self.path, len(report['bad_fmes']), len(report['bad_summaries']),
+                            len(report['bad_checksums']), len(report['orphans']))
+        if repair:
+            with self.batch():
+                self._repair(checks, report)
+        return report
+
+    def _repair(self, checks, report):
+        if self._cache is not None:
+            self._cache.clear()
+        for check in checks:
+            region = self._region(check.ndx)
+            if check.free is not None:
+                offsets, lengths = check.free
+                # the largest extents get the FME slots, the rest is leaked until the region is compacted
+                kept = sorted(sorted(range(len(offsets)), key=lambda i: -lengths[i])[:_REGION_NUM_FMES])
+                region._free = _FreeMap([offsets[i] for i in kept], [lengths[i] for i in kept])
+                region.leaked = sum(lengths) - region._free.free_space()
+                region._fmes_changed(0, _REGION_NUM_FMES)
+            elif not check.summary_ok:
+                region._update_summary()
+            else:
+                region.leaked = check.leaked
+            region.segment.set_region_bit(_TABLE_REGION_LEAK_OFF, region.ndx % _TABLE_NUM_REGIONS, region.leaked > 0)
+            if region.leaked:
+                self._set_fragmented(region.ndx)
+        for rec_addr in report['orphans']:
+            region, offset = self._locate(rec_addr)
+            self._free_segment(_ChainSegment(rec_addr, region, offset, _EXT_MAGICS))
+        checksums = dict((check.ndx, check.checksum) for check in checks)
+        for segment in self._segments:
+            segment.store_checksums(dict(
+                (i, segment.region_checksum(i) if i in segment.stale else checksums[segment.first_region + i])
+                for i in range(_TABLE_NUM_REGIONS)))
+
+    def _scan(self, ndxs, scan_filter):
+        for ndx in ndxs:
+            yield from self._read(ndx, functools.partial(self._scan_region, scan_filter), ndx)[0]
+
+    def _scan_region(self, scan_filter, ndx):
+        results = []
+        region = self._region(ndx)
+        for rec_addr, offset in region.walk():
+            fls = scan_filter.apply(region.mmap, offset)
+            if fls is _ScanFilter.CHAINED:
+                fls = scan_filter.apply_fls(self._load(rec_addr))
+            if fls is not None:
+                results.append((rec_addr, fls))
+        return results
+
+    def _walk(self):
+        # yields (rec_addr, mmap, offset in mmap) for every record in the table
+        for ndx in range(self.num_regions):
+            region = self._region(ndx)
+            for rec_addr, offset in region.walk():
+                yield rec_addr, region.mmap, offset
+
+    @_write_op
+    def compact(self, ndxs=None, max_regions=None, min_waste=_COMPACT_MIN_WASTE):
+        """
+        Compacts fragmented regions: their records slide together and the free space becomes one extent. Without
+        ndxs the regions freed into since they were last compacted are candidates, the most wasted space first;
+        regions are only compacted if at least min_waste bytes of their free space are outside the largest extent.
+        max_regions bounds the work of a call so compaction can run incrementally, e.g. between requests.
+
+        Records whose head moved get a new rec_addr. The indexes are updated, the callbacks registered with
+        on_relocate are called, and the {old rec_addr: new rec_addr} map is returned.
+        """
+        assert self.initialized and not self.readonly
+        if ndxs is None:
+            ndxs = self._fragmented
+        regions = [self._region(ndx) for ndx in ndxs]
+        regions = sorted((region for region in regions if region.waste() >= min_waste), key=lambda r: -r.waste())
+        moves = {}
+        for region in regions[:max_regions]:
+            moves.update(self._compact_region(region))
+        return moves
+
+    def _set_fragmented(self, ndx, on=True):
+        if (ndx in self._fragmented) != on:
+            if on:
+                self._fragmented.add(ndx)
+            else:
+                self._fragmented.discard(ndx)
+            segment = self._segments[ndx // _TABLE_NUM_REGIONS]
+            segment.set_region_bit(_TABLE_REGION_FRAG_OFF, ndx % _TABLE_NUM_REGIONS, on)
+
+    def on_relocate(self, callback):
+        """ Registers callback to be called with the {old rec_addr: new rec_addr} map of records that compact moved """
+        self._relocate_callbacks.append(callback)
+
+    def _compact_region(self, region):
+        moved = region.compact()
+        self._set_fragmented(region.ndx, False)
+        region.segment.set_region_bit(_TABLE_REGION_LEAK_OFF, region.ndx % _TABLE_NUM_REGIONS, False)
+        region_addr = region.ndx*_REGION_USABLE_SZ
+        moves = {}
+        # pointers into the region from segments in other regions
+        for offset, new_offset in moved.items():
+            at = region.offset + _REGION_HEADER_SZ + new_offset
+            rec_magic, rec_len, next_ = _FLS_HEADER.unpack_from(region.mmap, at)
+            new_addr = region_addr + new_offset
+            if rec_magic in _HEAD_MAGICS:
+                moves[region_addr + offset] = new_addr
+            else:
+                prev_addr = _REC_ADDR.unpack_from(region.mmap, at + _FLS_EXT_PREV_OFF)[0]
+                if prev_addr // _REGION_USABLE_SZ != region.ndx:
+                    prev_region, prev_at = self._locate(prev_addr)
+                    prev_len = _FLS_HEADER.unpack_from(prev_region.mmap, prev_at)[1]
+                    prev_region.segment.write(prev_at + prev_len - _FLS_NEXT_SZ, _REC_ADDR.pack(new_addr))
+            if next_ == _FLS_NEXT_FAR:
+                next_addr = _REC_ADDR.unpack_from(region.mmap, at + rec_len - _FLS_NEXT_SZ)[0]
+                if next_addr // _REGION_USABLE_SZ != region.ndx:
+                    next_region, next_at = self._locate(next_addr)
+                    next_region.segment.write(next_at + _FLS_EXT_PREV_OFF, _REC_ADDR.pack(new_addr))
+        _logger.debug('compacted region %d, moved %d records', region.ndx, len(moves))
+        self._counters['compacted_regions'] += 1
+        self._counters['relocated'] += len(moves)
+        if moves:
+            if self._cache is not None:
+                for rec_addr in moves:
+                    self._invalidate(rec_addr)
+            if self._changes is not None:
+                for rec_addr, new_addr in sorted(moves.items()):
+                    self._changes.append(CHANGE_MOVE, rec_addr, new_rec_addr=new_addr)
+            for index in self._indexes.values():
+                index.move(moves)
+            for callback in self._relocate_callbacks:
+                callback(moves)
+        return moves
+
+    def _record_op(self, name, ns, failed):
+        stats = self._op_stats.get(name)
+        if stats is None:
+            stats = self._op_stats[name] = _OpStats()
+        stats.record(ns, failed)
+        for hook in self._op_hooks:
+            hook(name, ns, failed)
+
+    def on_op(self, hook):
+        """
+        Registers hook to be called with the name of each public operation, the nanoseconds it took and whether it
+        raised, e.g. to profile or trace slow operations. Hooks are only called while metrics are enabled.
+        """
+        self._op_hooks.append(hook)
+
+    def metrics(self, space=True):
+        """
+        Returns a snapshot of the table's metrics: per operation counts, errors and latency percentiles (in
+        microseconds, accurate to within a factor of two), counters of records extended or rewritten by updates that
+        grew them and moved by compaction, the hit rate of the record cache and with space the fill and
+        fragmentation of the regions (see space_stats). Reads from several threads at once can miss a count.
+        """
+        snapshot = {'ops': dict((name, stats.snapshot()) for name, stats in sorted(self._op_stats.items())),
+                    'counters': dict(self._counters)}
+        if self._cache is not None:
+            snapshot['cache'] = self._cache.stats()
+        if space:
+            snapshot['space'] = self.space_stats()
+        return snapshot
+
+    def reset_metrics(self):
+        self._op_stats = {}
+        self._counters = collections.Counter()
+        if self._cache is not None:
+            self._cache.hits = self._cache.misses = self._cache.evictions = 0
+
+    def space_stats(self):
+        """
+        Returns how full and fragmented the regions are: the number of regions per 10% of fill, the free bytes and
+        the free extents (FMEs) holding them, the fraction of the free space outside of each region's largest extent,
+        the regions with every FME in use and the bytes they leak until compacted.
+        """
+        assert self.initialized
+        fill = [0] * 10
+        stats = {'regions': self.num_regions, 'initialized_regions': 0, 'free_bytes': 0, 'free_extents': 0,
+                 'full_fme_regions': 0, 'leaked_bytes': 0}
+        max_extents = 0
+        for ndx in range(self.num_regions):
+            region = self._regions[ndx]
+            if region is None and not self._segments[ndx // _TABLE_NUM_REGIONS].region_initialized(
+                    ndx % _TABLE_NUM_REGIONS):
+                free_space = max_extent = _REGION_USABLE_SZ
+                extents = 1
+            else:
+                region = self._region(ndx)
+                free = region._free_map()
+                free_space, max_extent, extents = free.free_space(), free.max_extent(), len(free.lengths)
+                stats['initialized_regions'] += 1
+                stats['leaked_bytes'] += region.leaked
+                if extents == _REGION_NUM_FMES:
+                    stats['full_fme_regions'] += 1
+            fill[min(9, (_REGION_USABLE_SZ - free_space) * 10 // _REGION_USABLE_SZ)] += 1
+            stats['free_bytes'] += free_space
+            stats['free_extents'] += extents
+            max_extents += max_extent
+        stats['fill_histogram'] = fill
+        stats['fragmentation'] = 1 - max_extents / stats['free_bytes'] if stats['free_bytes'] else 0.0
+        return stats
+
+    def _compact_for(self, space, moves=None):
+        # compacts a region with at least space bytes free in total, returns its ndx or -1; the records it moved are
+        # added to moves
+        candidates = [self._region(ndx) for ndx in self._fragmented]
+        candidates = [region for region in candidates if region._free_map().free_space() + region.leaked >= space]
+        if not candidates:
+            return -1
+        region = max(candidates, key=lambda r: r._free_map().free_space() + r.leaked)
+        moved = self._compact_region(region)
+        if moves is not None:
+            moves.update(moved)
+        return region.ndx if region._free_map().max_extent() >= space else -1
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups the write operations in the block into one operation of the write-ahead log: after a crash either
+        all or none of them are replayed, and with DURABILITY_BATCH they are committed together when the block exits.
+        Other threads cannot write during the block and read its writes only once it exits.
+        """
+        self._begin_op()
+        try:
+            yield self
+        finally:
+            self._end_op()
+
+    def _begin_op(self):
+        self._latch.acquire()
+        self._op_depth += 1
+
+    def _end_op(self):
+        self._op_depth -= 1
+        commit = False
+        if self._op_depth == 0:
+            for segment in self._segments:
+                segment.end_writes()
+            if self._wal is not None:
+                self._wal.end_op()
+                commit = self.durability == DURABILITY_BATCH and not self.group_commit
+        self._latch.release()
+        if commit:
+            self.commit()
+
+    def commit(self):
+        """ Makes the completed write operations durable by appending them to the write-ahead log with one fsync """
+        if self._wal is None:
+            return
+        with self._sync_lock:
+            for index in list(self._indexes.values()):
+                index.commit()
+            if self._changes is not None:
+                self._changes.flush()
+            self._wal.commit()
+        if self._wal.size > _WAL_CHECKPOINT_SZ:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Commits, syncs the pages written since the last checkpoint to the table files and empties the log """
+        if self._wal is None:
+            return
+        # under the latch no operation is half done, so every page written so far is either synced or in the log
+        with self._latch, self._sync_lock:
+            for index in self._indexes.values():
+                index.checkpoint()
+            self._wal.commit()
+            self._checkpoint()
+
+    def _checkpoint(self):
+        # every operation in the log file was applied to the mmaps before it was committed, so once they are synced
+        # the log can go; operations still buffered stay buffered
+        for segment in self._segments:
+            segment.sync()
+        self._wal.truncate()
+
+    def _open_wal(self, truncate=False):
+        self._wal = _WriteAheadLog(self.path + '.wal')
+        if truncate:
+            self._wal.truncate()
+        _fsync_dir(self.path)
+        for segment in self._segments:
+            segment.wal = self._wal
+            segment.dirty = set()
+        if self.durability == DURABILITY_PERIODIC and self.sync_interval:
+            self._stop_sync = threading.Event()
+            self._sync_thread = threading.Thread(target=self._sync_periodically, name='db48-sync', daemon=True)
+            self._sync_thread.start()
+
+    def _sync_periodically(self):
+        while not self._stop_sync.wait(self.sync_interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                _logger.exception('%s: periodic checkpoint failed', self.path)
 
     def close(self):
         assert self.initialized
-        self._mmap.close()
-        os.close(self._fd)
+        if self._sync_thread is not None:
+            self._stop_sync.set()
+            self._sync_thread.join()
+            self._sync_thread = None
+        for snapshot in list(self._snapshots):
+            snapshot.close()
+        if not self.readonly:
+            with self.batch():
+                for segment in self._segments:
+                    segment.store_checksums(dict((i, segment.region_checksum(i)) for i in segment.stale))
+        if self._wal is not None:
+            self.checkpoint()
+            self._wal.close()
+            self._wal = None
+        for index in self._indexes.values():
+            index.close()
+        self._indexes = {}
+        if self._changes is not None:
+            self._changes.close()
+            self._changes = None
+        if not self.readonly:
+            for segment in self._segments:
+                if not segment.mmap.closed:
+                    segment.mark_clean()
+        for segment in self._segments:
+            # raises BufferError while zero-copy values from view() are referenced, close can then be retried
+            segment.close()
+        self._segments = []
+        self._mmap = None
+        self._regions = None
+        if self._cache is not None:
+            self._cache.clear()
         self.initialized = False
 
-    def _find_region_with_space(self, space):
-        region_summaries = struct.unpack_from(">" + "B"*_TABLE_NUM_REGIONS, self._mmap[_TABLE_REGION_SUMMARY_OFF:])
-        tries = 0
-        for ndx in range(_TABLE_NUM_REGIONS):
-            percent_full = float(region_summaries[ndx]) / 100.0
-            free_space = _REGION_USABLE_SZ * (1.0 - percent_full)
-            if free_space >= space and percent_full <= 0.95:
-                return Region(self, ndx)
-        raise NoSpace()
+    def _segment_path(self, num):
+        return self.path if num == 0 else '%s.seg%d' % (self.path, num)
+
+    def _add_segment(self):
+        segment = _Segment(len(self._segments), self._segment_path(len(self._segments)))
+        segment.create(self.preallocate)
+        self._attach_segment(segment)
+        if self._wal is not None:
+            # the log only has the writes that follow, so the new file has to be on disk before them
+            segment.sync(full=True)
+            os.fsync(segment.fd)
+            _fsync_dir(segment.path)
+            segment.wal = self._wal
+            segment.dirty = set()
+        if segment.num > 0:
+            _logger.debug('added segment %s', segment.path)
+
+    def _attach_segment(self, segment):
+        self._segments.append(segment)
+        if segment.num == 0:
+            self._mmap = segment.mmap
+        self._regions.extend([None] * _TABLE_NUM_REGIONS)
+        self._free_index.grow(self.num_regions)
+        # the summaries only record how full each region is, so until a region is touched its largest free extent
+        # is taken to be its total free space; that over-estimates fragmented regions, and the retry in _insert
+        # corrects it once the region is loaded
+        region_summaries = struct.unpack_from(">%dB" % _TABLE_NUM_REGIONS, segment.mmap, _TABLE_REGION_SUMMARY_OFF)
+        self._free_index.set_many(segment.first_region, [_REGION_USABLE_SZ * (100 - percent_full) // 100
+                                                         for percent_full in region_summaries])
+        self._fragmented.update(segment.first_region + i for i in range(_TABLE_NUM_REGIONS)
+                                if segment.region_bit(_TABLE_REGION_FRAG_OFF, i))
+
+    def _find_region_with_space(self, space, compact=False, moves=None):
+        # compact is only set by callers that hold no rec_addrs a compaction could move, or that pass moves to learn
+        # their new addresses
+        if space > _REGION_USABLE_SZ:
+            raise NoSpace()
+        ndx = self._free_index.find(space, self._next_region)
+        if ndx < 0 and compact and self.auto_compact:
+            ndx = self._compact_for(space, moves)
+        if ndx < 0:
+            if self.max_segments is not None and len(self._segments) >= self.max_segments:
+                raise NoSpace()
+            self._add_segment()
+            ndx = self._free_index.find(space, self._next_region)
+        return self._region(ndx)
+
+    def _update_region_summary(self, ndx, free_space, max_extent):
+        segment = self._segments[ndx // _TABLE_NUM_REGIONS]
+        offset = _TABLE_REGION_SUMMARY_OFF + ndx % _TABLE_NUM_REGIONS
+        segment.write(offset, struct.pack("B", _percent_full(free_space)))
+        self._free_index.set(ndx, max_extent)
 
     def _find_region_with_rec(self, rec_addr):
         ndx = rec_addr // _REGION_USABLE_SZ
-        return Region(self, ndx)
+        return self._region(ndx)
+
+    def _region(self, ndx):
+        region = self._regions[ndx]
+        if region is None:
+            # readers create regions too, and a region's free map must only be loaded once
+            with self._latch:
+                region = self._regions[ndx]
+                if region is None:
+                    region = self._regions[ndx] = Region(self, ndx)
+        return region
+
+
+class _Segment(object):
+    """ One file of a table: a header followed by _TABLE_NUM_REGIONS regions, mapped in full """
+
+    def __init__(self, num, path):
+        self.num = num
+        self.path = path
+        self.first_region = num * _TABLE_NUM_REGIONS
+        self.fd = None
+        self.mmap = None
+        self.view = None
+        self.wal = None  # the table's _WriteAheadLog, if any
+        self.dirty = None  # _SYNC_CHUNK_SZ chunks written since the last sync, if tracked
+        self.stale = set()  # regions (numbered in the segment) written since their checksum was stored
+        self.clean = True  # whether the file was closed cleanly before it was opened
+        self.versions = [0] * _TABLE_NUM_REGIONS  # per region, odd while an operation writes to it, see Table
+        self._writing = []  # regions whose version is odd
+        self.snapshots = []  # the open Snapshots taken while the segment existed
+        self.fresh = {}  # offset: end of the space allocated by the operation in progress, tracked with a wal
+
+    def write(self, offset, raw):
+        # every change to a table file goes through here so it can be logged, synced and copied for snapshots
+        for snapshot in self.snapshots:
+            snapshot.preserve(self, offset)
+        if offset >= _TABLE_HEADER_SZ:
+            i = (offset - _TABLE_HEADER_SZ) // _REGION_SZ
+            self.stale.add(i)
+            if not self.versions[i] & 1:
+                self.begin_write(i)
+            if (self.wal is not None and (offset - _TABLE_HEADER_SZ) % _REGION_SZ >= _REGION_HEADER_SZ and
+                    self.fresh.get(offset, 0) < offset + len(raw)):
+                # the write may overwrite committed records, not only space the operation allocated
+                self.wal.protect(self, offset, len(raw))
+        self.mmap[offset:offset+len(raw)] = raw
+        if self.wal is not None:
+            self.wal.log(self.num, offset, raw)
+        if self.dirty is not None:
+            self.dirty.add(offset // _SYNC_CHUNK_SZ)
+            self.dirty.add((offset + len(raw) - 1) // _SYNC_CHUNK_SZ)
+
+    def begin_write(self, i):
+        if not self.versions[i] & 1:
+            self.versions[i] += 1
+            self._writing.append(i)
+
+    def end_writes(self):
+        for i in self._writing:
+            self.versions[i] += 1
+        self._writing = []
+        if self.fresh:
+            self.fresh = {}
+
+    def sync(self, full=False):
+        # msyncs the chunks written since the last sync, or the whole file
+        if full:
+            self.dirty = set() if self.dirty is not None else None
+            self.mmap.flush()
+            return
+        dirty, self.dirty = self.dirty, set()
+        for chunk in sorted(dirty):
+            offset = chunk * _SYNC_CHUNK_SZ
+            self.mmap.flush(offset, min(_SYNC_CHUNK_SZ, _TABLE_SZ - offset))
+
+    def create(self, preallocate=False):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        if preallocate and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.fd, 0, _TABLE_SZ)
+        else:
+            os.ftruncate(self.fd, _TABLE_SZ)
+        self.mmap = mmap.mmap(self.fd, _TABLE_SZ)
+        self.view = memoryview(self.mmap)
+        self.mmap[_TABLE_MAGIC_OFF:_TABLE_MAGIC_OFF+4] = struct.pack(">I", _TABLE_MAGIC)
+        self.mmap[_TABLE_FLAGS_OFF:_TABLE_FLAGS_OFF+4] = _INT.pack(_TABLE_FLAG_LAZY_REGIONS)
+        # the csum stays 0 until the file is closed, the region summaries and initialized bits are already zero
+        self.mmap[_TABLE_REGION_CSUM_OFF:_TABLE_REGION_CSUM_OFF+_REGION_CSUMS.size] = _REGION_CSUMS.pack(
+            *[_REGION_ZERO_CSUM] * _TABLE_NUM_REGIONS)
+
+    def open(self, readonly=False):
+        if readonly:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            self.mmap = mmap.mmap(self.fd, _TABLE_SZ, access=mmap.ACCESS_READ)
+        else:
+            self.fd = os.open(self.path, os.O_RDWR)
+            self.mmap = mmap.mmap(self.fd, _TABLE_SZ)
+        self.view = memoryview(self.mmap)
+        magic, csum = struct.unpack_from(">II", self.mmap, _TABLE_MAGIC_OFF)
+        assert magic == _TABLE_MAGIC
+        self.clean = csum == self._checksums_csum()
+        if not readonly:
+            self.mmap[_TABLE_CSUM_OFF:_TABLE_CSUM_OFF+4] = _INT.pack(0)
+            self.mmap.flush(0, mmap.PAGESIZE)
+
+    def flags(self):
+        return _INT.unpack_from(self.mmap, _TABLE_FLAGS_OFF)[0]
+
+    def set_flag(self, flag, on):
+        # header flags are only set before the table is used, so they are written directly rather than logged
+        flags = self.flags() | flag if on else self.flags() & ~flag
+        self.mmap[_TABLE_FLAGS_OFF:_TABLE_FLAGS_OFF+4] = _INT.pack(flags)
+
+    def region_initialized(self, i):
+        if not self.flags() & _TABLE_FLAG_LAZY_REGIONS:
+            return True
+        return self.region_bit(_TABLE_REGION_INIT_OFF, i)
+
+    def set_region_initialized(self, i):
+        self.set_region_bit(_TABLE_REGION_INIT_OFF, i, True)
+
+    def region_bit(self, bitmap, i):
+        return bool(self.mmap[bitmap + i // 8] & (1 << (i % 8)))
+
+    def set_region_bit(self, bitmap, i, on):
+        offset = bitmap + i // 8
+        byte = self.mmap[offset] | (1 << (i % 8)) if on else self.mmap[offset] & ~(1 << (i % 8))
+        if byte != self.mmap[offset]:
+            self.write(offset, bytes((byte, )))
+
+    def checksums(self):
+        return _REGION_CSUMS.unpack_from(self.mmap, _TABLE_REGION_CSUM_OFF)
+
+    def region_checksum(self, i):
+        offset = _TABLE_HEADER_SZ + i*_REGION_SZ
+        return zlib.crc32(self.view[offset:offset+_REGION_SZ]) & 0xffff
+
+    def store_checksums(self, csums):
+        """ Writes the checksums of the {region number in the segment: checksum} map """
+        for i, csum in csums.items():
+            self.write(_TABLE_REGION_CSUM_OFF + 2*i, _NEXT.pack(csum))
+            self.stale.discard(i)
+
+    def mark_clean(self):
+        # syncs the file, then records that its region checksums are current
+        self.mmap.flush()
+        self.mmap[_TABLE_CSUM_OFF:_TABLE_CSUM_OFF+4] = _INT.pack(self._checksums_csum())
+        self.mmap.flush(0, mmap.PAGESIZE)
+
+    def _checksums_csum(self):
+        return zlib.crc32(self.view[_TABLE_REGION_CSUM_OFF:_TABLE_REGION_CSUM_OFF+_REGION_CSUMS.size])
+
+    def close(self):
+        if self.mmap.closed:
+            return
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # zero-copy values from view() are still referenced
+            self.view = memoryview(self.mmap)
+            raise
+        os.close(self.fd)
+
+
+class _WriteAheadLog(object):
+    """
+    A redo log of the bytes written to a table's segment files. The writes of an operation are buffered and end with
+    a commit marker; commit appends the complete operations buffered so far with a single fsync (a group commit).
+    On open the complete operations in the log are applied again, and once the segment files are synced the log is
+    truncated (a checkpoint).
+
+    Data pages can reach the disk before the log does, so an operation that was not committed when the process died
+    may be partly applied. That is harmless for space it allocated, and the repair in Table.verify fixes the free
+    space maps and summaries, but an overwrite of committed data (an update in place, a delete, compaction) could
+    tear it. So before such a write the bytes it overwrites are appended to the log as an undo entry, and on open
+    the undo entries of the operations that were not committed are applied after the redo, newest first. Operations
+    are numbered; commit markers and undo entries carry the number.
+
+    Undo entries are written to the log file right away but not synced, the next commit's fsync covers them: that
+    is enough when the process dies, whose writes the OS still has, but a power loss can keep a page the OS wrote
+    back and lose the undo entry written just before it (a window of up to a commit interval).
+    """
+    _ENTRY = struct.Struct(">IBHII")  # crc32 of the rest of the entry and the data, kind, segment, offset, length
+    _WRITE = 1
+    _COMMIT = 2  # the offset is the operation's number
+    _UNDO = 3  # the data is the number of the operation that logged it and the bytes overwritten at the offset
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        self.size = os.fstat(self.fd).st_size
+        self._buf = bytearray()
+        self._complete = 0  # length of the buffered complete operations
+        self._lock = threading.Lock()  # commits can come from a background thread
+        self.seq = 0  # number of the operation in progress
+
+    def log(self, segment, offset, raw):
+        header = self._ENTRY.pack(0, self._WRITE, segment, offset, len(raw))
+        crc = zlib.crc32(raw, zlib.crc32(memoryview(header)[4:]))
+        self._buf += _INT.pack(crc)
+        self._buf += memoryview(header)[4:]
+        self._buf += raw
+
+    def end_op(self):
+        with self._lock:
+            header = self._ENTRY.pack(0, self._COMMIT, 0, self.seq, 0)
+            self._buf += _INT.pack(zlib.crc32(memoryview(header)[4:]))
+            self._buf += memoryview(header)[4:]
+            self._complete = len(self._buf)
+            self.seq += 1
+
+    def protect(self, segment, offset, length):
+        """ Appends an undo entry with the length bytes at offset in segment that a write will overwrite, see above """
+        with self._lock:
+            data = _INT.pack(self.seq) + segment.mmap[offset:offset+length]
+            header = self._ENTRY.pack(0, self._UNDO, segment.num, offset, len(data))
+            entry = _INT.pack(zlib.crc32(data, zlib.crc32(memoryview(header)[4:]))) + header[4:] + data
+            written = 0
+            while written < len(entry):
+                written += os.write(self.fd, entry[written:])
+            self.size += len(entry)
+
+    def commit(self, sync=True):
+        """ Appends the complete operations to the log, returns the number of bytes written """
+        with self._lock:
+            n = self._complete
+            if n == 0:
+                return 0
+            data = bytes(self._buf[:n])
+            del self._buf[:n]
+            self._complete = 0
+            written = 0
+            while written < n:
+                written += os.write(self.fd, data[written:])
+            if sync:
+                os.fsync(self.fd)
+            self.size += n
+        return n
+
+    def truncate(self):
+        with self._lock:
+            os.ftruncate(self.fd, 0)
+            os.fsync(self.fd)
+            self.size = 0
+
+    def replay(self, segments):
+        """ Applies the complete operations in the log to the segments (by number), returns how many there were """
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pending = []
+        undo = []
+        committed = -1
+        num_ops = 0
+        offset = 0
+        while offset + self._ENTRY.size <= len(data):
+            crc, kind, segment, seg_offset, length = self._ENTRY.unpack_from(data, offset)
+            end = offset + self._ENTRY.size + length
+            if end > len(data) or zlib.crc32(data[offset+4:end]) != crc:
+                break  # torn write at the end of the log
+            if kind == self._WRITE:
+                pending.append((segment, seg_offset, data[offset+self._ENTRY.size:end]))
+            elif kind == self._COMMIT:
+                committed = seg_offset
+                for segment, seg_offset, raw in pending:
+                    if segment < len(segments):
+                        segments[segment].mmap[seg_offset:seg_offset+len(raw)] = raw
+                pending = []
+                num_ops += 1
+            elif kind == self._UNDO:
+                seq = _INT.unpack_from(data, offset + self._ENTRY.size)[0]
+                undo.append((seq, segment, seg_offset, data[offset+self._ENTRY.size+_INT.size:end]))
+            offset = end
+        if pending or offset < len(data):
+            _logger.warning('%s: ignoring %d bytes of incomplete operations', self.path, len(data) - offset)
+        undone = [entry for entry in undo if entry[0] > committed and entry[1] < len(segments)]
+        for _, segment, seg_offset, raw in reversed(undone):
+            segments[segment].mmap[seg_offset:seg_offset+len(raw)] = raw
+        if undone:
+            _logger.warning('%s: undid %d writes of operations that were not committed', self.path, len(undone))
+        return num_ops
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _RecordCache(object):
+    """
+    The decoded records most recently looked up, by rec_addr, evicted least recently used first once their size
+    exceeds max_bytes. A record's size is its encoded length plus an estimate of the objects decoding it makes.
+    """
+    _FIELD_OVERHEAD = 100
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._records = collections.OrderedDict()  # rec_addr: (FieldList, size)
+        self._lock = threading.Lock()
+
+    def get(self, rec_addr):
+        with self._lock:
+            entry = self._records.get(rec_addr)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._records.move_to_end(rec_addr)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, rec_addr, fls, versions, version):
+        # (versions, i) and version are those of the region the record was read from, see Table._read: the record
+        # is only cached if no write to the region started since, as the write's invalidate may have come first
+        size = fls.length() + len(fls.fls) * self._FIELD_OVERHEAD
+        if size > self.max_bytes:
+            return
+        versions, i = versions
+        with self._lock:
+            if versions[i] != version:
+                return
+            entry = self._records.pop(rec_addr, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+            self._records[rec_addr] = (fls, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._records.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def invalidate(self, rec_addr):
+        with self._lock:
+            entry = self._records.pop(rec_addr, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'records': len(self._records), 'bytes': self.bytes, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class _ChangeFeed(object):
+    """
+    An append-only log of Changes: an entry per field written by an insert, update or merge, and one per deleted or
+    moved record. Entries have fixed sizes and their ts (64 bits of milliseconds, see _get_ts, so they do not wrap
+    around) never decreases (a clock stepping back logs the last ts again), so since finds its start with a binary
+    search.
+
+    Entries are buffered and written on flush, which reads and commits do, so a crash can lose the latest ones.
+    """
+    _ENTRY = struct.Struct(">QBHQQ")  # ts, kind, key, rec_addr, new rec_addr
+    _READ_SZ = 4096  # entries read at a time
+
+    def __init__(self, path, truncate=False):
+        self.path = path
+        self._file = open(path, 'wb' if truncate else 'ab')
+        self._buf = bytearray()
+        self._lock = threading.Lock()  # since flushes from reader threads
+        self._last_ts = None
+        size = self._file.tell()
+        if size >= self._ENTRY.size:
+            with open(path, 'rb') as f:
+                f.seek(size - size % self._ENTRY.size - self._ENTRY.size)
+                self._last_ts = self._ENTRY.unpack(f.read(self._ENTRY.size))[0]
+
+    def append(self, kind, rec_addr, keys=(_CHANGE_ALL_KEYS, ), new_rec_addr=0):
+        ts = _get_ts()
+        with self._lock:
+            if self._last_ts is not None and ts < self._last_ts:
+                ts = self._last_ts
+            self._last_ts = ts
+            for key in keys:
+                self._buf += self._ENTRY.pack(ts, kind, key, rec_addr, new_rec_addr)
+
+    def flush(self):
+        with self._lock:
+            if self._buf:
+                self._file.write(self._buf)
+                self._buf = bytearray()
+            self._file.flush()
+
+    def since(self, ts):
+        self.flush()
+        with open(self.path, 'rb') as f:
+            n = os.fstat(f.fileno()).st_size // self._ENTRY.size
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(mid * self._ENTRY.size)
+                if self._ENTRY.unpack(f.read(self._ENTRY.size))[0] < ts:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            f.seek(lo * self._ENTRY.size)
+            while lo < n:
+                count = min(self._READ_SZ, n - lo)
+                data = f.read(count * self._ENTRY.size)
+                for entry in self._ENTRY.iter_unpack(data):
+                    ts, kind, key, rec_addr, new_rec_addr = entry
+                    yield Change(ts, kind, rec_addr, key, new_rec_addr)
+                lo += count
+
+    def trim(self, ts):
+        # copies the entries to keep to a new file that replaces the log, nothing may be appended meanwhile
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for change in self.since(ts):
+                f.write(self._ENTRY.pack(change.ts, change.kind, change.key, change.rec_addr, change.new_rec_addr))
+        with self._lock:
+            os.replace(tmp_path, self.path)
+            self._file.close()
+            self._file = open(self.path, 'ab')
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class Snapshot(object):
+    """
+    A consistent image of a table's segment files as of when Table.snapshot took it. While a snapshot is open the
+    first write to each of its regions and segment headers copies their old contents to a side file
+    (<table path>.snap<n>) first, so taking a snapshot copies nothing and writers pay one copy per region they touch.
+    Regions that were not initialized when it was taken are not copied, and segments added later are not part of it.
+
+    export writes the image as a stream that holds only the regions with live records and Table.restore turns back
+    into a table, for backups and for seeding new replicas.
+    """
+
+    def __init__(self, table, num):
+        self.table = table
+        self.path = '%s.snap%d' % (table.path, num)
+        self.num_segments = len(table._segments)
+        self.fd = None  # the side file, created by the first copy
+        self._copies = {}  # (segment, region or _SNAPSHOT_HEADER_ENTRY): offset in the side file, None for zeros
+        self._size = 0
+        # which regions were initialized, so the first write to one that was not needs no copy
+        self._initialized = [segment.region_initialized(i) for segment in table._segments
+                             for i in range(_TABLE_NUM_REGIONS)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def preserve(self, segment, offset):
+        # called by _Segment.write (under the table's write latch) before it writes at offset
+        if segment.num >= self.num_segments:
+            return
+        if offset < _TABLE_HEADER_SZ:
+            key, start, length = (segment.num, _SNAPSHOT_HEADER_ENTRY), 0, _TABLE_HEADER_SZ
+        else:
+            i = (offset - _TABLE_HEADER_SZ) // _REGION_SZ
+            key, start, length = (segment.num, i), _TABLE_HEADER_SZ + i*_REGION_SZ, _REGION_SZ
+        if key in self._copies:
+            return
+        if key[1] != _SNAPSHOT_HEADER_ENTRY and not self._initialized[segment.first_region + key[1]]:
+            self._copies[key] = None
+            return
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        os.pwrite(self.fd, segment.view[start:start+length], self._size)
+        self._copies[key] = self._size
+        self._size += length
+        self.table._counters['snapshot_copies'] += 1
+
+    def _read(self, num, i, length):
+        # the first length bytes of region i (or the header) of segment num as of the snapshot
+        key = (num, i)
+        with self.table._latch:
+            if key not in self._copies:
+                start = 0 if i == _SNAPSHOT_HEADER_ENTRY else _TABLE_HEADER_SZ + i*_REGION_SZ
+                return bytes(self.table._segments[num].view[start:start+length])
+        offset = self._copies[key]
+        return bytes(length) if offset is None else os.pread(self.fd, length, offset)
+
+    def chunks(self):
+        """
+        Yields the export stream in pieces of an entry each. Regions that are not initialized or whose FMEs say they
+        are empty are left out, the free extents of the others are zeroed, and the segment headers are rewritten to
+        match: only the exported regions are initialized and the checksums are those of the image, so the restored
+        table is clean.
+        """
+        assert self.table is not None
+        yield _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, self.num_segments)
+        for num in range(self.num_segments):
+            header = bytearray(self._read(num, _SNAPSHOT_HEADER_ENTRY, _TABLE_HEADER_SZ))
+            lazy = _INT.unpack_from(header, _TABLE_FLAGS_OFF)[0] & _TABLE_FLAG_LAZY_REGIONS
+            initialized = bytearray(_TABLE_NUM_REGIONS // 8)
+            csums = [_REGION_ZERO_CSUM] * _TABLE_NUM_REGIONS
+            for i in range(_TABLE_NUM_REGIONS):
+                if lazy and not header[_TABLE_REGION_INIT_OFF + i // 8] & (1 << (i % 8)):
+                    continue
+                if header[_TABLE_REGION_SUMMARY_OFF + i] == 0:
+                    # only the FMEs are needed to tell whether the region is empty
+                    if _FreeMap.load(self._read(num, i, _REGION_HEADER_SZ), 0).free_space() == _REGION_USABLE_SZ:
+                        continue
+                region = bytearray(self._read(num, i, _REGION_SZ))
+                free = _FreeMap.load(region, 0)
+                if free.free_space() == _REGION_USABLE_SZ:
+                    continue
+                for offset, length in zip(free.offsets, free.lengths):
+                    start = _REGION_HEADER_SZ + offset
+                    region[start:start+length] = bytes(length)
+                csums[i] = zlib.crc32(region) & 0xffff
+                initialized[i // 8] |= 1 << (i % 8)
+                yield self._entry(num, i, region)
+            header[_TABLE_FLAGS_OFF:_TABLE_FLAGS_OFF+4] = _INT.pack(
+                _INT.unpack_from(header, _TABLE_FLAGS_OFF)[0] | _TABLE_FLAG_LAZY_REGIONS)
+            header[_TABLE_REGION_INIT_OFF:_TABLE_REGION_INIT_OFF+len(initialized)] = initialized
+            header[_TABLE_REGION_CSUM_OFF:_TABLE_REGION_CSUM_OFF+_REGION_CSUMS.size] = _REGION_CSUMS.pack(*csums)
+            header[_TABLE_CSUM_OFF:_TABLE_CSUM_OFF+4] = _INT.pack(
+                zlib.crc32(header[_TABLE_REGION_CSUM_OFF:_TABLE_REGION_CSUM_OFF+_REGION_CSUMS.size]))
+            yield self._entry(num, _SNAPSHOT_HEADER_ENTRY, header)
+        yield _SNAPSHOT_ENTRY.pack(_SNAPSHOT_END, 0, 0, 0)
+
+    @staticmethod
+    def _entry(num, i, data):
+        compressed = zlib.compress(data, 1)
+        return _SNAPSHOT_ENTRY.pack(num, i, zlib.crc32(data), len(compressed)) + compressed
+
+    def export(self, out):
+        """ Writes the snapshot to the binary file object out, see chunks; returns the number of bytes written """
+        written = 0
+        for chunk in self.chunks():
+            out.write(chunk)
+            written += len(chunk)
+        return written
+
+    def close(self):
+        """ Stops the copying and removes the side file """
+        table, self.table = self.table, None
+        if table is None:
+            return
+        with table._latch:
+            for segment in table._segments:
+                if self in segment.snapshots:
+                    segment.snapshots.remove(self)
+            table._snapshots.remove(self)
+        if self.fd is not None:
+            os.close(self.fd)
+            os.unlink(self.path)
+            self.fd = None
+
+
+class Index(object):
+    """
+    A secondary index over the values of one field key. Every (value, rec_addr) entry is stored as a FieldList in
+    a sibling db48 Table (<table path>.idx<key>.<type>) so the index survives restarts; a sorted copy of the
+    entries is kept in memory to answer equality and range queries.
+
+    Records whose field key is missing or has a different type than the index are not indexed.
+    """
+
+    def __init__(self, table, key, type_):
+        self.table = table
+        self.key = key
+        self.type = type_
+        self.path = None
+        self._entries_table = None
+        self._sorted = _SortedList()
+        self._entries = {}  # rec_addr -> (value, entry rec_addr)
+
+    def create(self, path):
+        self.path = path
+        self._entries_table = self._new_entries_table()
+        self._entries_table.create(path)
+
+    def open(self, path):
+        self.path = path
+        self._entries_table = self._new_entries_table()
+        self._entries_table.open(path)
+        for entry_addr, mm, offset in self._entries_table._walk():
+            entry = FieldList.load(offset, mm).fls
+            value, rec_addr = entry[0].value, _REC_ADDR.unpack(entry[1].value)[0]
+            self._sorted.add((value, rec_addr))
+            self._entries[rec_addr] = (value, entry_addr)
+
+    def close(self):
+        self._entries_table.close()
+        self._entries_table = None
+
+    def commit(self):
+        self._entries_table.commit()
+
+    def checkpoint(self):
+        self._entries_table.checkpoint()
+
+    def _new_entries_table(self):
+        # the entries are committed and checkpointed along with the table
+        entries_table = Table(max_segments=None, durability=self.table.durability, sync_interval=None, metrics=False)
+        entries_table.group_commit = True
+        return entries_table
+
+    def add(self, rec_addr, fls):
+        value = self._value(fls)
+        if value is None:
+            return
+        entry = FieldList.set((Field(self.type, 0, value), Field(FL_TYPE_BYTES, 1, _REC_ADDR.pack(rec_addr))))
+        entry_addr = self._entries_table.insert(entry)
+        self._sorted.add((value, rec_addr))
+        self._entries[rec_addr] = (value, entry_addr)
+
+    def remove(self, rec_addr):
+        entry = self._entries.pop(rec_addr, None)
+        if entry is None:
+            return
+        value, entry_addr = entry
+        self._entries_table.delete(entry_addr)
+        self._sorted.remove((value, rec_addr))
+
+    def update(self, old_rec_addr, new_rec_addr, fls):
+        entry = self._entries.get(old_rec_addr)
+        if entry is not None and old_rec_addr == new_rec_addr and entry[0] == self._value(fls):
+            return
+        self.remove(old_rec_addr)
+        self.add(new_rec_addr, fls)
+
+    def move(self, moves):
+        """ Points the entries of records that were relocated at their new rec_addr, moves maps old to new """
+        moved = [(rec_addr, self._entries.pop(rec_addr)) for rec_addr in moves if rec_addr in self._entries]
+        for rec_addr, (value, _) in moved:
+            self._sorted.remove((value, rec_addr))
+        for rec_addr, (value, entry_addr) in moved:
+            new_rec_addr = moves[rec_addr]
+            entry = FieldList.set((Field(FL_TYPE_BYTES, 1, _REC_ADDR.pack(new_rec_addr)),))
+            self._entries_table.update(entry_addr, entry)
+            self._sorted.add((value, new_rec_addr))
+            self._entries[new_rec_addr] = (value, entry_addr)
+
+    def lookup(self, value):
+        return [rec_addr for _, rec_addr in self._sorted.irange((value, ), (value, _MAX_REC_ADDR))]
+
+    def range(self, lo=None, hi=None):
+        lo = None if lo is None else (lo, )
+        hi = None if hi is None else (hi, )
+        return [rec_addr for _, rec_addr in self._sorted.irange(lo, hi, inclusive_hi=False)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _value(self, fls):
+        for fl in fls.fls:
+            if fl.key == self.key:
+                return fl.value if fl.type == self.type else None
+        return None
+
+
+class _ScanFilter(object):
+    """
+    Projection and predicates of a scan. Each record's field headers are walked once, BYTES predicates compare the
+    raw values, numeric ones (ints and floats) the decoded value of an INT, INT64 or FLOAT field, and only projected
+    fields are decoded.
+    """
+    __slots__ = ['fields', 'predicates', 'keys']
+
+    CHAINED = object()  # returned by apply for chained records, which have to be loaded and passed to apply_fls
+
+    _OPS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+            '>=': operator.ge}
+
+    def __init__(self, fields=None, where=None):
+        self.fields = None if fields is None else frozenset(fields)
+        self.predicates = []
+        for key, op, value in (where or ()):
+            if isinstance(value, (int, float)):
+                self.predicates.append((key, True, self._OPS[op], value))
+            else:
+                self.predicates.append((key, False, self._OPS[op], bytes(value)))
+        self.keys = frozenset(key for key, _, _, _ in self.predicates)
+
+    def apply(self, buf, offset):
+        """ Returns the projected FieldList of the record at offset if it matches, otherwise None """
+        rec_magic, rec_len, next_ = _FLS_HEADER.unpack_from(buf, offset)
+        if next_:
+            return self.CHAINED
+        if rec_magic == _FLS_COMPACT_MAGIC:
+            return self.apply_fls(FieldList.load(offset, buf))
+        end = offset + rec_len
+        offset += _FLS_HEADER_SZ
+        fields, keys = self.fields, self.keys
+        found = {}  # key -> (type, offset of value, length of value) for predicate keys
+        fls = []
+        while offset < end:
+            _, fl_type, fl_key, _ = _FIELD_HEADER.unpack_from(buf, offset)
+            value_off = offset + _FIELD_HEADER_SZ
+            if fl_type == FL_TYPE_INT:
+                value_len = 4
+            else:
+                value_len = _BYTES_LEN.unpack_from(buf, value_off)[0]
+                value_off += 2
+            if fl_key in keys:
+                found[fl_key] = (fl_type, value_off, value_len)
+            if fields is None or fl_key in fields:
+                fls.append(offset)
+            offset = value_off + value_len
+        for key, numeric, op, value in self.predicates:
+            field = found.get(key)
+            if field is None or (field[0] == FL_TYPE_INT) != numeric:
+                return None
+            if not op(_INT.unpack_from(buf, field[1])[0] if numeric else buf[field[1]:field[1]+field[2]], value):
+                return None
+        return FieldList([Field.from_raw(fl_offset, buf)[1] for fl_offset in fls])
+
+    def apply_fls(self, fls):
+        """ Like apply for a decoded FieldList """
+        index = fls.index()
+        for key, numeric, op, value in self.predicates:
+            fl = index.get(key)
+            if fl is None or (fl.type in _NUMERIC_TYPES) != numeric or not op(fl.value, value):
+                return None
+        return FieldList([fl for fl in fls.fls if self.fields is None or fl.key in self.fields])
+
+
+class _Aggregate(object):
+    __slots__ = ['count', 'sum', 'min', 'max']
+
+    def __init__(self):
+        self.count = 0
+        self.sum = None
+        self.min = None
+        self.max = None
+
+    def add(self, fl):
+        self.count += 1
+        if fl is None:
+            return
+        value = fl.value
+        if fl.type in _NUMERIC_TYPES:
+            self.sum = value if self.sum is None else self.sum + value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.count += other.count
+        if other.sum is not None:
+            self.sum = other.sum if self.sum is None else self.sum + other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+
+def _aggregate_regions(table, ndxs, key, group_by, where):
+    # partial aggregation over the regions ndxs, table is a path when run in a worker process
+    if not isinstance(table, Table):
+        path, table = table, Table()
+        table.open(path, readonly=True)
+        try:
+            return _aggregate_regions(table, ndxs, key, group_by, where)
+        finally:
+            table.close()
+    fields = [k for k in (key, group_by) if k is not None]
+    groups = {}
+    for _, fls in table._scan(ndxs, _ScanFilter(fields, where)):
+        value_fl = group = None
+        for fl in fls.fls:
+            if fl.key == key:
+                value_fl = fl
+            if fl.key == group_by:
+                group = fl.value
+        if key is not None and value_fl is None:
+            continue
+        partial = groups.get(group)
+        if partial is None:
+            partial = groups[group] = _Aggregate()
+        partial.add(value_fl)
+    return groups
+
+
+_RegionCheck = collections.namedtuple('_RegionCheck', ['ndx', 'records', 'segments', 'links', 'free', 'leaked',
+                                                     'summary_ok', 'checksum'])
+
+
+def _verify_regions(table, ndxs):
+    # checks the regions ndxs, see Table.verify; table is a path when run in a worker process
+    if not isinstance(table, Table):
+        path, table = table, Table()
+        table.open(path, readonly=True)
+        try:
+            return _verify_regions(table, ndxs)
+        finally:
+            table.close()
+    checks = []
+    for ndx in ndxs:
+        region = table._region(ndx)
+        region_addr = ndx * _REGION_USABLE_SZ
+        records = segments = 0
+        links = []  # (rec_addr, magic, prev rec_addr, next rec_addr) of the chained segments
+        gap_offsets, gap_lengths = [], []
+        pos = 0
+        for offset, length, magic, next_ in region._scan_segments():
+            if offset > pos:
+                gap_offsets.append(pos)
+                gap_lengths.append(offset - pos)
+            pos = offset + length
+            segments += 1
+            if magic in _HEAD_MAGICS:
+                records += 1
+            if next_ or magic in _EXT_MAGICS:
+                chain_segment = _ChainSegment(region_addr + offset, region, region.offset + _REGION_HEADER_SZ + offset,
+                                              (magic, ))
+                prev_addr = None
+                if magic in _EXT_MAGICS:
+                    prev_addr = _REC_ADDR.unpack_from(region.mmap, chain_segment.offset + _FLS_EXT_PREV_OFF)[0]
+                links.append((chain_segment.rec_addr, magic, prev_addr, chain_segment.next_rec_addr()))
+        if pos < _REGION_USABLE_SZ:
+            gap_offsets.append(pos)
+            gap_lengths.append(_REGION_USABLE_SZ - pos)
+        free = region._free_map()
+        # FMEs have to lie within the gaps, gaps that are not (fully) covered are leaked space
+        fmes_ok = True
+        for offset, length in zip(free.offsets, free.lengths):
+            i = bisect.bisect_right(gap_offsets, offset) - 1
+            if i < 0 or offset + length > gap_offsets[i] + gap_lengths[i]:
+                fmes_ok = False
+                break
+        percent_full = region.mmap[_TABLE_REGION_SUMMARY_OFF + ndx % _TABLE_NUM_REGIONS]
+        checks.append(_RegionCheck(
+            ndx, records, segments, links, None if fmes_ok else (gap_offsets, gap_lengths),
+            sum(gap_lengths) - free.free_space() if fmes_ok else 0, percent_full == _percent_full(free.free_space()),
+            region.segment.region_checksum(ndx % _TABLE_NUM_REGIONS)))
+    return checks
+
+
+class _SortedList(object):
+    """
+    A sorted list kept as a list of bounded sublists so inserts and removes stay cheap with millions of items.
+    """
+    _LOAD = 512
+
+    def __init__(self):
+        self._lists = []
+        self._maxes = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def add(self, item):
+        self._len += 1
+        if not self._lists:
+            self._lists.append([item])
+            self._maxes.append(item)
+            return
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            i -= 1
+            self._lists[i].append(item)
+            self._maxes[i] = item
+        else:
+            bisect.insort(self._lists[i], item)
+        sublist = self._lists[i]
+        if len(sublist) > 2 * self._LOAD:
+            self._lists.insert(i + 1, sublist[self._LOAD:])
+            del sublist[self._LOAD:]
+            self._maxes.insert(i, sublist[-1])
+
+    def remove(self, item):
+        i = bisect.bisect_left(self._maxes, item)
+        sublist = self._lists[i]
+        j = bisect.bisect_left(sublist, item)
+        assert sublist[j] == item
+        del sublist[j]
+        self._len -= 1
+        if not sublist:
+            del self._lists[i]
+            del self._maxes[i]
+        elif j == len(sublist):
+            self._maxes[i] = sublist[-1]
+
+    def irange(self, lo=None, hi=None, inclusive_hi=True):
+        """ Yields the items in [lo, hi] (or [lo, hi) if not inclusive_hi) in order """
+        i = 0 if lo is None else bisect.bisect_left(self._maxes, lo)
+        for sublist in self._lists[i:]:
+            j = 0 if lo is None else bisect.bisect_left(sublist, lo)
+            lo = None
+            for item in sublist[j:]:
+                if hi is not None and (item > hi or (item == hi and not inclusive_hi)):
+                    return
+                yield item
+
+
+class _FreeSpaceIndex(object):
+    """
+    A max segment tree over the regions of a table, each leaf holding the size of the largest extent known to be
+    free in its region. Finding a region that can hold a record is O(log n).
+    """
+
+    def __init__(self, num_regions):
+        size = 1
+        while size < num_regions:
+            size *= 2
+        self.num_regions = num_regions
+        self._size = size
+        self._tree = [0] * (2 * size)
+
+    def grow(self, num_regions):
+        leaves = self._tree[self._size:self._size + self.num_regions]
+        self.__init__(num_regions)
+        self.set_many(0, leaves)
+
+    def set_many(self, start, values):
+        """ Sets the leaves of regions start, start + 1, ... and rebuilds the tree """
+        tree = self._tree
+        lo, hi = self._size + start, self._size + start + len(values)
+        tree[lo:hi] = values
+        while lo > 1:
+            # the parents of nodes [lo, hi), a level at a time
+            lo, hi = lo // 2, (hi + 1) // 2
+            tree[lo:hi] = map(max, tree[2*lo:2*hi:2], tree[2*lo+1:2*hi:2])
+
+    def get(self, ndx):
+        return self._tree[self._size + ndx]
+
+    def set(self, ndx, free_space):
+        tree = self._tree
+        i = self._size + ndx
+        tree[i] = free_space
+        i //= 2
+        while i >= 1:
+            max_free = max(tree[2*i], tree[2*i+1])
+            if tree[i] == max_free:
+                break
+            tree[i] = max_free
+            i //= 2
+
+    def find(self, space, start=0):
+        """ Returns the first region at or after start (wrapping around) with space free, or -1 """
+        if self._tree[1] < space:
+            return -1
+        ndx = self._find(1, 0, self._size, start, space)
+        if ndx < 0:
+            ndx = self._find(1, 0, self._size, 0, space)
+        return ndx
+
+    def _find(self, node, node_lo, node_hi, lo, space):
+        if node_hi <= lo or self._tree[node] < space:
+            return -1
+        if node_hi - node_lo == 1:
+            return node_lo
+        mid = (node_lo + node_hi) // 2
+        ndx = self._find(2*node, node_lo, mid, lo, space)
+        if ndx < 0:
+            ndx = self._find(2*node+1, mid, node_hi, lo, space)
+        return ndx
+
+
+class _OpStats(object):
+    """ The count, errors and latencies of an operation, in buckets of powers of two nanoseconds """
+    __slots__ = ['count', 'errors', 'total_ns', 'max_ns', 'buckets']
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * 64
+
+    def record(self, ns, failed=False):
+        self.count += 1
+        self.errors += failed
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.buckets[ns.bit_length()] += 1
+
+    def percentile(self, p):
+        # the middle of the bucket the percentile falls in, in microseconds
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(3 << i >> 2, self.max_ns) / 1000.0
+        return 0.0
+
+    def snapshot(self):
+        return {'count': self.count, 'errors': self.errors,
+                'mean_us': self.total_ns / self.count / 1000.0 if self.count else 0.0,
+                'p50_us': self.percentile(0.5), 'p99_us': self.percentile(0.99), 'p999_us': self.percentile(0.999),
+                'max_us': self.max_ns / 1000.0}
+
+
+class _FreeMap(object):
+    """
+    The in-memory copy of a region's valid FMEs, kept as parallel arrays of offsets and lengths sorted by offset.
+    Each operation returns the range of FME slots it changed so only those need to be written back.
+    """
+    __slots__ = ['offsets', 'lengths']
+
+    def __init__(self, offsets, lengths):
+        self.offsets = array.array('H', offsets)
+        self.lengths = array.array('H', lengths)
+
+    @staticmethod
+    def load(buf, offset):
+        # decodes the FMEs of the initialized region at offset in buf
+        raw_fmes = struct.unpack_from(">%dH" % (2*_REGION_NUM_FMES), buf, offset)
+        n = raw_fmes[1::2].index(0) if 0 in raw_fmes[1::2] else _REGION_NUM_FMES
+        return _FreeMap(raw_fmes[0:2*n:2], raw_fmes[1:2*n:2])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def free_space(self):
+        return sum(self.lengths)
+
+    def max_extent(self):
+        return max(self.lengths) if self.lengths else 0
+
+    def alloc(self, space):
+        """ First-fit allocation, returns (offset, first changed slot, end of changed slots) or None """
+        lengths = self.lengths
+        for i in range(len(lengths)):
+            if lengths[i] < space: continue
+            offset = self.offsets[i]
+            if lengths[i] == space:
+                n = len(lengths)
+                del self.offsets[i]
+                del self.lengths[i]
+                return offset, i, n
+            self.offsets[i] += space
+            lengths[i] -= space
+            return offset, i, i + 1
+        return None
+
+    def free(self, offset, length):
+        """ Adds the extent, merging it with its neighbours, returns the (first, end) of the changed slots """
+        offsets, lengths = self.offsets, self.lengths
+        n = len(offsets)
+        upper = offset + length
+        i = bisect.bisect_left(offsets, offset)
+        if (i > 0 and offsets[i-1] + lengths[i-1] > offset) or (i < n and offsets[i] < upper):
+            # this should never happen (overlapping existing FME with new FME)
+            raise Exception('cannot free up space within an FME')
+        merge_lower = i > 0 and offsets[i-1] + lengths[i-1] == offset
+        merge_upper = i < n and offsets[i] == upper
+        if merge_lower and merge_upper:
+            lengths[i-1] += length + lengths[i]
+            del offsets[i]
+            del lengths[i]
+            return i - 1, n
+        elif merge_lower:
+            lengths[i-1] += length
+            return i - 1, i
+        elif merge_upper:
+            offsets[i] = offset
+            lengths[i] += length
+            return i, i + 1
+        elif n == _REGION_NUM_FMES:
+            # Region.compact reclaims the space; this can happen on every free into a full region, so only at debug
+            _logger.debug('no free FME slots, leaking %d bytes at %d', length, offset)
+            return i, i
+        offsets.insert(i, offset)
+        lengths.insert(i, length)
+        return i, n + 1
 
 
 class Region(object):
@@ -155,6 +2580,9 @@ class Region(object):
     #
     # 3) Full FMEs are sorted in order of increasing offset.
     #
+    # The FMEs are decoded once into a _FreeMap that is updated in place, only the FME slots that changed are
+    # written back to the mmap.
+    #
 
     class FME():
         def __init__(self, o, l):
@@ -163,61 +2591,153 @@ class Region(object):
 
     def __init__(self, table, ndx):
         self.table = table
-        self.offset = _TABLE_HEADER_SZ + ndx*_REGION_SZ
+        segment = table._segments[ndx // _TABLE_NUM_REGIONS]
+        self.segment = segment
+        self.mmap = segment.mmap
+        self.offset = _TABLE_HEADER_SZ + (ndx % _TABLE_NUM_REGIONS)*_REGION_SZ
         self.ndx = ndx
-
-    def create(self):
-        fme = self.FME(0, _REGION_USABLE_SZ)
-        self.table._mmap[self.offset:self.offset+4] = struct.pack(">HH", fme.offset, fme.length)
-        # relies on rest of FME array already being zero'd which fills each fme.length with zero
-        # which is the sentinel meaning end-of-valid-fmes.
+        self._free = None
+        self._pending_fmes = None  # (lo, hi) of FME slots changed while stores are deferred
+        self.leaked = 0  # bytes freed while the FMEs were full, reclaimed by compact
+        # until a region is initialized its FMEs are all zero and it is treated as one free extent
+        self.initialized = segment.region_initialized(ndx % _TABLE_NUM_REGIONS)
+        if self.initialized and segment.region_bit(_TABLE_REGION_LEAK_OFF, ndx % _TABLE_NUM_REGIONS):
+            # only that the region leaks is stored: the leak is the space neither the FMEs nor the segments cover
+            self.leaked = (_REGION_USABLE_SZ - self._free_map().free_space() -
+                           sum(length for _, length, _ in self._segments()))
 
     def _load_fmes(self):
-        raw_fmes = struct.unpack(">" + "HH"*_REGION_NUM_FMES, self.table._mmap[self.offset:self.offset+_REGION_HEADER_SZ])
+        if not self.initialized:
+            return [self.FME(0, _REGION_USABLE_SZ)] + [self.FME(0, 0) for _ in range(_REGION_NUM_FMES - 1)]
+        raw_fmes = struct.unpack(">" + "HH"*_REGION_NUM_FMES, self.mmap[self.offset:self.offset+_REGION_HEADER_SZ])
         assert len(raw_fmes) == 2 * _REGION_NUM_FMES
         fmes = [self.FME(raw_fmes[2*i], raw_fmes[2*i+1]) for i in range(_REGION_NUM_FMES)]
-        _logger.debug('loaded FMEs %s' % ', '.join('(%d,%d)' % (f.offset, f.length) for f in fmes if f.length > 0))
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug('loaded FMEs %s', ', '.join('(%d,%d)' % (f.offset, f.length) for f in fmes if f.length > 0))
         return fmes
 
-    def _store_fmes(self, fmes):
-        assert len(fmes) == _REGION_NUM_FMES
-        raw_fmes = [struct.pack(">HH", fme.offset, fme.length) for fme in fmes]
-        self.table._mmap[self.offset:self.offset+_REGION_HEADER_SZ] = b"".join(raw_fmes)
+    def _free_map(self):
+        if self._free is None and not self.initialized:
+            self._free = _FreeMap([0], [_REGION_USABLE_SZ])
+        elif self._free is None:
+            self._free = _FreeMap.load(self.mmap, self.offset)
+        return self._free
+
+    def _store_fmes(self, lo, hi):
+        # writes FME slots [lo, hi), slots past the valid FMEs are written as the (0, 0) sentinel
+        free = self._free
+        n = len(free)
+        if not self.initialized:
+            # the rest of the slots are already the zero sentinel
+            lo, hi = 0, max(hi, min(n + 1, _REGION_NUM_FMES))
+            self.segment.set_region_initialized(self.ndx % _TABLE_NUM_REGIONS)
+            self.initialized = True
+        if hi > lo:
+            raw = []
+            for i in range(lo, hi):
+                if i < n:
+                    raw.append(free.offsets[i])
+                    raw.append(free.lengths[i])
+                else:
+                    raw.append(0)
+                    raw.append(0)
+            self.segment.write(self.offset + lo*_REGION_FME_SZ, struct.pack(">%dH" % len(raw), *raw))
+        if _DEBUG:
+            fmes = self._load_fmes()
+            for i in range(_REGION_NUM_FMES):
+                if i < n:
+                    assert fmes[i].offset == free.offsets[i] and fmes[i].length == free.lengths[i]
+                else:
+                    assert fmes[i].length == 0
+        self._update_summary()
+
+    def _fmes_changed(self, lo, hi):
+        if self._pending_fmes is None:
+            self._store_fmes(lo, hi)
+        else:
+            # slots only shift towards the end of the valid FMEs so the union of the changed ranges covers them
+            pending_lo, pending_hi = self._pending_fmes
+            self._pending_fmes = (min(pending_lo, lo), max(pending_hi, hi))
+
+    def _defer_fmes(self):
+        self._pending_fmes = (_REGION_NUM_FMES, 0)
+
+    def _flush_fmes(self):
+        lo, hi = self._pending_fmes
+        self._pending_fmes = None
+        if hi > lo:
+            self._store_fmes(lo, hi)
+
+    def _update_summary(self):
+        free = self._free_map()
+        self.table._update_region_summary(self.ndx, free.free_space(), free.max_extent())
 
-        temp_fmes = self._load_fmes()
-        for i in range(len(temp_fmes)):
-            assert fmes[i].length == temp_fmes[i].length
+    def alloc(self, space):
+        """ Allocates space bytes, returns their rec_addr or None if no free extent is large enough """
+        allocated = self._free_map().alloc(space)
+        if allocated is None:
+            self._update_summary()
+            return None
+        offset, lo, hi = allocated
+        self._fmes_changed(lo, hi)
+        self._allocated(offset, space)
+        return offset + self.ndx*_REGION_USABLE_SZ
+
+    def _allocated(self, offset, space):
+        # writes to the new space need no undo entry, see _WriteAheadLog
+        if self.segment.wal is not None:
+            start = self.offset + _REGION_HEADER_SZ + offset
+            self.segment.fresh[start] = start + space
 
     def insert(self, fls, space):
-        fmes = self._load_fmes()
-        # assert fmes[1].offset == 0
-        # assert fmes[1].length == 0
-        for i in range(_REGION_NUM_FMES):
-            if fmes[i].length == 0: break   # length == 0 means we're at end of valid fmes
-            if fmes[i].length < space: continue
-            _logger.debug('inserting %d bytes at %d' % (space, fmes[i].offset))
-            rec_addr = fmes[i].offset + self.ndx*_REGION_USABLE_SZ
-            if fmes[i].length == space:
-                assert False
-                del fmes[i]
-                empty_fme = self.FME(0, 0)
-                fmes.append(empty_fme)
-            else:
-                fmes[i].offset += space
-                fmes[i].length -= space
-            # assert fmes[i+1].offset == 0
-            # assert fmes[i+1].length == 0
-            self._store_fmes(fmes)
-            rec_offset = rec_addr + (self.ndx + 1) * _REGION_HEADER_SZ + _TABLE_HEADER_SZ
-            fls.store(rec_offset, self.table._mmap)
-            return rec_addr
-        raise NoSpace()
+        raw = fls.as_raw()  # before allocating, a record that cannot be encoded must not leak the space
+        rec_addr = self.alloc(space)
+        if rec_addr is None:
+            raise NoSpace()
+        rec_off_in_region = rec_addr % _REGION_USABLE_SZ
+        _logger.debug('inserting %d bytes at %d', space, rec_off_in_region)
+        self.segment.write(self.offset + _REGION_HEADER_SZ + rec_off_in_region, raw)
+        return rec_addr
+
+    def insert_many(self, raws, start):
+        """
+        Inserts raw FieldLists from raws[start:] into the largest free extents, as many consecutive records per
+        extent as fit, until the next record does not fit. Returns the rec_addrs of the records inserted.
+        """
+        free = self._free_map()
+        rec_addrs = []
+        self._defer_fmes()
+        try:
+            i = start
+            while i < len(raws):
+                max_extent = free.max_extent()
+                space, end = 0, i
+                while end < len(raws) and space + len(raws[end]) <= max_extent:
+                    space += len(raws[end])
+                    end += 1
+                if end == i:
+                    break
+                offset, lo, hi = free.alloc(space)
+                self._fmes_changed(lo, hi)
+                self._allocated(offset, space)
+                _logger.debug('inserting %d records in %d bytes at %d', end - i, space, offset)
+                mm_offset = self.offset + _REGION_HEADER_SZ + offset
+                self.segment.write(mm_offset, b"".join(raws[i:end]))
+                for raw in raws[i:end]:
+                    rec_addrs.append(offset + self.ndx*_REGION_USABLE_SZ)
+                    offset += len(raw)
+                i = end
+        finally:
+            self._flush_fmes()
+        if not rec_addrs:
+            self._update_summary()
+        return rec_addrs
 
     def update(self, rec_addr, fls, new_length, old_length):
         rec_off_in_region = rec_addr % _REGION_USABLE_SZ
         offset = self.offset + _REGION_HEADER_SZ + rec_off_in_region
-        _logger.debug('updating record at %d' % (rec_off_in_region))
-        fls.store(offset, self.table._mmap)
+        _logger.debug('updating record at %d', rec_off_in_region)
+        self.segment.write(offset, fls.as_raw())
         if old_length > new_length:
             self._free_up_space(rec_off_in_region + new_length, old_length - new_length)
         return rec_addr
@@ -225,79 +2745,184 @@ class Region(object):
     def delete(self, rec_addr):
         rec_off_in_region = rec_addr % _REGION_USABLE_SZ
         offset = self.offset + _REGION_HEADER_SZ + rec_off_in_region
-        rec_len = FieldList.delete(offset, self.table._mmap)
-        _logger.debug('deleting %d bytes at %d' % (rec_len, rec_off_in_region))
+        rec_magic, rec_len, _ = _FLS_HEADER.unpack_from(self.mmap, offset)
+        assert rec_magic in _HEAD_MAGICS
+        self.segment.write(offset, _FLS_HEADER.pack(rec_magic, 0, 0))
+        _logger.debug('deleting %d bytes at %d', rec_len, rec_off_in_region)
         self._free_up_space(rec_off_in_region, rec_len)
 
     def read(self, rec_addr):
         rec_off_in_region = rec_addr % _REGION_USABLE_SZ
         offset = self.offset + _REGION_HEADER_SZ + rec_off_in_region
-        fls = FieldList.load(offset, self.table._mmap)
+        fls = FieldList.load(offset, self.mmap)
         return fls
 
+    def read_raw(self, rec_addr):
+        rec_off_in_region = rec_addr % _REGION_USABLE_SZ
+        offset = self.offset + _REGION_HEADER_SZ + rec_off_in_region
+        rec_magic, rec_len, _ = _FLS_HEADER.unpack_from(self.mmap, offset)
+        assert rec_magic in _HEAD_MAGICS
+        if rec_len == 0:
+            raise RecordDeleted()
+        return self.mmap[offset:offset+rec_len]
+
+    def view(self, rec_addr):
+        rec_off_in_region = rec_addr % _REGION_USABLE_SZ
+        return RecordView(self.segment.view, self.offset + _REGION_HEADER_SZ + rec_off_in_region)
+
+    def walk(self):
+        """ Yields (rec_addr, offset in mmap) for the records in the used extents, i.e. the gaps between FMEs """
+        base = self.offset + _REGION_HEADER_SZ
+        for pos, _, rec_magic in self._segments():
+            # extension segments are part of a chained record, which is yielded at its head
+            if rec_magic in _HEAD_MAGICS:
+                yield self.ndx*_REGION_USABLE_SZ + pos, base + pos
+
+    def _segments(self):
+        # yields (offset in region, length, magic) of the record heads and extension segments in the used extents
+        free = self._free_map()
+        # copied so the region can be modified between yields
+        offsets, lengths = free.offsets[:], free.lengths[:]
+        mm = self.mmap
+        base = self.offset + _REGION_HEADER_SZ
+        num_fmes = len(offsets)
+        pos = 0
+        for i in range(num_fmes + 1):
+            end = offsets[i] if i < num_fmes else _REGION_USABLE_SZ
+            while pos + _FLS_HEADER_SZ <= end:
+                rec_magic, rec_len, _ = _FLS_HEADER.unpack_from(mm, base + pos)
+                if rec_magic in _HEAD_MAGICS and _FLS_HEADER_SZ <= rec_len <= end - pos:
+                    yield pos, rec_len, rec_magic
+                    pos += rec_len
+                elif rec_magic in _EXT_MAGICS and _FLS_EXT_HEADER_SZ <= rec_len <= end - pos:
+                    yield pos, rec_len, rec_magic
+                    pos += rec_len
+                else:
+                    # a deleted record or space leaked when the FMEs were full, skip to the next valid segment
+                    pos = self._resync(pos + 1, end)
+            if i < num_fmes:
+                pos = offsets[i] + lengths[i]
+
+    def _resync(self, pos, end):
+        mm = self.mmap
+        base = self.offset + _REGION_HEADER_SZ
+        while True:
+            # the head and extension magics of both formats only differ in their last byte
+            found = mm.find(_FLS_MAGIC_RAW[:3], base + pos, base + end)
+            if found < 0 or found + _FLS_HEADER_SZ > base + end:
+                return end
+            pos = found - base
+            rec_magic, rec_len, next_ = _FLS_HEADER.unpack_from(mm, found)
+            header_sz = _FLS_HEADER_SZ if rec_magic in _HEAD_MAGICS else _FLS_EXT_HEADER_SZ
+            fields_end = found + rec_len - (_FLS_NEXT_SZ if next_ == _FLS_NEXT_FAR else 0)
+            if (rec_magic in _SEGMENT_MAGICS and header_sz <= rec_len <= end - pos and
+                    _fields_fit(mm, found + header_sz, fields_end, next_ == _FLS_NEXT_FAR, _is_compact(rec_magic))):
+                return pos
+            pos += 1
+
+    def _scan_segments(self):
+        # yields (offset in region, length, magic, next) of the well formed segments found by their magics, without
+        # looking at the FMEs
+        mm = self.mmap
+        base = self.offset + _REGION_HEADER_SZ
+        pos = 0
+        while pos + _FLS_HEADER_SZ <= _REGION_USABLE_SZ:
+            rec_magic, rec_len, next_ = _FLS_HEADER.unpack_from(mm, base + pos)
+            header_sz = _FLS_HEADER_SZ if rec_magic in _HEAD_MAGICS else _FLS_EXT_HEADER_SZ
+            fields_end = base + pos + rec_len - (_FLS_NEXT_SZ if next_ == _FLS_NEXT_FAR else 0)
+            if (rec_magic in _SEGMENT_MAGICS and header_sz <= rec_len <= _REGION_USABLE_SZ - pos and
+                    _fields_fit(mm, base + pos + header_sz, fields_end, next_ == _FLS_NEXT_FAR,
+                                _is_compact(rec_magic))):
+                yield pos, rec_len, rec_magic, next_
+                pos += rec_len
+            else:
+                pos = self._resync(pos + 1, _REGION_USABLE_SZ)
+
+    def compact(self):
+        """
+        Slides the live segments together at the start of the region so all its free space, including space leaked
+        when the FMEs were full, becomes one extent. Pointers between segments of the region are adjusted, returns
+        {old offset: new offset} of the segments that moved for the table to fix everything else.
+        """
+        segments = list(self._segments())
+        mm = self.mmap
+        base = self.offset + _REGION_HEADER_SZ
+        new_offsets = {}
+        pos = 0
+        for offset, length, _ in segments:
+            if offset != pos:
+                # segments only move down and in order, so nothing is overwritten before it is moved
+                self.segment.write(base + pos, mm[base + offset:base + offset + length])
+            new_offsets[offset] = pos
+            pos += length
+        region_addr = self.ndx*_REGION_USABLE_SZ
+        for offset, length, rec_magic in segments:
+            at = base + new_offsets[offset]
+            next_ = _FLS_HEADER.unpack_from(mm, at)[2]
+            if next_ == _FLS_NEXT_FAR:
+                trailer = at + length - _FLS_NEXT_SZ
+                next_addr = _REC_ADDR.unpack_from(mm, trailer)[0]
+                if next_addr // _REGION_USABLE_SZ == self.ndx:
+                    new_addr = region_addr + new_offsets[next_addr % _REGION_USABLE_SZ]
+                    self.segment.write(trailer, _REC_ADDR.pack(new_addr))
+            elif next_:
+                self.segment.write(at + _FLS_NEXT_OFF, _NEXT.pack(new_offsets[next_ - 1] + 1))
+            if rec_magic in _EXT_MAGICS:
+                prev_addr = _REC_ADDR.unpack_from(mm, at + _FLS_EXT_PREV_OFF)[0]
+                if prev_addr // _REGION_USABLE_SZ == self.ndx:
+                    self.segment.write(at + _FLS_EXT_PREV_OFF,
+                                       _REC_ADDR.pack(region_addr + new_offsets[prev_addr % _REGION_USABLE_SZ]))
+        for offset, _, _ in segments:
+            if offset >= pos:
+                # the old copy is in the free space now, it must not be taken for a segment by verify
+                self.segment.write(base + offset + _FLS_LEN_OFF, struct.pack(">HH", 0, 0))
+        if pos < _REGION_USABLE_SZ:
+            self._free = _FreeMap([pos], [_REGION_USABLE_SZ - pos])
+        else:
+            self._free = _FreeMap([], [])
+        self.leaked = 0
+        self._fmes_changed(0, _REGION_NUM_FMES)
+        _logger.debug('compacted region %d, %d bytes free', self.ndx, _REGION_USABLE_SZ - pos)
+        return dict((offset, new) for offset, new in new_offsets.items() if offset != new)
+
+    def waste(self):
+        """ Free space that is unusable for a record the size of the largest free extent """
+        free = self._free_map()
+        return free.free_space() - free.max_extent() + self.leaked
+
     def _free_up_space(self, offset, length):  # offset in region
-        _logger.debug('freeing up %d bytes at %d' % (length, offset))
-        fmes = self._load_fmes()
-        len_fmes = len(fmes)
-        new_lower, new_upper = offset, offset + length
-        for i in range(len_fmes):
-            fme = fmes[i]
-            assert fme.length != 0
-            fme_lower, fme_upper = fme.offset, fme.offset + fme.length
-            if fme_upper < new_lower:
-                # this fme is too low, continue
-                continue
-            elif fme_upper == new_lower:
-                # then extend this fme upward
-                fme.length += length
-                if len_fmes > (i+1):
-                    next_fme = fmes[i+2]
-                    if next_fme.offset == (fme.offset + fme.length):
-                        # then merge with the next one
-                        fme.length += next_fme.length
-                        del fmes[i+1]
-                        fmes.append(self.FME(0, 0))
-                break
-            # now fme_upper > new_lower
-            elif fme_lower < new_upper:
-                # this should never happen (overlapping existing FME with new FME)
-                raise Exception('cannot free up space within an FME')
-            elif fme_lower == new_upper:
-                # then extend this fme downward
-                fme.offset -= length
-                # previous if statement is guaranteed to handle the case where this would touch another fme, so break
-                break
-            else:  # fme_lower > new_upper:
-                # create a new fme here
-                assert fmes[-1].length == 0  # TODO clean up fmes if they get too fragmented
-                fmes.insert(i, self.FME(offset, length))
-                del fmes[-1:]
-                break
-        _logger.debug('new FMEs %s' % ', '.join('(%d,%d)' % (f.offset, f.length) for f in fmes if f.length > 0))
-        self._store_fmes(fmes)
+        _logger.debug('freeing up %d bytes at %d', length, offset)
+        lo, hi = self._free_map().free(offset, length)
+        if lo == hi:
+            if not self.leaked:
+                self.segment.set_region_bit(_TABLE_REGION_LEAK_OFF, self.ndx % _TABLE_NUM_REGIONS, True)
+            self.leaked += length
+        self._fmes_changed(lo, hi)
+        self.table._set_fragmented(self.ndx)
 
 
 class FieldList(object):
-    def __init__(self, fls):
+    def __init__(self, fls, compact=False):
         self.fls = fls
+        self.compact = compact  # encoded in the compact record format, see RECORD_FORMAT_COMPACT
 
     @staticmethod
     def set(fls):
         assert len(fls) > 0
         fls = list(fls)
         fls.sort(key=lambda x: x.key)
-        ts = _get_time()
+        ts = _get_ts()
         for fl in fls:
             fl.ts = ts
         return FieldList(fls)
 
     def update(self, new_field_list):
         new_fls = new_field_list.fls
-        if not new_fls: return 0
         existing_length = self.length()
+        if not new_fls: return existing_length, existing_length
         new_fls.sort(key=lambda x: x.key)
         index = self.index()
-        ts = _get_time()
+        ts = _get_ts()
         for new_fl in new_fls:
             new_fl.ts = ts
             fl = index.get(new_fl.key)
@@ -305,95 +2930,380 @@ class FieldList(object):
                 self.fls.append(new_fl)
             else:
                 fl.update(new_fl)
+        self.fls.sort(key=lambda x: x.key)
         return self.length(), existing_length
 
+    def merge(self, other):
+        """
+        Merges the fields of other into this FieldList: for each key the field with the newer ts is kept, ties going
+        to the larger (type, value) so replicas converge whatever order they merge in. The timestamps of other are
+        kept, so every field of other needs one (ValueError otherwise). This FieldList is in key order (as set and load
+        leave it) and other is sorted, keeping the newer of fields with the same key, so the merge is a single
+        merge-join pass. Returns (new length, old length, the fields of other that were taken).
+        """
+        existing_length = self.length()
+        fls, new_fls = self.fls, []
+        for new_fl in sorted(other.fls, key=lambda x: x.key):
+            if new_fl.ts is None:
+                raise ValueError('field %d has no ts to merge by' % new_fl.key)
+            if new_fls and new_fls[-1].key == new_fl.key:
+                if _field_newer(new_fl, new_fls[-1]):
+                    new_fls[-1] = new_fl
+            else:
+                new_fls.append(new_fl)
+        merged = []
+        taken = []
+        i = j = 0
+        while i < len(fls) and j < len(new_fls):
+            fl, new_fl = fls[i], new_fls[j]
+            if fl.key < new_fl.key:
+                merged.append(fl)
+                i += 1
+            elif new_fl.key < fl.key:
+                merged.append(new_fl)
+                taken.append(new_fl)
+                j += 1
+            else:
+                if _field_newer(new_fl, fl):
+                    merged.append(new_fl)
+                    taken.append(new_fl)
+                else:
+                    merged.append(fl)
+                i += 1
+                j += 1
+        merged.extend(fls[i:])
+        merged.extend(new_fls[j:])
+        taken.extend(new_fls[j:])
+        self.fls = merged
+        return self.length(), existing_length, taken
+
     def index(self):
         index = {}
         for fl in self.fls:
             index[fl.key] = fl
         return index
 
+    def base(self):
+        # the base timestamp of the compact encoding, None for the fixed one
+        if not self.compact:
+            return None
+        return min((fl.ts for fl in self.fls), default=0)
+
     def length(self):
-        return _FLS_HEADER_SZ + sum(fl.length() for fl in self.fls)
+        if not self.compact:
+            return _FLS_HEADER_SZ + sum(fl.length() for fl in self.fls)
+        base = self.base()
+        return _FLS_HEADER_SZ + _varint_len(base) + sum(fl.length(base) for fl in self.fls)
 
-    def store(self, offset, mmap_):
-        raw_fls = b"".join(fl.as_raw() for fl in self.fls)
-        raw_header = struct.pack(">IHH", _FLS_MAGIC, len(raw_fls) + _FLS_HEADER_SZ, 0)
+    def as_raw(self):
+        base = self.base()
+        if base is None:
+            raw_fls = b"".join(fl.as_raw() for fl in self.fls)
+        else:
+            raw_fls = _varint(base) + b"".join(fl.as_raw(base) for fl in self.fls)
+        magic = _FLS_COMPACT_MAGIC if self.compact else _FLS_MAGIC
+        raw_header = struct.pack(">IHH", magic, len(raw_fls) + _FLS_HEADER_SZ, 0)
         assert len(raw_header) == _FLS_HEADER_SZ
         raw = raw_header + raw_fls
-        assert self.length() == len(raw)
+        assert base is not None or self.length() == len(raw)
+        return raw
+
+    def as_raw_chunks(self):
+        """
+        Encodes the FieldList as one or more FieldLists that each fit the 16 bit length, all but the last with
+        _FLS_NEXT_MORE in their next slot. This is how records travel on the wire.
+        """
+        if self.length() <= _MAX_BYTES_LEN:
+            return [self.as_raw()]
+        chunks = _pack_fields(self.fls, _MAX_BYTES_LEN - _FLS_HEADER_SZ, _MAX_BYTES_LEN - _FLS_HEADER_SZ, self.base())
+        magic = _FLS_COMPACT_MAGIC if self.compact else _FLS_MAGIC
+        raws = []
+        for i, chunk in enumerate(chunks):
+            raw_fls = b"".join(chunk)
+            next_ = _FLS_NEXT_MORE if i < len(chunks) - 1 else 0
+            raws.append(_FLS_HEADER.pack(magic, len(raw_fls) + _FLS_HEADER_SZ, next_) + raw_fls)
+        return raws
+
+    @staticmethod
+    def load_chunks(offset, buf):
+        """ Decodes a record sent as as_raw_chunks, returns (FieldList, offset after it) """
+        fls = []
+        compact = None
+        while True:
+            rec_len, next_ = _FLS_HEADER.unpack_from(buf, offset)[1:]
+            if rec_len < _FLS_HEADER_SZ or offset + rec_len > len(buf):
+                raise ValueError('bad FieldList')
+            chunk = FieldList.load(offset, buf)
+            if compact is None:
+                compact = chunk.compact
+            fls.extend(chunk.fls)
+            offset += rec_len
+            if next_ != _FLS_NEXT_MORE:
+                break
+        return FieldList(_merge_fields(fls), compact), offset
+
+    def store(self, offset, mmap_):
+        raw = self.as_raw()
         mmap_[offset:offset+len(raw)] = raw
 
     @staticmethod
-    def load(offset, mmap_):
+    def load(offset, mmap_, zero_copy=False):
+        # an unchained FieldList, chained records are loaded with Table._load
         fls = []
-        rec_magic, rec_len, _ = struct.unpack(">IHH", mmap_[offset:offset+8])
-        assert rec_magic == _FLS_MAGIC
+        rec_magic, rec_len, _ = _FLS_HEADER.unpack_from(mmap_, offset)
+        assert rec_magic in _HEAD_MAGICS
         if rec_len == 0:
             raise RecordDeleted()
-        offset += 8
-        rec_len -= 8
-        while rec_len > 0:
-            fl_len, fl = Field.from_raw(offset, mmap_)
-            rec_len -= fl_len
+        end = offset + rec_len
+        offset += _FLS_HEADER_SZ
+        base = None
+        if rec_magic == _FLS_COMPACT_MAGIC:
+            base, offset = _read_varint(mmap_, offset)
+        while offset < end:
+            fl_len, fl = Field.from_raw(offset, mmap_, zero_copy, base)
             offset += fl_len
             fls.append(fl)
-        assert rec_len == 0
-        return FieldList(fls)
+        assert offset == end
+        return FieldList(fls, base is not None)
 
-    @staticmethod
-    def delete(offset, mmap_):
-        rec_magic, rec_len, _ = struct.unpack(">IHH", mmap_[offset:offset+8])
-        assert rec_magic == _FLS_MAGIC
-        raw = struct.pack(">IHH", _FLS_MAGIC, 0, 0)
-        mmap_[offset:offset+len(raw)] = raw
-        return rec_len
+
+class RecordView(object):
+    """
+    A read-only view of a stored FieldList that decodes fields lazily, straight out of the table's mmap.
+
+    Field headers are only walked as far as needed to find the requested key. With zero_copy BYTES values are
+    returned as memoryview slices of the mmap; they must be released before the table is closed and are only
+    valid until the record is next updated or deleted.
+    """
+    __slots__ = ['_buf', '_offset', '_end', '_scanned', '_fields', '_base']
+
+    def __init__(self, buf, offset):
+        rec_magic, rec_len, _ = _FLS_HEADER.unpack_from(buf, offset)
+        assert rec_magic in _HEAD_MAGICS
+        if rec_len == 0:
+            raise RecordDeleted()
+        self._buf = buf
+        self._offset = offset
+        self._end = offset + rec_len
+        self._scanned = offset + _FLS_HEADER_SZ  # fields before this offset are in self._fields
+        self._fields = {}  # key -> offset of field header
+        self._base = None  # of a compact record
+        if rec_magic == _FLS_COMPACT_MAGIC:
+            self._base, self._scanned = _read_varint(buf, self._scanned)
+
+    def _find(self, key):
+        off = self._fields.get(key)
+        if off is not None or self._scanned >= self._end:
+            return off
+        buf, end, fields = self._buf, self._end, self._fields
+        compact = self._base is not None
+        off = self._scanned
+        while off < end:
+            if compact:
+                _, fl_key, next_off = _skip_compact_field(buf, off)
+            else:
+                fl_magic, fl_type, fl_key, _ = _FIELD_HEADER.unpack_from(buf, off)
+                assert fl_magic == _FIELD_MAGIC
+                next_off = off + _FIELD_HEADER_SZ
+                if fl_type == FL_TYPE_INT:
+                    next_off += 4
+                else:
+                    next_off += 2 + _BYTES_LEN.unpack_from(buf, next_off)[0]
+            fields[fl_key] = off
+            if fl_key == key:
+                self._scanned = next_off
+                return off
+            off = next_off
+        self._scanned = end
+        return None
+
+    def keys(self):
+        self._find(None)
+        return sorted(self._fields)
+
+    def get(self, key, zero_copy=False):
+        """ Returns the Field with key, or None """
+        off = self._find(key)
+        if off is None:
+            return None
+        return Field.from_raw(off, self._buf, zero_copy, self._base)[1]
+
+    def value(self, key, default=None, zero_copy=False):
+        fl = self.get(key, zero_copy)
+        return default if fl is None else fl.value
+
+    def ts(self, key):
+        off = self._find(key)
+        if off is None:
+            return None
+        if self._base is not None:
+            return self._base + _read_varint(self._buf, _read_varint(self._buf, off + 1)[1])[0]
+        return _FIELD_HEADER.unpack_from(self._buf, off)[3]
+
+    def field_list(self):
+        return FieldList.load(self._offset, self._buf)
+
+
+class _ChainedRecordView(object):
+    """ The RecordView API over a chained record, which is decoded up front """
+    __slots__ = ['_fls', '_fields']
+
+    def __init__(self, fls):
+        self._fls = fls
+        self._fields = fls.index()
+
+    def keys(self):
+        return sorted(self._fields)
+
+    def get(self, key, zero_copy=False):
+        return self._fields.get(key)
+
+    def value(self, key, default=None, zero_copy=False):
+        fl = self._fields.get(key)
+        return default if fl is None else fl.value
+
+    def ts(self, key):
+        fl = self._fields.get(key)
+        return None if fl is None else fl.ts
+
+    def field_list(self):
+        return self._fls
+
+
+class _ChainSegment(object):
+    """ One stored segment of a record: where it is, its length and how far its fields extend """
+    __slots__ = ['rec_addr', 'region', 'offset', 'length', 'next', 'fields_offset', 'fields_end', 'compact', 'base']
+
+    def __init__(self, rec_addr, region, offset, magics):
+        # magics are the magics the segment may have, _HEAD_MAGICS or _EXT_MAGICS
+        rec_magic, rec_len, next_ = _FLS_HEADER.unpack_from(region.mmap, offset)
+        assert rec_magic in magics
+        if rec_len == 0:
+            raise RecordDeleted()
+        self.rec_addr = rec_addr
+        self.region = region
+        self.offset = offset
+        self.length = rec_len
+        self.next = next_
+        self.fields_offset = offset + (_FLS_HEADER_SZ if rec_magic in _HEAD_MAGICS else _FLS_EXT_HEADER_SZ)
+        self.fields_end = offset + rec_len - (_FLS_NEXT_SZ if next_ == _FLS_NEXT_FAR else 0)
+        self.compact = _is_compact(rec_magic)
+        self.base = None  # of a compact segment, which has none if it has no fields
+        if self.compact and self.fields_offset < self.fields_end:
+            self.base, self.fields_offset = _read_varint(region.mmap, self.fields_offset)
+
+    def next_rec_addr(self):
+        if self.next == 0:
+            return None
+        if self.next == _FLS_NEXT_FAR:
+            return _REC_ADDR.unpack_from(self.region.mmap, self.fields_end)[0]
+        return self.rec_addr - self.rec_addr % _REGION_USABLE_SZ + self.next - 1
+
+    def fields(self):
+        # the fields may be followed by zero padding
+        fls = []
+        offset = self.fields_offset
+        mm = self.region.mmap
+        base = self.base
+        while offset < self.fields_end and (mm[offset] == _FIELD_MAGIC if base is None else
+                                            mm[offset] & _FIELD_TAG_MASK == _FIELD_TAG):
+            fl_len, fl = Field.from_raw(offset, mm, base=base)
+            fls.append(fl)
+            offset += fl_len
+        return fls
 
 
 class Field(object):
-    __slots__ = ['type', 'key', 'value', 'ts']
+    __slots__ = ['type', 'key', 'value', 'ts', '_packed']
 
     def __init__(self, type_, key, value, ts=None):
         self.type = type_
         self.key = key
         self.value = value
         self.ts = ts
+        self._packed = None  # (value, flags, stored value) of a BYTES value in compact records, see _compact_value
 
-    def length(self):
+    def length(self, base=None):
+        # the encoded length, in the compact format with timestamps relative to base unless base is None
+        if base is not None:
+            return (1 + _varint_len(self.key) + _varint_len(self.ts - base) +
+                    self._compact_value_len())
         length = _FIELD_HEADER_SZ
         if self.type == FL_TYPE_INT:
             length += 4
-        elif self.type == FL_TYPE_BYTES:
+        elif self.type in (FL_TYPE_BYTES, FL_TYPE_BYTES_CONT):
             length += 2
             length += len(self.value)
         return length
 
-    def as_raw(self):
-        out = struct.pack(">BBHI", _FIELD_MAGIC, self.type, self.key, self.ts)
+    def as_raw(self, base=None):
+        if base is not None:
+            flags, value = self._compact_value()
+            return bytes((_FIELD_TAG | flags | self.type, )) + _varint(self.key) + _varint(self.ts - base) + value
+        if self.type not in _FIXED_TYPES:
+            raise ValueError('field type %d needs the compact record format' % self.type)
+        out = struct.pack(">BBHI", _FIELD_MAGIC, self.type, self.key, self.ts & 0xffffffff)
         assert len(out) == _FIELD_HEADER_SZ
         if self.type == FL_TYPE_INT:
             out += struct.pack(">I", self.value)
-        elif self.type == FL_TYPE_BYTES:
+        elif self.type in (FL_TYPE_BYTES, FL_TYPE_BYTES_CONT):
             out += struct.pack(">H", len(self.value))
             out += self.value
         assert self.length() == len(out)
         return out
 
+    def _compact_value(self):
+        # (tag flags, encoded value) in compact records, BYTES values are compressed if that saves an eighth
+        type_, value = self.type, self.value
+        if type_ == FL_TYPE_INT:
+            if not 0 <= value <= 0xffffffff:
+                raise ValueError('INT value out of range')
+            return 0, _varint(value)
+        if type_ == FL_TYPE_INT64:
+            if not -1 << 63 <= value < 1 << 63:
+                raise ValueError('INT64 value out of range')
+            return 0, _varint((value << 1) ^ (value >> 63))
+        if type_ == FL_TYPE_FLOAT:
+            return 0, _DOUBLE.pack(value)
+        packed = self._packed
+        if packed is None or packed[0] is not value:
+            packed = self._packed = (value, ) + _compress(value)
+        return packed[1], _varint(len(packed[2])) + packed[2]
+
+    def _compact_value_len(self):
+        type_ = self.type
+        if type_ == FL_TYPE_FLOAT:
+            return 8
+        if type_ == FL_TYPE_INT:
+            return _varint_len(self.value)
+        if type_ == FL_TYPE_INT64:
+            return _varint_len((self.value << 1) ^ (self.value >> 63))
+        value, packed = self.value, self._packed
+        if packed is None or packed[0] is not value:
+            packed = self._packed = (value, ) + _compress(value)
+        return _varint_len(len(packed[2])) + len(packed[2])
+
     @staticmethod
-    def from_raw(offset, mmap_):
+    def from_raw(offset, mmap_, zero_copy=False, base=None):
+        # with zero_copy and a memoryview as mmap_, uncompressed BYTES values are returned as memoryview slices; a
+        # base means the field is in the compact format
+        if base is not None:
+            return _compact_field(offset, mmap_, zero_copy, base)
         length = _FIELD_HEADER_SZ
-        fl_magic, fl_type, fl_key, fl_ts = struct.unpack(">BBHI", mmap_[offset:offset+_FIELD_HEADER_SZ])
+        fl_magic, fl_type, fl_key, fl_ts = _FIELD_HEADER.unpack_from(mmap_, offset)
         assert fl_magic == _FIELD_MAGIC
-        assert fl_type in (FL_TYPE_INT, FL_TYPE_BYTES, )
+        assert fl_type in (FL_TYPE_INT, FL_TYPE_BYTES, FL_TYPE_BYTES_CONT, )
         offset += _FIELD_HEADER_SZ
         if fl_type == FL_TYPE_INT:
-            value = struct.unpack(">I", mmap_[offset:offset+4])[0]
+            value = _INT.unpack_from(mmap_, offset)[0]
             length += 4
-        elif fl_type == FL_TYPE_BYTES:
-            value_len = struct.unpack(">H", mmap_[offset:offset+2])[0]
+        else:
+            value_len = _BYTES_LEN.unpack_from(mmap_, offset)[0]
             offset += 2
             length += 2
             value = mmap_[offset:offset+value_len]
+            if not zero_copy:
+                value = bytes(value)
             length += value_len
         fl = Field(fl_type, fl_key, value, fl_ts)
         return length, fl
@@ -403,13 +3313,1176 @@ class Field(object):
             setattr(self, k, getattr(new_fl, k))
 
 
+#
+# Network protocol
+#
+# Every request is a frame with a 9 byte header (body length, request id, opcode) followed by the body, every
+# response a frame with a 9 byte header (body length, request id, status) followed by the body. Requests are handled
+# in order per connection and can be pipelined, the request id is echoed back. Records and scan predicate values
+# travel in their on-disk FieldList / Field encoding and rec_addrs as 8 byte big-endian integers.
+#
+#   OP_INSERT  body: one or more FieldLists                  response: their rec_addrs
+#   OP_LOOKUP  body: one or more rec_addrs                   response: a FieldList per rec_addr, deleted records
+#                                                                      are an empty FieldList header (length 0)
+#   OP_UPDATE  body: rec_addr, FieldList                     response: the new rec_addr
+#   OP_DELETE  body: one or more rec_addrs                   response: empty
+#   OP_MERGE   body: one or more (rec_addr, FieldList) pairs response: empty, see Table.merge
+#   OP_CHANGES body: 8 byte ts                               response: STATUS_MORE frames of change entries (see
+#                                                                      _ChangeFeed) and a final empty STATUS_OK frame
+#   OP_SCAN    body: scan spec (see _encode_scan)            response: STATUS_MORE frames of (rec_addr, FieldList)
+#                                                                      pairs and a final empty STATUS_OK frame
+#   OP_SNAPSHOT body: empty                                 response: STATUS_MORE frames of a Snapshot.export
+#                                                                      stream and a final empty STATUS_OK frame
+#
+# Failed requests get an error status with a utf-8 message as the body.
+#
+
+OP_INSERT = 1
+OP_LOOKUP = 2
+OP_UPDATE = 3
+OP_DELETE = 4
+OP_SCAN = 5
+OP_MERGE = 6
+OP_CHANGES = 7
+OP_SNAPSHOT = 8
+
+STATUS_OK = 0
+STATUS_MORE = 1
+STATUS_DELETED = 2
+STATUS_NO_SPACE = 3
+STATUS_BAD_REQUEST = 4
+STATUS_ERROR = 5
+
+_FRAME_HEADER = struct.Struct(">IIB")
+_MAX_FRAME_BODY = 16 * 1024 * 1024
+_SCAN_OPS = ('==', '!=', '<', '<=', '>', '>=')
+_SCAN_ALL_FIELDS = 0xffff
+
+
+def _encode_frame(req_id, code, body=b""):
+    return _FRAME_HEADER.pack(len(body), req_id, code) + body
+
+
+def _encode_scan(fields=None, where=None, batch_size=256):
+    out = [struct.pack(">H", _SCAN_ALL_FIELDS if fields is None else len(fields))]
+    out.extend(struct.pack(">H", key) for key in (fields or ()))
+    where = list(where or ())
+    out.append(struct.pack(">H", len(where)))
+    for key, op, value in where:
+        # values travel as compact fields, which have room for every type
+        if isinstance(value, float):
+            type_ = FL_TYPE_FLOAT
+        elif isinstance(value, int):
+            type_ = FL_TYPE_INT if 0 <= value <= 0xffffffff else FL_TYPE_INT64
+        else:
+            type_ = FL_TYPE_BYTES
+        out.append(struct.pack(">B", _SCAN_OPS.index(op)))
+        out.append(Field(type_, key, value, 0).as_raw(base=0))
+    out.append(struct.pack(">H", batch_size))
+    return b"".join(out)
+
+
+def _decode_scan(body):
+    offset = 0
+    num_fields = struct.unpack_from(">H", body, offset)[0]
+    offset += 2
+    fields = None
+    if num_fields != _SCAN_ALL_FIELDS:
+        fields = struct.unpack_from(">%dH" % num_fields, body, offset)
+        offset += 2 * num_fields
+    num_preds = struct.unpack_from(">H", body, offset)[0]
+    offset += 2
+    where = []
+    for _ in range(num_preds):
+        op = _SCAN_OPS[struct.unpack_from(">B", body, offset)[0]]
+        fl_len, fl = Field.from_raw(offset + 1, body, base=0)
+        where.append((fl.key, op, fl.value))
+        offset += 1 + fl_len
+    batch_size = struct.unpack_from(">H", body, offset)[0]
+    return fields, where, max(batch_size, 1)
+
+
+def _record_end(body, offset):
+    # the end of the record at offset, which may have been sent as several FieldLists
+    while True:
+        rec_len, next_ = _FLS_HEADER.unpack_from(body, offset)[1:] if offset + _FLS_HEADER_SZ <= len(body) else (0, 0)
+        if rec_len < _FLS_HEADER_SZ:
+            raise ValueError('bad FieldList')
+        offset += rec_len
+        if next_ != _FLS_NEXT_MORE:
+            return offset
+
+
+def _split_field_lists(body, offset=0):
+    raws = []
+    while offset < len(body):
+        end = _record_end(body, offset)
+        raws.append(body[offset:end])
+        offset = end
+    return raws
+
+
+def _split_lookup(body):
+    # a lookup response has a record per rec_addr, or just a zero length header for deleted records
+    raws = []
+    offset = 0
+    while offset < len(body):
+        if _FLS_HEADER.unpack_from(body, offset)[1] == 0:
+            raws.append(None)
+            offset += _FLS_HEADER_SZ
+        else:
+            end = _record_end(body, offset)
+            raws.append(body[offset:end])
+            offset = end
+    return raws
+
+
+def _split_merges(body):
+    # (rec_addr, raw record) pairs
+    merges = []
+    offset = 0
+    while offset < len(body):
+        if offset + _REC_ADDR.size > len(body):
+            raise ValueError('bad rec_addr')
+        rec_addr = _REC_ADDR.unpack_from(body, offset)[0]
+        end = _record_end(body, offset + _REC_ADDR.size)
+        merges.append((rec_addr, body[offset + _REC_ADDR.size:end]))
+        offset = end
+    return merges
+
+
+def _split_rec_addrs(body):
+    if len(body) % _REC_ADDR.size:
+        raise ValueError('bad rec_addrs')
+    return struct.unpack(">%dQ" % (len(body) // _REC_ADDR.size), body)
+
+
+class Server(object):
+    """
+    Serves a Table over the binary protocol above using asyncio. All requests run on the event loop thread; other
+    threads can use the same Table meanwhile (see the comments on Table), e.g. the periodic commit thread or an
+    application that embeds the server.
+
+    With a DURABILITY_BATCH table the responses to writes are held until a commit that is shared by all the
+    requests read in the same event loop iteration, so a pipelined batch costs one fsync. Responses that follow a
+    held one on the same connection are held too to keep them in order.
+    """
+    _DRAIN_SZ = 256 * 1024  # wait for the socket to drain once this much output is buffered
+    _WRITE_OPS = frozenset((OP_INSERT, OP_UPDATE, OP_DELETE, OP_MERGE))
+
+    def __init__(self, table, host='127.0.0.1', port=0):
+        self.table = table
+        self.host = host
+        self.port = port
+        self._server = None
+        self._group_commit = table.durability == DURABILITY_BATCH
+        if self._group_commit:
+            table.group_commit = True
+        self._waiting = []  # (writer, held responses) of connections waiting for the next commit
+        self._commit_done = None
+        self._connections = set()  # the tasks serving connections
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._connected, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        self._server.close()
+
+    def _connected(self, reader, writer):
+        # the connection gets a task of its own rather than start_server's, which before Python 3.11.8 reports a
+        # cancelled one (the loop shutting down) as an unhandled exception
+        task = asyncio.get_running_loop().create_task(self._handle(reader, writer))
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+
+    async def _handle(self, reader, writer):
+        held = []  # (is a write, req_id, response) waiting for the next commit
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                body_len, req_id, op = _FRAME_HEADER.unpack(header)
+                if body_len > _MAX_FRAME_BODY:
+                    writer.write(_encode_frame(req_id, STATUS_BAD_REQUEST, b"request too large"))
+                    break
+                body = await reader.readexactly(body_len)
+                if op in (OP_SCAN, OP_CHANGES, OP_SNAPSHOT):
+                    if held:
+                        await self._commit_done
+                    if op == OP_SCAN:
+                        await self._scan(req_id, body, writer)
+                    elif op == OP_CHANGES:
+                        await self._changes(req_id, body, writer)
+                    else:
+                        await self._snapshot(req_id, writer)
+                elif self._group_commit and (held or op in self._WRITE_OPS):
+                    if not held:
+                        self._wait_for_commit(writer, held)
+                    held.append((op in self._WRITE_OPS, req_id, self._dispatch(req_id, op, body)))
+                else:
+                    writer.write(self._dispatch(req_id, op, body))
+                if writer.transport.get_write_buffer_size() > self._DRAIN_SZ:
+                    await writer.drain()
+            if held:
+                await self._commit_done
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # a CancelledError (the server is shutting down) propagates so the task ends cancelled
+            writer.close()
+
+    def _wait_for_commit(self, writer, held):
+        if self._commit_done is None:
+            self._commit_done = asyncio.get_running_loop().create_future()
+            # runs once the requests already read in this event loop iteration have been dispatched
+            asyncio.get_running_loop().call_soon(self._commit)
+        self._waiting.append((writer, held))
+
+    def _commit(self):
+        waiting, self._waiting = self._waiting, []
+        commit_done, self._commit_done = self._commit_done, None
+        error = None
+        try:
+            self.table.commit()
+        except Exception as e:
+            _logger.exception('commit failed')
+            error = str(e).encode()
+        for writer, held in waiting:
+            if writer.is_closing():
+                continue
+            for is_write, req_id, response in held:
+                if is_write and error is not None:
+                    response = _encode_frame(req_id, STATUS_ERROR, error)
+                writer.write(response)
+            del held[:]
+        commit_done.set_result(None)
+
+    def _dispatch(self, req_id, op, body):
+        try:
+            if op == OP_INSERT:
+                rec_addrs = self.table.insert_raw(_split_field_lists(body))
+                return _encode_frame(req_id, STATUS_OK, struct.pack(">%dQ" % len(rec_addrs), *rec_addrs))
+            elif op == OP_LOOKUP:
+                out = []
+                for rec_addr in _split_rec_addrs(body):
+                    try:
+                        out.append(self.table.lookup_raw(rec_addr))
+                    except RecordDeleted:
+                        out.append(_FLS_HEADER.pack(_FLS_MAGIC, 0, 0))
+                return _encode_frame(req_id, STATUS_OK, b"".join(out))
+            elif op == OP_UPDATE:
+                rec_addr = _REC_ADDR.unpack_from(body, 0)[0]
+                raws = _split_field_lists(body, _REC_ADDR.size)
+                if len(raws) != 1:
+                    raise ValueError('bad FieldList')
+                new_rec_addr = self.table.update(rec_addr, _decode_record(raws[0]))
+                return _encode_frame(req_id, STATUS_OK, _REC_ADDR.pack(new_rec_addr))
+            elif op == OP_DELETE:
+                self.table.delete_many(_split_rec_addrs(body))
+                return _encode_frame(req_id, STATUS_OK)
+            elif op == OP_MERGE:
+                self.table.merge_many([(rec_addr, _decode_record(raw)) for rec_addr, raw in _split_merges(body)])
+                return _encode_frame(req_id, STATUS_OK)
+            return _encode_frame(req_id, STATUS_BAD_REQUEST, ("unknown op %d" % op).encode())
+        except RecordDeleted:
+            return _encode_frame(req_id, STATUS_DELETED)
+        except NoSpace:
+            return _encode_frame(req_id, STATUS_NO_SPACE)
+        except (ValueError, IndexError, struct.error) as e:
+            return _encode_frame(req_id, STATUS_BAD_REQUEST, str(e).encode())
+        except Exception as e:
+            _logger.exception('request %d failed', req_id)
+            return _encode_frame(req_id, STATUS_ERROR, str(e).encode())
+
+    async def _scan(self, req_id, body, writer):
+        try:
+            fields, where, batch_size = _decode_scan(body)
+            batches = self.table.scan(fields, where, batch_size)
+        except (ValueError, IndexError, KeyError, struct.error) as e:
+            writer.write(_encode_frame(req_id, STATUS_BAD_REQUEST, str(e).encode()))
+            return
+        for batch in batches:
+            out = []
+            for rec_addr, fls in batch:
+                out.append(_REC_ADDR.pack(rec_addr))
+                out.extend(fls.as_raw_chunks())
+            writer.write(_encode_frame(req_id, STATUS_MORE, b"".join(out)))
+            # let other connections in between batches
+            await writer.drain()
+        writer.write(_encode_frame(req_id, STATUS_OK))
+
+    async def _changes(self, req_id, body, writer):
+        if len(body) != _TS.size or self.table._changes is None:
+            writer.write(_encode_frame(req_id, STATUS_BAD_REQUEST, b"bad ts or no change feed"))
+            return
+        entries = (_ChangeFeed._ENTRY.pack(*change[:2] + (change.key, change.rec_addr, change.new_rec_addr))
+                   for change in self.table.changes_since(_TS.unpack(body)[0]))
+        for batch in _batched(entries, 1024):
+            writer.write(_encode_frame(req_id, STATUS_MORE, b"".join(batch)))
+            await writer.drain()
+        writer.write(_encode_frame(req_id, STATUS_OK))
+
+    async def _snapshot(self, req_id, writer):
+        # other connections keep writing while the image is sent, the snapshot copies what they change
+        with self.table.snapshot() as snapshot:
+            for batch in _batched(snapshot.chunks(), 16):
+                writer.write(_encode_frame(req_id, STATUS_MORE, b"".join(batch)))
+                await writer.drain()
+                await asyncio.sleep(0)  # drain only waits for a full buffer, and a table can be gigabytes
+        writer.write(_encode_frame(req_id, STATUS_OK))
+
+
+#
+# Client
+#
+# Servers know nothing about each other: the client places records on nodes with a consistent hash of an application
+# key, writes every record to the first `replicas` nodes clockwise on the ring and reads from the first replica that
+# answers. A record is identified by the Refs of its copies since each node assigns its own rec_addr.
+#
+
+Ref = collections.namedtuple('Ref', ['node', 'rec_addr'])
+
+
+class HashRing(object):
+    """ A consistent hash ring with vnodes virtual nodes per unit of node weight """
+
+    def __init__(self, vnodes=160):
+        self.vnodes = vnodes
+        self._points = []  # sorted hashes
+        self._owners = []  # node owning each point
+        self.weights = {}
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        return struct.unpack_from(">Q", hashlib.md5(key).digest())[0]
+
+    def add(self, node, weight=1):
+        self.weights[node] = weight
+        self._rebuild()
+
+    def remove(self, node):
+        del self.weights[node]
+        self._rebuild()
+
+    def _rebuild(self):
+        points = []
+        for node, weight in self.weights.items():
+            for i in range(int(self.vnodes * weight)):
+                points.append((self._hash('%s#%d' % (node, i)), node))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def nodes_for(self, key, n=1, exclude=()):
+        """ Returns up to n distinct nodes for key, in ring order starting at the key's hash """
+        nodes = []
+        if not self._points:
+            return nodes
+        start = bisect.bisect(self._points, self._hash(key))
+        for i in range(len(self._points)):
+            node = self._owners[(start + i) % len(self._points)]
+            if node not in nodes and node not in exclude:
+                nodes.append(node)
+                if len(nodes) == n:
+                    break
+        return nodes
+
+
+class _Connection(object):
+    """ A blocking connection to a Server, requests can be pipelined by sending several before reading """
+
+    def __init__(self, host, port, timeout):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        self._next_id = 0
+
+    def pipeline(self, requests):
+        """ Sends all the (op, body) requests then reads their (status, body) responses """
+        self.pipeline_send(requests)
+        return [self.receive()[1:] for _ in requests]
+
+    def pipeline_send(self, requests):
+        self._sock.sendall(b"".join(_encode_frame(self._new_id(), op, body) for op, body in requests))
+
+    def _new_id(self):
+        self._next_id = (self._next_id + 1) & 0xffffffff
+        return self._next_id
+
+    def receive(self):
+        header = self._file.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            raise ConnectionError('connection closed')
+        body_len, req_id, status = _FRAME_HEADER.unpack(header)
+        body = self._file.read(body_len)
+        if len(body) < body_len:
+            raise ConnectionError('connection closed')
+        return req_id, status, body
+
+    def request(self, op, body=b""):
+        return self.pipeline([(op, body)])[0]
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class _ConnectionPool(object):
+    """ Persistent connections to one node, connections that fail are dropped """
+
+    def __init__(self, host, port, size, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = _Connection(self.host, self.port, self.timeout)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class ClientError(Exception):
+    pass
+
+
+class Client(object):
+    """
+    A client for a set of db48 servers. nodes are "host:port" strings or (host, port[, weight]) tuples. Writes go to
+    `replicas` nodes and fail only if no replica could be written, reads go to the first replica that answers.
+    Requests for several records are grouped per node and sent to the nodes in parallel.
+    """
+
+    def __init__(self, nodes, replicas=1, vnodes=160, pool_size=8, timeout=5.0, retry_after=5.0):
+        self.replicas = replicas
+        self.retry_after = retry_after
+        self._ring = HashRing(vnodes)
+        self._pools = {}
+        self._down = {}  # node -> time until which it is skipped for writes
+        for node in nodes:
+            if isinstance(node, str):
+                host, _, port = node.rpartition(':')
+                node = (host, int(port))
+            host, port = node[0], node[1]
+            name = '%s:%d' % (host, port)
+            self._pools[name] = _ConnectionPool(host, port, pool_size, timeout)
+            self._ring.add(name, node[2] if len(node) > 2 else 1)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max(len(self._pools), 1))
+
+    def close(self):
+        self._executor.shutdown()
+        for pool in self._pools.values():
+            pool.close()
+
+    def nodes_for(self, key):
+        now = time.time()
+        down = [node for node, until in self._down.items() if until > now]
+        return self._ring.nodes_for(key, self.replicas, down)
+
+    def insert(self, key, fls):
+        """ Inserts fls on the replicas for key, returns the Refs of the copies """
+        return self.insert_many([(key, fls)])[0]
+
+    def insert_many(self, items):
+        """ Inserts (key, fls) items, one request per node, returns a list of Refs per item """
+        by_node = {}
+        for i, (key, fls) in enumerate(items):
+            raw = b"".join(fls.as_raw_chunks())
+            for node in self.nodes_for(key):
+                by_node.setdefault(node, []).append((i, raw))
+        refs = [[] for _ in items]
+        results = self._fan_out(by_node, lambda entries: (OP_INSERT, b"".join(raw for _, raw in entries)))
+        for node, entries in by_node.items():
+            status, body = results[node]
+            if status != STATUS_OK:
+                continue
+            for (i, _), rec_addr in zip(entries, _split_rec_addrs(body)):
+                refs[i].append(Ref(node, rec_addr))
+        for i, item_refs in enumerate(refs):
+            if not item_refs:
+                raise ClientError('could not write item %d to any replica' % i)
+        return refs
+
+    def lookup(self, refs):
+        """ Returns the FieldList of a record from the first replica that answers """
+        fls = self.lookup_many([refs])[0]
+        if fls is None:
+            raise RecordDeleted()
+        return fls
+
+    def lookup_many(self, refs_list):
+        """ Looks up several records, one multi-get per node, returns a FieldList (or None if deleted) for each """
+        results = [None] * len(refs_list)
+        pending = list(range(len(refs_list)))
+        attempt = 0
+        while pending:
+            by_node = {}
+            for i in pending:
+                if attempt < len(refs_list[i]):
+                    ref = refs_list[i][attempt]
+                    by_node.setdefault(ref.node, []).append((i, ref.rec_addr))
+            if not by_node:
+                raise ClientError('no replica answered for %d records' % len(pending))
+            responses = self._fan_out(
+                by_node, lambda entries: (OP_LOOKUP, struct.pack(">%dQ" % len(entries), *[a for _, a in entries])))
+            pending = []
+            for node, entries in by_node.items():
+                status, body = responses[node]
+                if status != STATUS_OK:
+                    pending.extend(i for i, _ in entries)
+                    continue
+                for (i, _), raw in zip(entries, _split_lookup(body)):
+                    if raw is not None:
+                        results[i] = _decode_record(raw)
+            attempt += 1
+        return results
+
+    def update(self, refs, fls):
+        """ Updates every replica, returns the new Refs of the copies that were updated """
+        raw = b"".join(fls.as_raw_chunks())
+        by_node = dict((ref.node, [ref]) for ref in refs)
+        responses = self._fan_out(by_node, lambda entries: (OP_UPDATE, _REC_ADDR.pack(entries[0].rec_addr) + raw))
+        new_refs = []
+        for ref in refs:
+            status, body = responses[ref.node]
+            if status == STATUS_OK:
+                new_refs.append(Ref(ref.node, _REC_ADDR.unpack(body)[0]))
+        if not new_refs:
+            raise ClientError('could not update any replica')
+        return new_refs
+
+    def merge(self, refs, fls):
+        """
+        Merges fls into every replica keeping its field timestamps, e.g. to bring a replica up to date with
+        another one's copy of a record; see Table.merge. Returns the Refs of the copies that were merged into.
+        """
+        raw = b"".join(fls.as_raw_chunks())
+        by_node = dict((ref.node, [ref]) for ref in refs)
+        responses = self._fan_out(by_node, lambda entries: (OP_MERGE, _REC_ADDR.pack(entries[0].rec_addr) + raw))
+        merged = [ref for ref in refs if responses[ref.node][0] == STATUS_OK]
+        if not merged:
+            raise ClientError('could not merge into any replica')
+        return merged
+
+    def changes_since(self, node, ts):
+        """ Returns the Changes a node logged at or after ts, see Table.changes_since """
+        changes = []
+        with self._pools[node].connection() as conn:
+            conn.pipeline_send([(OP_CHANGES, _TS.pack(ts))])
+            while True:
+                _, status, body = conn.receive()
+                if status == STATUS_OK:
+                    return changes
+                if status != STATUS_MORE:
+                    raise ClientError(body.decode(errors='replace'))
+                for ts_, kind, key, rec_addr, new_rec_addr in _ChangeFeed._ENTRY.iter_unpack(body):
+                    changes.append(Change(ts_, kind, rec_addr, key, new_rec_addr))
+
+    def snapshot(self, node, out):
+        """ Writes a consistent image of a node's table to the binary file object out, see Table.restore """
+        with self._pools[node].connection() as conn:
+            conn.pipeline_send([(OP_SNAPSHOT, b"")])
+            while True:
+                _, status, body = conn.receive()
+                if status == STATUS_OK:
+                    return
+                if status != STATUS_MORE:
+                    raise ClientError(body.decode(errors='replace'))
+                out.write(body)
+
+    def delete(self, refs):
+        by_node = {}
+        for ref in refs:
+            by_node.setdefault(ref.node, []).append(ref.rec_addr)
+        self._fan_out(by_node, lambda rec_addrs: (OP_DELETE, struct.pack(">%dQ" % len(rec_addrs), *rec_addrs)))
+
+    def _fan_out(self, by_node, make_request):
+        # sends one request per node in parallel, returns node -> (status, body), unreachable nodes get STATUS_ERROR
+        futures = dict((node, self._executor.submit(self._request, node, make_request(entries)))
+                       for node, entries in by_node.items())
+        return dict((node, future.result()) for node, future in futures.items())
+
+    def _request(self, node, request):
+        try:
+            with self._pools[node].connection() as conn:
+                status, body = conn.request(*request)
+        except (OSError, ConnectionError) as e:
+            _logger.warning('request to %s failed: %s', node, e)
+            self._down[node] = time.time() + self.retry_after
+            return STATUS_ERROR, str(e).encode()
+        self._down.pop(node, None)
+        return status, body
+
+
+def _serve(args):
+    table = Table(max_segments=args.max_segments or None, durability=args.durability, change_feed=args.change_feed,
+                  record_format=RECORD_FORMAT_COMPACT if args.compact_records else None)
+    if args.create and not os.path.exists(args.path):
+        table.create(args.path)
+    else:
+        table.open(args.path)
+        if not table.clean:
+            table.verify(repair=True)
+    server = Server(table, args.host, args.port)
+
+    async def run():
+        await server.start()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, server.close)
+        print('listening on %s:%d' % (server.host, server.port), flush=True)
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+    try:
+        asyncio.run(run())
+    finally:
+        table.close()
+
+
+def _verify(args):
+    table = Table(max_segments=None)
+    table.open(args.path, readonly=not args.repair)
+    try:
+        report = table.verify(args.repair, args.workers)
+    finally:
+        table.close()
+    for key, value in sorted(report.items()):
+        print('%s: %s' % (key, len(value) if isinstance(value, list) else value))
+    problems = ('bad_fmes', 'bad_summaries', 'bad_checksums', 'orphans', 'broken_chains')
+    if not args.repair and any(report[key] for key in problems):
+        sys.exit(1)
+
+
+def _backup(args):
+    table = Table(max_segments=None)
+    table.open(args.path, readonly=True)
+    try:
+        with table.snapshot() as snapshot, open(args.out, 'wb') as out:
+            written = snapshot.export(out)
+    finally:
+        table.close()
+    print('wrote %d bytes to %s' % (written, args.out))
+
+
+def _restore(args):
+    table = Table(max_segments=None)
+    with open(args.backup, 'rb') as stream:
+        table.restore(args.path, stream)
+    table.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='db48')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    server_parser = commands.add_parser('server', help='serve a table over the network')
+    server_parser.add_argument('path')
+    server_parser.add_argument('--host', default='127.0.0.1')
+    server_parser.add_argument('--port', type=int, default=4848)
+    server_parser.add_argument('--create', action='store_true', help='create the table if it does not exist')
+    server_parser.add_argument('--max-segments', type=int, default=1, help='segment files the table may grow to, '
+                               '0 for no limit')
+    server_parser.add_argument('--durability', choices=(DURABILITY_NONE, DURABILITY_PERIODIC, DURABILITY_BATCH),
+                               default=DURABILITY_NONE, help='when writes are made durable with the write-ahead log')
+    server_parser.add_argument('--change-feed', action='store_true', help='log changes for replicas to catch up with')
+    server_parser.add_argument('--compact-records', action='store_true', help='write new records in the compact format')
+    server_parser.set_defaults(func=_serve)
+    verify_parser = commands.add_parser('verify', help='check a table and optionally repair it')
+    verify_parser.add_argument('path')
+    verify_parser.add_argument('--repair', action='store_true')
+    verify_parser.add_argument('--workers', type=int, default=None, help='processes to check regions in')
+    verify_parser.set_defaults(func=_verify)
+    backup_parser = commands.add_parser('backup', help='write the live regions of a table that is not in use to a '
+                                        'file, Client.snapshot backs up a served one')
+    backup_parser.add_argument('path')
+    backup_parser.add_argument('out')
+    backup_parser.set_defaults(func=_backup)
+    restore_parser = commands.add_parser('restore', help='create a table from a backup')
+    restore_parser.add_argument('backup')
+    restore_parser.add_argument('path')
+    restore_parser.set_defaults(func=_restore)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
 class NoSpace(Exception):
     pass
 
 
+class IndexExists(Exception):
+    pass
+
+
 class RecordDeleted(Exception):
     pass
 
 
-def _get_time():
+def _fields_fit(buf, offset, end, padded=False, compact=False):
+    # checks that well formed field headers exactly cover [offset, end), or are followed by zeros if padded
+    if compact:
+        return _compact_fields_fit(buf, offset, end, padded)
+    while offset < end:
+        if padded and buf[offset] == 0:
+            return buf[offset:end].count(0) == end - offset
+        if offset + _FIELD_HEADER_SZ > end:
+            return False
+        fl_magic, fl_type, _, _ = _FIELD_HEADER.unpack_from(buf, offset)
+        if fl_magic != _FIELD_MAGIC:
+            return False
+        offset += _FIELD_HEADER_SZ
+        if fl_type == FL_TYPE_INT:
+            offset += 4
+        elif fl_type in (FL_TYPE_BYTES, FL_TYPE_BYTES_CONT) and offset + 2 <= end:
+            offset += 2 + _BYTES_LEN.unpack_from(buf, offset)[0]
+        else:
+            return False
+    return offset == end
+
+
+def _compact_fields_fit(buf, offset, end, padded):
+    try:
+        if offset < end:
+            offset = _read_varint(buf, offset)[1]
+        while offset < end:
+            if padded and buf[offset] == 0:
+                return buf[offset:end].count(0) == end - offset
+            tag = buf[offset]
+            if tag & _FIELD_TAG_MASK != _FIELD_TAG or not FL_TYPE_INT <= tag & _FIELD_TYPE_MASK <= FL_TYPE_FLOAT:
+                return False
+            offset = _skip_compact_field(buf, offset)[2]
+    except IndexError:
+        return False
+    return offset == end
+
+
+def _is_compact(magic):
+    return magic in (_FLS_COMPACT_MAGIC, _FLS_EXT_COMPACT_MAGIC)
+
+
+def _is_raw_field_list(raw):
+    if len(raw) < _FLS_HEADER_SZ:
+        return False
+    rec_magic, rec_len, next_ = _FLS_HEADER.unpack_from(raw, 0)
+    return (rec_magic in _HEAD_MAGICS and rec_len == len(raw) and next_ == 0 and
+            _fields_fit(raw, _FLS_HEADER_SZ, rec_len, compact=_is_compact(rec_magic)))
+
+
+def _pack_fields(fls, first_space, space, base=None):
+    """
+    Splits the encoded fields into chunks, the first of at most first_space bytes and the others of at most space
+    bytes. BYTES values that do not fit in what is left of a chunk are split into a BYTES field and BYTES_CONT
+    fragments, so at most a few bytes of a chunk stay unused. Returns a list of lists of raw fields; with a base
+    the fields are in the compact format and every chunk starts with the base.
+    """
+    prefix = b"" if base is None else _varint(base)
+    # a first chunk with no room for the base stays empty
+    chunks = [[prefix]] if len(prefix) <= first_space else [[]]
+    free = first_space - len(prefix) if chunks[0] else 0
+    for fl in fls:
+        length = fl.length(base)
+        if fl.type not in (FL_TYPE_BYTES, FL_TYPE_BYTES_CONT) or (length <= free and len(fl.value) <= _MAX_BYTES_LEN):
+            if length > free:
+                chunks.append([prefix])
+                free = space - len(prefix)
+            chunks[-1].append(fl.as_raw(base))
+            free -= length
+            continue
+        value, pos, type_ = fl.value, 0, fl.type
+        # the most a fragment's header takes, with a length of up to 3 bytes in the compact format
+        overhead = (_FIELD_HEADER_SZ + 2 if base is None else
+                    1 + _varint_len(fl.key) + _varint_len(fl.ts - base) + 3)
+        while pos < len(value):
+            room = min(free - overhead, _MAX_BYTES_LEN)
+            if room < min(_MIN_FRAGMENT, len(value) - pos):
+                chunks.append([prefix])
+                free = space - len(prefix)
+                continue
+            fragment = Field(type_, fl.key, value[pos:pos+room], fl.ts)
+            chunks[-1].append(fragment.as_raw(base))
+            free -= fragment.length(base)
+            pos += room
+            type_ = FL_TYPE_BYTES_CONT
+    return chunks
+
+
+def _merge_fields(fls):
+    """
+    Merges the fields of the segments of a record in chain order: BYTES_CONT fragments are appended to the value
+    they continue and a later field replaces an earlier one with the same key. Returns the fields sorted by key.
+    """
+    by_key = {}
+    fragments = {}
+    for fl in fls:
+        if fl.type == FL_TYPE_BYTES_CONT:
+            fragments[fl.key].append(fl.value)
+        else:
+            by_key[fl.key] = fl
+            fragments[fl.key] = [fl.value]
+    for key, values in fragments.items():
+        if len(values) > 1:
+            by_key[key].value = b"".join(values)
+    return sorted(by_key.values(), key=lambda x: x.key)
+
+
+def _segment_sizes(chunks, head):
+    # the stored sizes of a chain of segments holding chunks, the first is a head segment if head
+    sizes = [_FLS_EXT_HEADER_SZ + sum(len(raw) for raw in chunk) + _FLS_NEXT_SZ for chunk in chunks]
+    if head:
+        sizes[0] -= _FLS_EXT_HEADER_SZ - _FLS_HEADER_SZ
+    sizes[-1] -= _FLS_NEXT_SZ
+    return sizes
+
+
+def _decode_record(raw):
+    # decodes a record encoded with FieldList.as_raw_chunks
+    try:
+        fls, end = FieldList.load_chunks(0, raw)
+    except (AssertionError, KeyError):
+        raise ValueError('bad FieldList')
+    if end != len(raw):
+        raise ValueError('bad FieldList')
+    return fls
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('truncated snapshot')
+    return data
+
+
+def _batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _get_uint(buf, offsets, size):
+    # the big endian unsigned ints of size bytes at offsets in a uint8 array
+    value = buf[offsets].astype(numpy.int64)
+    for i in range(1, size):
+        value = (value << 8) | buf[offsets + i]
+    return value
+
+
+def _put_uint(buf, offsets, value, size):
+    for i in range(size):
+        buf[offsets + i] = (value >> (8 * (size - 1 - i))) & 0xff
+
+
+def _spans(starts, lengths):
+    # the indexes of the concatenated ranges [starts[i], starts[i] + lengths[i])
+    ends = numpy.cumsum(lengths)
+    return numpy.arange(ends[-1] if len(ends) else 0) - numpy.repeat(ends - lengths - starts, lengths)
+
+
+def _parse_fields(buf, starts, ends, keys):
+    """
+    Finds the fields keys of the FieldLists in a uint8 array whose fields are at [starts[row], ends[row]), for all
+    rows at once: each step decodes the header of every row's next field. Returns {key: (rows, types, INT values,
+    BYTES lengths, the BYTES values concatenated)} with an entry per field found.
+    """
+    found = dict((key, []) for key in keys)
+    rows = numpy.arange(len(starts))
+    pos = starts
+    while True:
+        active = pos + _FIELD_HEADER_SZ <= ends[rows]
+        rows, pos = rows[active], pos[active]
+        if not len(rows):
+            break
+        types = buf[pos + _FIELD_TYPE_OFF]
+        field_keys = _get_uint(buf, pos + _FIELD_KEY_OFF, 2)
+        is_int = types == FL_TYPE_INT
+        values = _get_uint(buf, pos + _FIELD_HEADER_SZ, 4)
+        lengths = numpy.where(is_int, 0, values >> 16)  # the first 2 bytes of a BYTES field are its length
+        for key in keys:
+            match = numpy.flatnonzero(field_keys == key)
+            if len(match):
+                data = buf[_spans(pos[match] + _FIELD_HEADER_SZ + 2, lengths[match])]
+                found[key].append((rows[match], types[match], numpy.where(is_int[match], values[match], 0),
+                                   lengths[match], data))
+        pos = pos + _FIELD_HEADER_SZ + numpy.where(is_int, 4, 2 + lengths)
+    empty = (numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.uint8), numpy.zeros(0, numpy.int64),
+             numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.uint8))
+    return dict((key, tuple(numpy.concatenate(arrays) for arrays in zip(*found[key])) if found[key] else empty)
+                for key in keys)
+
+
+def _int_column(parts, key, dtype=None):
+    values, present = [], []
+    for rec_addrs, found, chained in parts:
+        rows, _, ints, _, _ = found[key]
+        part_values = numpy.zeros(len(rec_addrs), dtype=dtype or numpy.uint32)
+        part_present = numpy.zeros(len(rec_addrs), dtype=bool)
+        part_values[rows] = ints
+        part_present[rows] = True
+        for row, fls in chained.items():
+            for fl in fls.fls:
+                if fl.key == key:
+                    part_values[row] = fl.value
+                    part_present[row] = True
+        values.append(part_values)
+        present.append(part_present)
+    return IntColumn(numpy.concatenate(values), numpy.concatenate(present))
+
+
+def _bytes_column(parts, key):
+    lengths, data, present = [], [], []
+    for rec_addrs, found, chained in parts:
+        rows, _, _, part_lengths, part_data = found[key]
+        row_lengths = numpy.zeros(len(rec_addrs), dtype=numpy.int64)
+        part_present = numpy.zeros(len(rec_addrs), dtype=bool)
+        row_lengths[rows] = part_lengths
+        part_present[rows] = True
+        values = {}
+        for row, fls in chained.items():
+            for fl in fls.fls:
+                if fl.key == key:
+                    values[row] = fl.value
+                    row_lengths[row] = len(fl.value)
+                    part_present[row] = True
+        offsets = numpy.cumsum(row_lengths) - row_lengths
+        row_data = numpy.empty(int(row_lengths.sum()), dtype=numpy.uint8)
+        row_data[_spans(offsets[rows], part_lengths)] = part_data
+        for row, value in values.items():
+            row_data[offsets[row]:offsets[row] + len(value)] = numpy.frombuffer(value, dtype=numpy.uint8)
+        lengths.append(row_lengths)
+        data.append(row_data)
+        present.append(part_present)
+    lengths = numpy.concatenate(lengths)
+    return BytesColumn(numpy.concatenate(([0], numpy.cumsum(lengths))), numpy.concatenate(data),
+                       numpy.concatenate(present))
+
+
+def _encode_columns(columns, ts):
+    """
+    Encodes a FieldList per row of columns (see Table.from_columns) into one buffer. Returns the raw FieldLists and
+    the rows too large for a region, whose raw FieldLists are left empty.
+    """
+    keys = sorted(columns)
+    num_rows = len(columns[keys[0]].present) if keys else 0
+    field_lengths = {}
+    rec_lengths = numpy.full(num_rows, _FLS_HEADER_SZ, dtype=numpy.int64)
+    for key in keys:
+        column = columns[key]
+        if len(column.present) != num_rows:
+            raise ValueError('the columns have different lengths')
+        if isinstance(column, FloatColumn):
+            raise ValueError('from_columns writes fixed format records, which have no FLOAT fields')
+        if isinstance(column, IntColumn):
+            values = numpy.asarray(column.values, dtype=numpy.int64)
+            if len(values) and (values.min() < 0 or values.max() > 0xffffffff):
+                raise ValueError('INT field %d has values out of range' % key)
+            length = _FIELD_HEADER_SZ + 4
+        else:
+            length = _FIELD_HEADER_SZ + 2 + numpy.diff(numpy.asarray(column.offsets, dtype=numpy.int64))
+        field_lengths[key] = numpy.where(numpy.asarray(column.present, dtype=bool), length, 0)
+        rec_lengths += field_lengths[key]
+    large = rec_lengths > _REGION_USABLE_SZ
+    rec_lengths[large] = 0
+    starts = numpy.cumsum(rec_lengths) - rec_lengths
+    buf = numpy.zeros(int(rec_lengths.sum()), dtype=numpy.uint8)
+    small = numpy.flatnonzero(~large)
+    _put_uint(buf, starts[small], _FLS_MAGIC, 4)
+    _put_uint(buf, starts[small] + _FLS_LEN_OFF, rec_lengths[small], 2)
+    pos = starts + _FLS_HEADER_SZ
+    for key in keys:
+        column = columns[key]
+        rows = numpy.flatnonzero(numpy.asarray(column.present, dtype=bool) & ~large)
+        at = pos[rows]
+        buf[at + _FIELD_MAGIC_OFF] = _FIELD_MAGIC
+        _put_uint(buf, at + _FIELD_KEY_OFF, key, 2)
+        _put_uint(buf, at + _FIELD_TS_OFF, ts, 4)
+        if isinstance(column, IntColumn):
+            buf[at + _FIELD_TYPE_OFF] = FL_TYPE_INT
+            _put_uint(buf, at + _FIELD_HEADER_SZ, numpy.asarray(column.values, dtype=numpy.int64)[rows], 4)
+        else:
+            offsets = numpy.asarray(column.offsets, dtype=numpy.int64)
+            lengths = offsets[rows + 1] - offsets[rows]
+            buf[at + _FIELD_TYPE_OFF] = FL_TYPE_BYTES
+            _put_uint(buf, at + _FIELD_HEADER_SZ, lengths, 2)
+            buf[_spans(at + _FIELD_HEADER_SZ + 2, lengths)] = numpy.asarray(column.data)[_spans(offsets[rows], lengths)]
+        pos += field_lengths[key]
+    data = buf.tobytes()
+    raws = [data[start:end] for start, end in zip(starts.tolist(), (starts + rec_lengths).tolist())]
+    return raws, numpy.flatnonzero(large).tolist()
+
+
+def _row_field_list(columns, row, ts):
+    fls = []
+    for key in sorted(columns):
+        column = columns[key]
+        if column.present[row]:
+            if isinstance(column, IntColumn):
+                fls.append(Field(FL_TYPE_INT, key, int(column.values[row]), ts))
+            else:
+                value = bytes(column.data[column.offsets[row]:column.offsets[row + 1]])
+                fls.append(Field(FL_TYPE_BYTES, key, value, ts))
+    return FieldList(fls)
+
+
+def _varint(value):
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    if value < 0x4000:
+        return bytes((value & 0x7f | 0x80, value >> 7))
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+_SMALL_VARINTS = [bytes((i, )) for i in range(0x80)]
+
+
+def _varint_len(value):
+    return (value.bit_length() + 6) // 7 or 1
+
+
+def _read_varint(buf, offset):
+    # returns (value, offset after it)
+    byte = buf[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    value, shift = byte & 0x7f, 7
+    while True:
+        offset += 1
+        byte = buf[offset]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset + 1
+        shift += 7
+
+
+def _compress(value):
+    # (tag flags, stored value) of a BYTES value in a compact record
+    if len(value) >= _COMPRESS_MIN_LEN:
+        compressed = zlib.compress(value, 1)
+        if len(compressed) <= len(value) - len(value) // 8:
+            return _FIELD_ZLIB, compressed
+    return 0, bytes(value)
+
+
+def _compact_field(offset, buf, zero_copy, base):
+    # decodes the compact field at offset, returns (its length, Field)
+    tag = buf[offset]
+    assert tag & _FIELD_TAG_MASK == _FIELD_TAG
+    fl_type = tag & _FIELD_TYPE_MASK
+    fl_key, pos = _read_varint(buf, offset + 1)
+    delta = buf[pos]  # most fields have the record's base timestamp, inline the one byte case
+    if delta < 0x80:
+        pos += 1
+    else:
+        delta, pos = _read_varint(buf, pos)
+    if fl_type == FL_TYPE_INT:
+        value, pos = _read_varint(buf, pos)
+    elif fl_type == FL_TYPE_INT64:
+        value, pos = _read_varint(buf, pos)
+        value = (value >> 1) ^ -(value & 1)
+    elif fl_type == FL_TYPE_FLOAT:
+        value = _DOUBLE.unpack_from(buf, pos)[0]
+        pos += 8
+    else:
+        assert fl_type in (FL_TYPE_BYTES, FL_TYPE_BYTES_CONT)
+        value_len, pos = _read_varint(buf, pos)
+        value = buf[pos:pos+value_len]
+        pos += value_len
+        if tag & _FIELD_ZLIB:
+            value = zlib.decompress(value)
+        elif not zero_copy:
+            value = bytes(value)
+    return pos - offset, Field(fl_type, fl_key, value, base + delta)
+
+
+def _skip_compact_field(buf, offset):
+    # returns (tag, key, offset after it) of the compact field at offset
+    tag = buf[offset]
+    assert tag & _FIELD_TAG_MASK == _FIELD_TAG
+    fl_key, pos = _read_varint(buf, offset + 1)
+    pos = _read_varint(buf, pos)[1]
+    fl_type = tag & _FIELD_TYPE_MASK
+    if fl_type in (FL_TYPE_INT, FL_TYPE_INT64):
+        pos = _read_varint(buf, pos)[1]
+    elif fl_type == FL_TYPE_FLOAT:
+        pos += 8
+    else:
+        value_len, pos = _read_varint(buf, pos)
+        pos += value_len
+    return tag, fl_key, pos
+
+
+def _percent_full(free_space):
+    # the region summary of a region with free_space bytes free
+    return int(math.ceil(100.0 * (_REGION_USABLE_SZ - free_space) / _REGION_USABLE_SZ))
+
+
+def _fsync_dir(path):
+    # makes a newly created file's directory entry durable
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _field_newer(fl, other):
+    # compact records keep full width timestamps, which compare plainly; those of fixed format records wrap around
+    if fl.ts >= 1 << 32 and other.ts >= 1 << 32:
+        if fl.ts != other.ts:
+            return fl.ts > other.ts
+    elif (fl.ts - other.ts) & 0xffffffff:
+        return _ts_newer(fl.ts, other.ts)
+    return (fl.type, fl.value) > (other.type, other.value)
+
+
+def _ts_newer(ts, other):
+    # timestamps wrap around, so a ts is newer if it is less than half the range ahead
+    return 0 < (ts - other) & 0xffffffff < 0x80000000
+
+
+def _get_ts():
+    # the timestamp of field writes and changes, milliseconds since _TABLE_EPOCH
     return int((time.time() - _TABLE_EPOCH) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
 import unittest
 import os
+import io
+import sys
+import asyncio
+import subprocess
+import glob
+import random
 import struct
+import collections
+import time
+import threading
 
 import db48
+import bench
 
 
-class TestCreateClose(unittest.TestCase):
+class TableTestCase(unittest.TestCase):
     path = "/tmp/t.db48"
 
     def setUp(self):
-        try:
-            os.unlink(self.path)
-        except OSError:
-            pass
+        for path in glob.glob(self.path + "*"):
+            os.unlink(path)
 
     def _create(self):
         t = db48.Table()
@@ -26,6 +34,14 @@ class TestCreateClose(unittest.TestCase):
         t.open(self.path)
         return t
 
+    def _fls(self, i, value):
+        # a record of an INT field 0 and a BYTES field 1
+        fl1 = db48.Field(db48.FL_TYPE_INT, 0, i)
+        fl2 = db48.Field(db48.FL_TYPE_BYTES, 1, value)
+        return db48.FieldList.set((fl1, fl2))
+
+
+class TestCreateClose(TableTestCase):
     def test_create_and_close(self):
         t = self._create()
         r = db48.Region(t, 0)
@@ -195,4 +211,1212 @@ class TestCreateClose(unittest.TestCase):
             self.assertRaises(db48.RecordDeleted, t.lookup, records[i])
         t.close()
 
+
+class TestSpace(TableTestCase):
+    def test_region_summaries(self):
+        t = self._open()
+        fl1 = db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 6000)
+        rid = t.insert(db48.FieldList.set((fl1,)))
+        summary = struct.unpack("B", t._mmap[db48._TABLE_REGION_SUMMARY_OFF:db48._TABLE_REGION_SUMMARY_OFF+1])[0]
+        self.assertTrue(summary == 10)
+        t.delete(rid)
+        summary = struct.unpack("B", t._mmap[db48._TABLE_REGION_SUMMARY_OFF:db48._TABLE_REGION_SUMMARY_OFF+1])[0]
+        self.assertTrue(summary == 0)
+        t.close()
+
+    def test_insert_spills_to_next_region(self):
+        t = self._open()
+        records = []
+        for i in range(11):
+            fl1 = db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 6000)
+            records.append(t.insert(db48.FieldList.set((fl1,))))
+        regions = [rid // db48._REGION_USABLE_SZ for rid in records]
+        self.assertTrue(regions == [0] * 10 + [1])
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t._free_index.get(0) < 6000 + 18)
+        fl1 = db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 6000)
+        rid = t.insert(db48.FieldList.set((fl1,)))
+        self.assertTrue(rid // db48._REGION_USABLE_SZ == 1)
+        t.close()
+
+    def test_free_map(self):
+        t = self._open()
+        records = []
+        for i in range(4):
+            fl1 = db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 92)
+            records.append(t.insert(db48.FieldList.set((fl1,))))
+        t.delete(records[1])
+        t.delete(records[3])
+        fmes = db48.Region(t, 0)._load_fmes()
+        self.assertTrue((fmes[0].offset, fmes[0].length) == (110, 110))
+        self.assertTrue((fmes[1].offset, fmes[1].length) == (330, db48._REGION_USABLE_SZ - 330))
+        self.assertTrue(fmes[2].length == 0)
+        t.delete(records[2])
+        fmes = db48.Region(t, 0)._load_fmes()
+        self.assertTrue((fmes[0].offset, fmes[0].length) == (110, db48._REGION_USABLE_SZ - 110))
+        self.assertTrue(fmes[1].length == 0)
+        fl1 = db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * (db48._REGION_USABLE_SZ - 110 - 18))
+        rid = t.insert(db48.FieldList.set((fl1,)))  # exactly fills the free space
+        self.assertTrue(rid == 110)
+        fmes = db48.Region(t, 0)._load_fmes()
+        self.assertTrue(fmes[0].length == 0)
+        self.assertTrue(t._free_index.get(0) == 0)
+        t.close()
+
+    def test_grow(self):
+        t = db48.Table(max_segments=None)
+        t.create(self.path)
+        big = [db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 40000),)) for i in range(1024)]
+        records = t.insert_many(big)
+        self.assertTrue(t.num_regions == 1024)
+        self.assertTrue(not os.path.exists(self.path + ".seg1"))
+        rid = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"y" * 40000),)))
+        self.assertTrue(t.num_regions == 2048)
+        self.assertTrue(os.path.exists(self.path + ".seg1"))
+        self.assertTrue(rid == 1024 * db48._REGION_USABLE_SZ)
+        small = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1),)))
+        self.assertTrue(small // db48._REGION_USABLE_SZ == 1024)  # fills the new region before going back
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t.num_regions == 2048)
+        self.assertTrue(t.lookup(rid).fls[0].value == b"y" * 40000)
+        self.assertTrue(t.lookup(records[1000]).fls[0].value == b"x" * 40000)
+        self.assertTrue(len(list(t.scan(fields=[]))) == 1026)
+        t.update(rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"z"),)))
+        self.assertTrue(t.lookup(rid).fls[0].value == b"z")
+        t.close()
+        # without growth a full table raises NoSpace
+        t = db48.Table()
+        t.create(self.path + ".2")
+        t.insert_many(big)
+        self.assertRaises(db48.NoSpace, t.insert, big[0])
+        t.close()
+
+    def test_lazy_regions(self):
+        t = self._create()
+        self.assertTrue(os.stat(self.path).st_blocks * 512 < 1024 * 1024)
+        self.assertTrue(not any(t._segments[0].region_initialized(i) for i in range(db48._TABLE_NUM_REGIONS)))
+        rid = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1),)))
+        self.assertTrue(t._segments[0].region_initialized(0) and not t._segments[0].region_initialized(1))
+        self.assertTrue(db48.Region(t, 0)._load_fmes()[0].offset == 20)
+        self.assertTrue(struct.unpack_from(">HH", t._mmap, db48._TABLE_HEADER_SZ + db48._REGION_SZ) == (0, 0))
+        self.assertTrue(len(list(t.scan())) == 1 and t.aggregate(0, workers=1)["count"] == 1)
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t.lookup(rid).fls[0].value == 1 and not t.verify(workers=1)["bad_checksums"])
+        t.close()
+        # files without the flag have all their regions initialized
+        t = self._create()
+        t._mmap[db48._TABLE_FLAGS_OFF:db48._TABLE_FLAGS_OFF + 4] = b"\x00" * 4
+        self.assertTrue(db48.Region(t, 7).initialized)
+        t.close()
+        if hasattr(os, "posix_fallocate"):
+            t = db48.Table(preallocate=True)
+            t.create(self.path + ".2")
+            self.assertTrue(os.stat(self.path + ".2").st_blocks * 512 >= db48._TABLE_SZ)
+            t.close()
+
+
+class TestRecordView(TableTestCase):
+    def test_view(self):
+        t = self._open()
+        msg = "Hello, World!".encode("utf-8")
+        fl1 = db48.Field(db48.FL_TYPE_INT, 0, 42)
+        fl2 = db48.Field(db48.FL_TYPE_BYTES, 13, msg)
+        fl3 = db48.Field(db48.FL_TYPE_INT, 20, 7)
+        rid = t.insert(db48.FieldList.set((fl1, fl2, fl3)))
+        view = t.view(rid)
+        self.assertTrue(view.value(0) == 42)
+        self.assertTrue(view.value(5) is None)
+        self.assertTrue(view.value(5, 1) == 1)
+        self.assertTrue(view.value(13) == msg)
+        self.assertTrue(isinstance(view.value(13), bytes))
+        value = view.value(13, zero_copy=True)
+        self.assertTrue(isinstance(value, memoryview))
+        self.assertTrue(value == msg)
+        self.assertTrue(view.keys() == [0, 13, 20])
+        self.assertTrue(view.ts(20) == view.get(20).ts)
+        self.assertTrue(len(view.field_list().fls) == 3)
+        self.assertRaises(BufferError, t.close)
+        value.release()
+        t.delete(rid)
+        self.assertRaises(db48.RecordDeleted, t.view, rid)
+        t.close()
+
+
+class TestBatch(TableTestCase):
+    def test_insert_many(self):
+        t = self._open()
+        fls_list = []
+        for i in range(3000):
+            fl1 = db48.Field(db48.FL_TYPE_INT, 0, i)
+            fl2 = db48.Field(db48.FL_TYPE_BYTES, 1, ("Hello %d" % i).encode())
+            fls_list.append(db48.FieldList.set((fl1, fl2)))
+        lengths = [fls.length() for fls in fls_list]
+        stores = []
+        store_fmes = db48.Region._store_fmes
+        db48.Region._store_fmes = lambda r, lo, hi: stores.append(r.ndx) or store_fmes(r, lo, hi)
+        try:
+            records = t.insert_many(fls_list)
+        finally:
+            db48.Region._store_fmes = store_fmes
+        self.assertTrue(stores == [0, 1])  # one FME store per region
+        self.assertTrue(records[0] == 0)
+        for i in range(1, len(records)):
+            if records[i] // db48._REGION_USABLE_SZ == records[i-1] // db48._REGION_USABLE_SZ:
+                self.assertTrue(records[i] == records[i-1] + lengths[i-1])
+        self.assertTrue(records[-1] // db48._REGION_USABLE_SZ == 1)
+        for i in (0, 1500, 2999):
+            fls = t.lookup(records[i])
+            self.assertTrue(fls.fls[0].value == i)
+            self.assertTrue(fls.fls[1].value.decode() == "Hello %d" % i)
+        # records larger than a region are chained
+        rid = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 65000),))])[0]
+        self.assertTrue(t.lookup(rid).fls[0].value == b"x" * 65000)
+        t.close()
+
+    def test_update_delete_many(self):
+        t = self._open()
+        t.create_index(0, db48.FL_TYPE_INT)
+        fls_list = []
+        for i in range(10):
+            fl1 = db48.Field(db48.FL_TYPE_INT, 0, i)
+            fl2 = db48.Field(db48.FL_TYPE_BYTES, 1, ("Hello %d" % (i + 100000)).encode())
+            fls_list.append(db48.FieldList.set((fl1, fl2)))
+        records = t.insert_many(fls_list)
+        updates = []
+        for i, rid in enumerate(records):
+            msg = ("Hello %d" % i) if i % 2 == 0 else ("Hello %d" % (i + 10000000))
+            updates.append((rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, msg.encode()),))))
+        new_records = t.update_many(updates)
+        # records keep their rec_addr, also the ones that grew
+        self.assertTrue(new_records == records)
+        for i in range(10):
+            fls = t.lookup(new_records[i])
+            self.assertTrue(fls.fls[0].value == i)
+            expected = "Hello %d" % (i if i % 2 == 0 else i + 10000000)
+            self.assertTrue(fls.fls[1].value.decode() == expected)
+            self.assertTrue(t.index_lookup(0, i) == [new_records[i]])
+        t.delete_many(new_records[:5])
+        for i in range(5):
+            self.assertRaises(db48.RecordDeleted, t.lookup, new_records[i])
+            self.assertTrue(t.index_lookup(0, i) == [])
+        self.assertTrue(t.lookup(new_records[5]).fls[0].value == 5)
+        t.close()
+
+    def test_merge(self):
+        def fls(*fields):
+            return db48.FieldList([db48.Field(db48.FL_TYPE_INT, key, value, ts) for key, value, ts in fields])
+        existing = fls((1, 10, 100), (3, 30, 100), (5, 50, 0xfffffff0))
+        new_length, old_length, taken = existing.merge(fls((0, 0, 1), (1, 11, 99), (3, 31, 101), (5, 51, 5),
+                                                           (6, 60, 1)))
+        self.assertTrue(new_length == old_length + 24 and [fl.key for fl in taken] == [0, 3, 5, 6])
+        self.assertTrue([(fl.key, fl.value) for fl in existing.fls] == [(0, 0), (1, 10), (3, 31), (5, 51), (6, 60)])
+        # ties go to the larger value whichever side merges
+        a, b = fls((1, 1, 100)), fls((1, 2, 100))
+        a.merge(fls((1, 2, 100)))
+        b.merge(fls((1, 1, 100)))
+        self.assertTrue(a.fls[0].value == b.fls[0].value == 2)
+        # other may be in any order and repeat keys, every field needs a ts
+        existing = fls((1, 10, 100), (2, 20, 100))
+        existing.merge(fls((2, 99, 101), (1, 88, 0), (3, 30, 50), (3, 31, 60)))
+        self.assertTrue([(fl.key, fl.value) for fl in existing.fls] == [(1, 10), (2, 99), (3, 31)])
+        self.assertRaises(ValueError, existing.merge, db48.FieldList([db48.Field(db48.FL_TYPE_INT, 1, 11)]))
+        t = self._open()
+        t.create_index(0, db48.FL_TYPE_INT)
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),)) for i in range(10)])
+        ts = t.lookup(records[0]).fls[0].ts
+        region, offset = t._locate(records[0])
+        before = region.mmap[offset:offset + 20]
+        self.assertTrue(t.merge(records[0], fls((0, 100, ts - 1))) == records[0])
+        self.assertTrue(region.mmap[offset:offset + 20] == before)
+        merges = [(records[i], fls((0, 100 + i, ts + 1))) for i in range(0, 10, 2)]
+        merges.append((records[1], db48.FieldList([db48.Field(db48.FL_TYPE_BYTES, 1, b"m" * 70000, ts + 1)])))
+        self.assertTrue(t.merge_many(merges) == [rid for rid, _ in merges])
+        values = [t.lookup(rid).fls[0].value for rid in records]
+        self.assertTrue(values == [100 + i if i % 2 == 0 else i for i in range(10)])
+        self.assertTrue(t.index_lookup(0, 102) == [records[2]] and t.index_lookup(0, 2) == [])
+        self.assertTrue(t.lookup(records[1]).fls[1].value == b"m" * 70000)
+        t.merge(records[1], db48.FieldList([db48.Field(db48.FL_TYPE_BYTES, 1, b"old", ts)]))
+        self.assertTrue(t.lookup(records[1]).fls[1].value == b"m" * 70000)
+        t.merge(records[1], db48.FieldList([db48.Field(db48.FL_TYPE_BYTES, 1, b"new", ts + 2)]))
+        self.assertTrue(t.lookup(records[1]).fls[1].value == b"new" and t.lookup(records[1]).fls[1].ts == ts + 2)
+        unsorted = db48.FieldList([db48.Field(db48.FL_TYPE_BYTES, 1, b"newer", ts + 3),
+                                   db48.Field(db48.FL_TYPE_INT, 0, 88, ts - 100000)])
+        t.merge_many([(records[3], unsorted)])
+        self.assertTrue([fl.value for fl in t.lookup(records[3]).fls] == [3, b"newer"])
+        t.close()
+
+
+class TestChangeFeed(TableTestCase):
+    def test_change_feed(self):
+        t = db48.Table(change_feed=True)
+        t.create(self.path)
+        start = db48._get_ts()
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),
+                                                     db48.Field(db48.FL_TYPE_BYTES, 1, b"Hello"))) for i in range(100)])
+        t.update(records[1], db48.FieldList([db48.Field(db48.FL_TYPE_INT, 0, 1001)]))
+        for rid in records[2:50]:
+            t.delete(rid)
+        moves = t.compact()
+        changes = list(t.changes_since(start))
+        self.assertTrue(len(changes) == 200 + 1 + 48 + len(moves))
+        self.assertTrue([c.kind for c in changes[:201]] == [db48.CHANGE_INSERT] * 200 + [db48.CHANGE_UPDATE])
+        self.assertTrue(changes[200].rec_addr == records[1] and changes[200].key == 0)
+        self.assertTrue([c.rec_addr for c in changes[201:249]] == records[2:50])
+        self.assertTrue({c.rec_addr: c.new_rec_addr for c in changes[249:]} == moves)
+        self.assertTrue(all(a.ts <= b.ts for a, b in zip(changes, changes[1:])))
+        self.assertTrue(list(t.changes_since(db48._get_ts() + 1000)) == [])
+        t.close()
+        t = db48.Table(change_feed=True)
+        t.open(self.path)
+        t.delete(moves.get(records[60], records[60]))
+        later = list(t.changes_since(changes[-1].ts))
+        self.assertTrue(later[-1].kind == db48.CHANGE_DELETE and len(list(t.changes_since(start))) == len(changes) + 1)
+        t.trim_changes(later[-1].ts)
+        self.assertTrue(list(t.changes_since(start))[0].ts == later[-1].ts)
+        # timestamps do not wrap around after 2**32 milliseconds, and a clock stepping back logs the last ts again
+        get_ts = db48._get_ts
+        wrap = (get_ts() // 2**32 + 1) * 2**32
+        try:
+            for i, ts in enumerate((wrap - 10, wrap + 10, wrap + 5, wrap + 2**31)):
+                db48._get_ts = lambda: ts
+                t.delete(moves.get(records[70 + i], records[70 + i]))
+        finally:
+            db48._get_ts = get_ts
+        self.assertTrue([c.ts for c in t.changes_since(wrap - 10)] == [wrap - 10, wrap + 10, wrap + 10, wrap + 2**31])
+        self.assertTrue([c.ts for c in t.changes_since(wrap)] == [wrap + 10, wrap + 10, wrap + 2**31])
+        t.close()
+
+
+class TestMetrics(TableTestCase):
+    def test_metrics(self):
+        t = db48.Table(auto_compact=True)
+        t.create(self.path)
+        calls = []
+        t.on_op(lambda name, ns, failed: calls.append((name, failed)))
+        fls_list = [db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),
+                                        db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * 100))) for i in range(1000)]
+        records = t.insert_many(fls_list)
+        for rid in records[:100]:
+            t.lookup(rid)
+        t.update(records[0], db48.FieldList([db48.Field(db48.FL_TYPE_BYTES, 1, b"y" * 1000)]))
+        for rid in records[1:200:2]:
+            t.delete(rid)
+        self.assertRaises(db48.RecordDeleted, t.lookup, records[1])
+        self.assertTrue(len(t.compact()) > 0)
+        metrics = t.metrics()
+        ops = metrics['ops']
+        self.assertTrue(sorted(ops) == ['compact', 'delete', 'insert_many', 'lookup', 'update'])
+        self.assertTrue(ops['lookup']['count'] == 101 and ops['lookup']['errors'] == 1)
+        self.assertTrue(ops['delete']['count'] == 100)
+        self.assertTrue(0 < ops['lookup']['p50_us'] <= ops['lookup']['p999_us'] <= ops['lookup']['max_us'])
+        self.assertTrue(metrics['counters']['extended'] == 1 and metrics['counters']['relocated'] > 0)
+        space = metrics['space']
+        self.assertTrue(space['initialized_regions'] == 3 and sum(space['fill_histogram']) == space['regions'])
+        self.assertTrue(space['fill_histogram'][0] == space['regions'] - 3 and 0 <= space['fragmentation'] < 0.5)
+        self.assertTrue(calls[0] == ('insert_many', False) and ('lookup', True) in calls and len(calls) == 204)
+        t.reset_metrics()
+        self.assertTrue(t.metrics(space=False) == {'ops': {}, 'counters': {}})
+        t.close()
+
+    def test_record_cache(self):
+        t = db48.Table(cache_bytes=10000)
+        t.create(self.path)
+        fls_list = [db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),
+                                        db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * 100))) for i in range(100)]
+        records = t.insert_many(fls_list)
+        first = t.lookup(records[0])
+        self.assertTrue(t.lookup(records[0]) is first and t.metrics()['cache']['hits'] == 1)
+        t.update(records[0], db48.FieldList([db48.Field(db48.FL_TYPE_INT, 0, 1000)]))
+        self.assertTrue(t.lookup(records[0]).fls[0].value == 1000)
+        t.delete(records[0])
+        self.assertRaises(db48.RecordDeleted, t.lookup, records[0])
+        for _ in range(2):
+            for rid in records[1:]:
+                t.lookup(rid)
+        cache = t.metrics()['cache']
+        self.assertTrue(cache['bytes'] <= 10000 and cache['records'] == 10000 // (126 + 200))
+        self.assertTrue(cache['evictions'] > 0 and cache['hits'] == 1)
+        # the last records looked up are cached, compaction moves them
+        for rid in records[1:90]:
+            t.delete(rid)
+        moves = t.compact()
+        self.assertTrue(all(rid in moves for rid in records[90:]))
+        self.assertTrue([t.lookup(moves[rid]).fls[0].value for rid in records[90:]] == list(range(90, 100)))
+        self.assertTrue(t.metrics()['cache']['hits'] == 1)
+        t.close()
+
+
+class TestThreads(TableTestCase):
+    def test_threads(self):
+        t = db48.Table(cache_bytes=100000)
+        t.create(self.path)
+
+        def fls(n, reps):
+            return db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, n),
+                                       db48.Field(db48.FL_TYPE_BYTES, 1, b"%08d" % n * reps)))
+        records = t.insert_many([fls(i, 10) for i in range(2000)])
+        first, other = records[0], records[-1]
+        self.assertTrue(first // db48._REGION_USABLE_SZ != other // db48._REGION_USABLE_SZ)
+        # readers of a region being written wait for the operation, readers of other regions do not
+        written, release = threading.Event(), threading.Event()
+
+        def write():
+            with t.batch():
+                t.update(first, fls(1000, 5))
+                written.set()
+                release.wait()
+        writer = threading.Thread(target=write)
+        writer.start()
+        written.wait()
+        self.assertTrue(t.lookup(other).fls[0].value == 1999)
+        results = []
+        reader = threading.Thread(target=lambda: results.append(t.lookup(first)))
+        reader.start()
+        reader.join(0.1)
+        self.assertTrue(reader.is_alive())
+        release.set()
+        reader.join()
+        writer.join()
+        self.assertTrue(results[0].fls[0].value == 1000 and t.lookup(first) is results[0])
+        # a read that a write overlaps is made again under the latch and not cached
+        reads = []
+
+        def read(rec_addr):
+            reads.append(rec_addr)
+            fls_ = t._load(rec_addr)
+            if len(reads) == 1:
+                writer = threading.Thread(target=t.update, args=(rec_addr, fls(2000, 1)))
+                writer.start()
+                writer.join()
+            return fls_
+        self.assertTrue(t._read(first // db48._REGION_USABLE_SZ, read, first)[0].fls[0].value == 2000)
+        self.assertTrue(len(reads) == 2 and t.lookup(first).fls[0].value == 2000)
+        # many writers and readers
+        errors = []
+
+        def update(k):
+            rng = random.Random(k)
+            for _ in range(300):
+                t.update(records[rng.randrange(k, len(records), 4)], fls(rng.randrange(10 ** 7), rng.randint(1, 300)))
+                t.delete(t.insert(fls(5, 3)))
+
+        def lookup(k):
+            rng = random.Random(k)
+            while any(thread.is_alive() for thread in writers):
+                fls_ = t.lookup(records[rng.randrange(len(records))])
+                if fls_.fls[1].value != b"%08d" % fls_.fls[0].value * (len(fls_.fls[1].value) // 8):
+                    errors.append(fls_)
+        writers = [threading.Thread(target=update, args=(k, )) for k in range(4)]
+        readers = [threading.Thread(target=lookup, args=(k, )) for k in range(4)]
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers + readers:
+            thread.join()
+        self.assertTrue(errors == [] and len(list(t.scan())) == 2000)
+        report = t.verify()
+        self.assertTrue(not any(report[key] for key in ('bad_fmes', 'bad_summaries', 'orphans', 'broken_chains')))
+        t.close()
+
+
+class TestScan(TableTestCase):
+    def test_scan(self):
+        t = self._open()
+        fls_list = []
+        for i in range(3000):
+            fl1 = db48.Field(db48.FL_TYPE_INT, 0, i)
+            fl2 = db48.Field(db48.FL_TYPE_BYTES, 1, ("Hello %04d" % i).encode())
+            fl3 = db48.Field(db48.FL_TYPE_INT, 2, i % 3)
+            fls_list.append(db48.FieldList.set((fl1, fl2, fl3)))
+        records = t.insert_many(fls_list)
+        t.delete_many(records[1000:2000])
+        t.update(records[0], db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"moved" * 10),)))
+        results = list(t.scan())
+        self.assertTrue(len(results) == 2000)
+        self.assertTrue(sorted(fls.fls[0].value for _, fls in results) == list(range(1000)) + list(range(2000, 3000)))
+        rid, fls = [(rid, fls) for rid, fls in results if fls.fls[0].value == 5][0]
+        self.assertTrue(rid == records[5])
+        results = list(t.scan(fields=[1], where=[(0, ">=", 2990), (2, "==", 1)]))
+        self.assertTrue([fls.fls[0].value for _, fls in results] == [b"Hello 2992", b"Hello 2995", b"Hello 2998"])
+        self.assertTrue(all(len(fls.fls) == 1 for _, fls in results))
+        results = list(t.scan(fields=[0], where=[(1, "<", b"Hello 0003")]))
+        self.assertTrue(sorted(fls.fls[0].value for _, fls in results) == [1, 2])
+        self.assertTrue(list(t.scan(where=[(1, "==", 5)])) == [])  # type mismatch
+        self.assertTrue(list(t.scan(where=[(3, "==", 5)])) == [])  # missing field
+        batches = list(t.scan(fields=[], batch_size=300))
+        self.assertTrue([len(b) for b in batches] == [300] * 6 + [200])
+        t.close()
+
+    def test_aggregate(self):
+        t = self._open()
+        fls_list = []
+        for i in range(3000):
+            fl1 = db48.Field(db48.FL_TYPE_INT, 0, i)
+            fl2 = db48.Field(db48.FL_TYPE_BYTES, 1, ("Hello %04d" % i).encode())
+            fl3 = db48.Field(db48.FL_TYPE_INT, 2, i % 3)
+            fls_list.append(db48.FieldList.set((fl1, fl2, fl3)))
+        fls_list.append(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 2, 5),)))
+        t.insert_many(fls_list)
+        for workers in (1, 3):
+            result = t.aggregate(0, workers=workers)
+            self.assertTrue(result == {'count': 3000, 'sum': sum(range(3000)), 'min': 0, 'max': 2999})
+            result = t.aggregate(workers=workers)
+            self.assertTrue(result['count'] == 3001)
+            result = t.aggregate(1, where=[(0, "<", 100)], workers=workers)
+            self.assertTrue(result == {'count': 100, 'sum': None, 'min': b"Hello 0000", 'max': b"Hello 0099"})
+            result = t.aggregate(0, group_by=2, workers=workers)
+            self.assertTrue(sorted(result) == [0, 1, 2])
+            self.assertTrue(result[1] == {'count': 1000, 'sum': sum(range(1, 3000, 3)), 'min': 1, 'max': 2998})
+            result = t.aggregate(group_by=2, workers=workers)
+            self.assertTrue(result[5]['count'] == 1)
+        t.close()
+
+    @unittest.skipIf(db48.numpy is None, "needs numpy")
+
+    def test_columns(self):
+        numpy = db48.numpy
+        t = self._open()
+        fls_list = []
+        for i in range(3000):
+            fls = [db48.Field(db48.FL_TYPE_INT, 0, i)]
+            if i % 2:
+                fls.append(db48.Field(db48.FL_TYPE_BYTES, 1, ("Hello %04d" % i).encode()))
+            fls_list.append(db48.FieldList.set(fls))
+        records = t.insert_many(fls_list)
+        t.update(records[2], db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * 70000),)))  # chained
+        t.delete(records[3])
+        columns = t.to_columns([0, 1, 2])
+        self.assertTrue(columns['rec_addr'].tolist() == sorted(records[:3] + records[4:]))
+        order = sorted(i for i in range(3000) if i != 3)
+        self.assertTrue(columns[0].values.tolist() == order and columns[0].present.all())
+        self.assertTrue(columns[1].present.tolist() == [i % 2 == 1 or i == 2 for i in order])
+        offsets, data = columns[1].offsets, columns[1].data
+        self.assertTrue(bytes(data[offsets[2]:offsets[3]]) == b"x" * 70000)
+        self.assertTrue(bytes(data[offsets[4]:offsets[5]]) == b"Hello 0005")
+        self.assertTrue(not columns[2].present.any())
+        t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"mixed"),)))
+        self.assertRaises(ValueError, t.to_columns, [0])
+
+        rec_addrs = t.from_columns({1: columns[1], 3: numpy.arange(len(order)) * 2})
+        self.assertTrue(t.lookup(rec_addrs[1]).index()[3].value == 2)
+        self.assertTrue(t.lookup(rec_addrs[2]).index()[1].value == b"x" * 70000)
+        self.assertTrue(t.lookup(rec_addrs[4]).index()[1].value == b"Hello 0005")
+        self.assertTrue(1 not in t.lookup(rec_addrs[0]).index())
+        copy = t.to_columns([1, 3])
+        rows = numpy.searchsorted(copy['rec_addr'], rec_addrs)
+        self.assertTrue((copy[3].values[rows] == numpy.arange(len(order)) * 2).all())
+        self.assertTrue((numpy.diff(copy[1].offsets)[rows] == numpy.diff(offsets)).all())
+        t.close()
+
+
+class TestRecordFormats(TableTestCase):
+    def test_record_formats(self):
+        t = db48.Table(change_feed=True)
+        t.create(self.path)
+        old = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),
+                                                 db48.Field(db48.FL_TYPE_BYTES, 1, b"fixed %d" % i)))
+                             for i in range(100)])
+        tiny = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1),)))
+        # fields the fixed format cannot store fail before any space is allocated or any change logged
+        free_bytes = t.space_stats()["free_bytes"]
+        num_changes = len(list(t.changes_since(0)))
+        wide = db48.FieldList.set((db48.Field(db48.FL_TYPE_INT64, 0, 1),))
+        for _ in range(3):
+            self.assertRaises(ValueError, t.insert, wide)
+        self.assertRaises(ValueError, t.update, old[0], wide)
+        self.assertRaises(ValueError, t.update_many, [(old[1], wide)])
+        self.assertTrue(t.space_stats()["free_bytes"] == free_bytes and t.lookup(old[0]).fls[0].value == 0)
+        self.assertTrue(len(list(t.changes_since(0))) == num_changes)
+        t.close()
+        t = db48.Table(record_format=db48.RECORD_FORMAT_COMPACT)
+        t.open(self.path)
+        fields = (db48.Field(db48.FL_TYPE_INT, 0, 0xffffffff), db48.Field(db48.FL_TYPE_BYTES, 1, b"compact"),
+                  db48.Field(db48.FL_TYPE_INT64, 2, -1 << 63), db48.Field(db48.FL_TYPE_FLOAT, 3, 2.5),
+                  db48.Field(db48.FL_TYPE_BYTES, 300, b"z" * 5000))
+        fls = db48.FieldList.set(fields)
+        rid = t.insert(fls)
+        region, offset = t._locate(rid)
+        stored = struct.unpack_from(">IH", region.mmap, offset)
+        self.assertTrue(stored[0] == db48._FLS_COMPACT_MAGIC and stored[1] < 120)
+        self.assertTrue(stored[1] == db48.FieldList(fls.fls, True).length() < fls.length())
+        fls = t.lookup(rid)
+        self.assertTrue([fl.value for fl in fls.fls] == [fl.value for fl in fields] and fls.compact)
+        self.assertTrue(fls.fls[0].ts == fields[0].ts > 0xffffffff)  # not wrapped around
+        view = t.view(rid)
+        self.assertTrue(view.keys() == [0, 1, 2, 3, 300] and view.value(3) == 2.5 and view.ts(300) == fields[0].ts)
+        self.assertTrue(t.lookup_raw(rid) == region.mmap[offset:offset + stored[1]])
+        # old records are read and updated in their own format, new records are compact
+        self.assertTrue(t.lookup(old[5]).fls[1].value == b"fixed 5" and not t.lookup(old[5]).compact)
+        t.update(old[5], db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"x"),)))
+        self.assertTrue(t.lookup(old[5]).fls[1].value == b"x" and not t.lookup(old[5]).compact)
+        # unless they get a field only the compact format stores, then they are rewritten in it
+        t.update(old[6], db48.FieldList.set((db48.Field(db48.FL_TYPE_INT64, 20, -6),)))
+        t.update_many([(old[7], db48.FieldList.set((db48.Field(db48.FL_TYPE_FLOAT, 21, 0.5),
+                                                     db48.Field(db48.FL_TYPE_BYTES, 22, b"y" * 300))))])
+        t.update(tiny, db48.FieldList.set((db48.Field(db48.FL_TYPE_INT64, 20, 1 << 40),)))  # no room for the base
+        for rec_addr, values in ((old[6], [6, b"fixed 6", -6]), (old[7], [7, b"fixed 7", 0.5, b"y" * 300]),
+                                 (tiny, [1, 1 << 40])):
+            self.assertTrue([fl.value for fl in t.lookup(rec_addr).fls] == values and t.lookup(rec_addr).compact)
+        noise = os.urandom(100000)
+        t.update(rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, noise),)))  # chained
+        self.assertTrue(len(t._chain(rid)) > 1 and t.lookup(rid).fls[1].value == noise)
+        t.merge(rid, db48.FieldList([db48.Field(db48.FL_TYPE_INT64, 2, 1 << 40, fields[0].ts + 1)]))
+        fls = t.lookup(rid)
+        self.assertTrue(fls.fls[2].value == 1 << 40 and fls.fls[2].ts == fields[0].ts + 1)
+        self.assertTrue(fls.fls[1].value == noise and fls.fls[4].value == b"z" * 5000)
+        # full width timestamps do not wrap around, a field 30 days newer wins and one 30 days older loses
+        month = 30 * 86400 * 1000
+        t.merge(rid, db48.FieldList([db48.Field(db48.FL_TYPE_INT64, 2, 7, fields[0].ts + 1 + month)]))
+        t.merge(rid, db48.FieldList([db48.Field(db48.FL_TYPE_INT64, 2, 8, fields[0].ts + 1)]))
+        self.assertTrue(t.lookup(rid).fls[2].value == 7)
+        big = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, noise),)))
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),)) for i in range(100)])
+        results = list(t.scan(fields=[0], where=[(0, ">=", 98)]))
+        self.assertTrue(sorted(fls.fls[0].value for _, fls in results) == [98, 98, 99, 99, 0xffffffff])
+        numbers = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT64, 10, v),
+                                                     db48.Field(db48.FL_TYPE_FLOAT, 11, v / 2.0)))
+                                 for v in (-5, 3, 1 << 40)])
+        for where, expected in (((10, "==", -5), numbers[:1]), ((10, ">", 1 << 32), numbers[2:]),
+                                ((11, "==", 1.5), numbers[1:2]), ((11, "<", 0.0), numbers[:1]),
+                                ((10, "<", 2.5), numbers[:1]), ((1, "==", -5), [])):
+            self.assertTrue([r for r, _ in t.scan(fields=[], where=[where])] == expected)
+        self.assertTrue(t.aggregate(10, workers=1)["sum"] == (1 << 40) - 2)
+        self.assertTrue(t.aggregate(11, where=[(10, ">=", 3)], workers=1)["sum"] == 1.5 + (1 << 39))
+        where = [(10, "==", -5), (10, ">", 1 << 40), (11, "<", 2.5), (1, "==", b"x"), (0, "==", 7)]
+        self.assertTrue(db48._decode_scan(db48._encode_scan(None, where))[1] == where)
+        t.delete_many(records[::2])
+        moves = t.compact(ndxs=[0], min_waste=0)
+        report = t.verify(workers=1)
+        self.assertTrue(report["records"] == 156 and not report["broken_chains"] and not report["orphans"])
+        self.assertTrue(t.lookup(moves.get(big, big)).fls[0].value == noise)
+        self.assertTrue(t.lookup(moves.get(records[1], records[1])).fls[0].value == 1)
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t.record_format == db48.RECORD_FORMAT_COMPACT)
+        if db48.numpy is not None:
+            columns = t.to_columns([1, 2, 3])
+            self.assertTrue(columns[1].present.sum() == 101 and columns[2].values.dtype == db48.numpy.int64)
+            self.assertTrue(isinstance(columns[3], db48.FloatColumn) and columns[3].values[columns[3].present] == [2.5])
+        t.close()
+
+
+class TestChaining(TableTestCase):
+    def test_chaining(self):
+        t = self._open()
+        free_space = lambda: sum(t._region(ndx)._free_map().free_space() for ndx in range(8))
+        empty = free_space()
+        value = bytes(random.getrandbits(8) for _ in range(200000))
+        fls = db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 7), db48.Field(db48.FL_TYPE_BYTES, 1, value),
+                                  db48.Field(db48.FL_TYPE_BYTES, 2, b"small")))
+        rid = t.insert(fls)
+        self.assertTrue(len(t._chain(rid)) == 4)
+        fls = t.lookup(rid)
+        self.assertTrue([fl.value for fl in fls.fls] == [7, value, b"small"])
+        self.assertTrue(db48._decode_record(t.lookup_raw(rid)).fls[1].value == value)
+        self.assertTrue(t.view(rid).value(1) == value)
+        self.assertTrue(t.view(rid).keys() == [0, 1, 2])
+        self.assertTrue([(r, f.fls[0].value) for r, f in t.scan(fields=[2], where=[(0, "==", 7)])] == [(rid, b"small")])
+        self.assertTrue(list(t.scan(where=[(0, "==", 8)])) == [])
+        t.update(rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"shrunk"),)))
+        self.assertTrue([fl.value for fl in t.lookup(rid).fls] == [7, b"shrunk", b"small"])
+        t.delete(rid)
+        self.assertRaises(db48.RecordDeleted, t.lookup, rid)
+        self.assertTrue(free_space() == empty)
+        # growing a record appends extensions and keeps its rec_addr
+        rid = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1),)))
+        other = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 2),)))
+        for i in range(1, 200):
+            self.assertTrue(t.update(rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, i, b"v%d" % i),))) == rid)
+        t.update(rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 5, b"x" * 70000),)))
+        fls = t.lookup(rid)
+        self.assertTrue([fl.key for fl in fls.fls] == list(range(200)))
+        self.assertTrue(fls.index()[5].value == b"x" * 70000 and fls.index()[199].value == b"v199")
+        # superseded data is consolidated
+        for i in range(50):
+            t.update(rid, db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"%d" % i),)))
+        self.assertTrue(sum(segment.length for segment in t._chain(rid)) <= 2 * t.lookup(rid).length())
+        self.assertTrue(t.lookup(other).fls[0].value == 2)
+        self.assertTrue([r for r, _ in t.scan()] == [rid, other])
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t.lookup(rid).index()[1].value == b"49")
+        t.delete_many([rid, other])
+        self.assertTrue(free_space() == empty)
+        self.assertTrue(list(t.scan()) == [])
+        # on the wire records are sent as FieldLists of at most 64 KB
+        fls = db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, value), db48.Field(db48.FL_TYPE_INT, 1, 3)))
+        chunks = fls.as_raw_chunks()
+        self.assertTrue(len(chunks) == 4 and all(len(chunk) <= 0xffff for chunk in chunks))
+        self.assertTrue(db48._split_field_lists(b"".join(chunks) * 2) == [b"".join(chunks)] * 2)
+        self.assertTrue([fl.value for fl in db48._decode_record(b"".join(chunks)).fls] == [value, 3])
+        t.close()
+
+
+class TestCompact(TableTestCase):
+    def test_compact(self):
+        t = self._open()
+        t.create_index(0, db48.FL_TYPE_INT)
+        relocated = []
+        t.on_relocate(relocated.append)
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),)) for i in range(8000)])
+        # the full region 0 leaves no room for an extension so the record continues in region 2
+        t.update(records[10], db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 2, b"grown" * 4000),)))
+        big = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, -1 & 0xffffffff),
+                                           db48.Field(db48.FL_TYPE_BYTES, 1, b"b" * 150000))))
+        # every other record deleted runs region 0 out of FME slots, the rest of the holes leak
+        t.delete_many(records[1::2])
+        region = t._region(0)
+        self.assertTrue(len(region._free_map()) == db48._REGION_NUM_FMES and region.leaked > 0)
+        # the fragmented regions and the leaked space are found again after a restart
+        leaked, total, fragmented = region.leaked, t.space_stats()["leaked_bytes"], set(t._fragmented)
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        t.on_relocate(relocated.append)
+        region = t._region(0)
+        self.assertTrue(region.leaked == leaked and t._fragmented == fragmented)
+        self.assertTrue(t.space_stats()["leaked_bytes"] == total == t.verify(workers=1)["leaked"])
+        self.assertTrue(t.compact(min_waste=1 << 20) == {})
+        chain = t._chain(records[10])
+        moves = t.compact(ndxs=[0, 1, 2], max_regions=2)
+        self.assertTrue(len(relocated) == 2 and len(moves) > 3000)
+        self.assertTrue(moves == dict(list(relocated[0].items()) + list(relocated[1].items())))
+        self.assertTrue(sorted(moves) == sorted(r for r in records[::2] if r in moves))
+        self.assertTrue(len(region._free_map()) == 1 and region.leaked == 0 and region.waste() == 0)
+        self.assertTrue(region._load_fmes()[1].length == 0)
+        live = [moves.get(r, r) for r in records[::2]]
+        for i, rid in zip(range(0, 8000, 2), live):
+            fls = t.lookup(rid)
+            self.assertTrue(fls.fls[0].value == i and t.index_lookup(0, i) == [rid])
+        self.assertTrue(t.lookup(live[5]).fls[1].value == b"grown" * 4000)
+        self.assertTrue(t.lookup(big).fls[1].value == b"b" * 150000)
+        self.assertTrue([r for r, _ in t.scan(fields=[])] == sorted(live + [big]))
+        # the extension in region 2 has not moved yet
+        ext_addr = t._chain(live[5])[1].rec_addr
+        self.assertTrue(len(moves) == 3070 and ext_addr == chain[1].rec_addr)
+        # the rest of the regions, including the ones the big record spans
+        t.delete_many(live[::3][2:])
+        moves = t.compact()
+        big = moves.get(big, big)
+        self.assertTrue(t.lookup(big).fls[1].value == b"b" * 150000)
+        self.assertTrue(t._fragmented == set())
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t._fragmented == set() and t._region(0).leaked == 0)
+        chain = t._chain(live[5])
+        self.assertTrue(len(chain) == 2 and chain[1].rec_addr // db48._REGION_USABLE_SZ == 2)
+        self.assertTrue(chain[1].rec_addr < ext_addr)
+        for prev, segment in zip(chain, chain[1:]):
+            self.assertTrue(struct.unpack_from(">Q", segment.region.mmap, segment.offset + 8)[0] == prev.rec_addr)
+        self.assertTrue(t.lookup(live[5]).fls[1].value == b"grown" * 4000)
+        self.assertTrue(len(list(t.scan())) == len(live) - len(live[::3][2:]) + 1)
+        t.close()
+        # inserts that find no large enough extent compact a region first with auto_compact
+        t = db48.Table(auto_compact=True)
+        t.create(self.path + ".2")
+        fls = [db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 20000),)) for _ in range(3 * 1024)]
+        records = t.insert_many(fls)
+        t.delete_many(records[1::3])
+        self.assertTrue(t._free_index.find(21000) < 0)
+        rid = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"y" * 21000),)))
+        self.assertTrue(t.lookup(rid).fls[0].value == b"y" * 21000)
+        t.auto_compact = False
+        fls = db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"y" * 21000),))
+        self.assertRaises(db48.NoSpace, t.insert, fls)
+        t.close()
+        # a compaction during a bulk insert can move records placed earlier in the call, their rec_addrs follow
+        for chunked in (False, True):
+            t = db48.Table(auto_compact=True)
+            t.create(self.path + ".3")
+            fls = [db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"x" * 15000),)) for _ in range(4 * 1024)]
+            records = t.insert_many(fls)
+            t.delete_many([records[1], records[3]])
+            first = db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"a" * 15500),))
+            second = db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"b" * 7750),
+                                         db48.Field(db48.FL_TYPE_BYTES, 1, b"c" * 7750)))
+            if chunked:
+                head = bytearray(db48.FieldList.set(second.fls[:1]).as_raw())
+                magic, length, _ = db48._FLS_HEADER.unpack_from(head, 0)
+                db48._FLS_HEADER.pack_into(head, 0, magic, length, db48._FLS_NEXT_MORE)
+                rids = t.insert_raw([first.as_raw(), bytes(head) + db48.FieldList.set(second.fls[1:]).as_raw()])
+            else:
+                rids = t.insert_many([first, second])
+            self.assertTrue(t.metrics(space=False)["counters"]["compacted_regions"] == 1 and rids[0] < 45054)
+            self.assertTrue(t.lookup(rids[0]).fls[0].value == b"a" * 15500)
+            self.assertTrue([fl.value for fl in t.lookup(rids[1]).fls] == [b"b" * 7750, b"c" * 7750])
+            t.close()
+            os.unlink(self.path + ".3")
+
+
+class TestDurability(TableTestCase):
+    def test_durability(self):
+        t = db48.Table(durability=db48.DURABILITY_BATCH)
+        t.create(self.path)
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),)) for i in range(100)])
+        t.close()
+        self.assertTrue(os.path.getsize(self.path + ".wal") == 0)
+        with open(self.path, "rb") as f:
+            image = f.read()
+        t = db48.Table(durability=db48.DURABILITY_BATCH)
+        t.open(self.path)
+        t.update(records[0], db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * 100000),)))
+        t.delete(records[1])
+        with t.batch():
+            new = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 100),)))
+            t.update(records[2], db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 102),)))
+        # a crash leaves the table file as of the last checkpoint and the committed log
+        crashed = self.path + ".crashed"
+        with open(crashed, "wb") as f:
+            f.write(image)
+        with open(self.path + ".wal", "rb") as f:
+            log = f.read()
+        segment = db48._Segment(0, crashed)
+        segment.open()
+        with open(crashed + ".wal", "wb") as f:
+            f.write(log)
+        self.assertTrue(db48._WriteAheadLog(crashed + ".wal").replay([segment]) == 3)
+        segment.close()
+        # followed by an operation that was not committed and a torn entry
+        with open(crashed, "wb") as f:
+            f.write(image)
+        with open(crashed + ".wal", "wb") as f:
+            f.write(log + db48._WriteAheadLog._ENTRY.pack(0, 1, 0, 0, 4) + b"\xde\xad" + log[:10])
+        t2 = db48.Table()
+        t2.open(crashed)
+        self.assertTrue(os.path.getsize(crashed + ".wal") == 0)
+        self.assertTrue(t2.lookup(records[0]).fls[1].value == b"x" * 100000)
+        self.assertRaises(db48.RecordDeleted, t2.lookup, records[1])
+        self.assertTrue(t2.lookup(new).fls[0].value == 100 and t2.lookup(records[2]).fls[0].value == 102)
+        self.assertTrue([r for r, _ in t2.scan(fields=[])] == [r for r, _ in t.scan(fields=[])])
+        t2.close()
+        t.close()
+        # the pages an operation that was not committed overwrote can reach the disk, its undo entries restore them
+        t = db48.Table(durability=db48.DURABILITY_BATCH)
+        t.open(self.path)
+        t.group_commit = True
+        t.update(records[3], db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1003),)))
+        t.commit()
+        t.update(records[4], db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1004),)))
+        t.delete(records[5])
+        t.compact(ndxs=[0], min_waste=0)
+        self.assertTrue(t._wal.size < db48._REGION_SZ)  # the undo entries only hold the bytes overwritten
+        for suffix in ("", ".wal"):
+            with open(self.path + suffix, "rb") as f, open(crashed + suffix, "wb") as out:
+                out.write(f.read())
+        t2 = db48.Table()
+        t2.open(crashed)
+        self.assertTrue(t2.lookup(records[3]).fls[0].value == 1003 and t2.lookup(records[4]).fls[0].value == 4)
+        self.assertTrue(t2.lookup(records[5]).fls[0].value == 5)
+        self.assertTrue(not t2.verify(workers=1)["orphans"])
+        t2.close()
+        t.close()
+        # the periodic mode commits in the background
+        t = db48.Table(durability=db48.DURABILITY_PERIODIC, sync_interval=0.01)
+        t.open(self.path)
+        t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 103),)))
+        self.assertTrue(os.path.getsize(self.path + ".wal") == 0 and t._wal._complete > 0)
+        for _ in range(200):
+            if t._wal._complete == 0:
+                break
+            time.sleep(0.01)
+        self.assertTrue(t._wal._complete == 0)
+        t.close()
+
+    def test_verify(self):
+        t = self._open()
+        self.assertTrue(t.clean)
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),)) for i in range(5000)])
+        big = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"b" * 150000),)))
+        t.delete_many(records[:3000:2])
+        moves = t.compact(ndxs=[0])
+        records = [moves.get(r, r) for r in records]
+        report = t.verify(workers=1)
+        self.assertTrue(report["records"] == 3501 and report["segments"] == 3503)
+        self.assertTrue(not any(report[k] for k in ("bad_fmes", "bad_summaries", "bad_checksums", "orphans")))
+        t.close()
+        # a crash leaves the file marked as not closed cleanly
+        t = db48.Table()
+        t.open(self.path)
+        t2 = db48.Table()
+        t2.open(self.path, readonly=True)
+        self.assertTrue(t.clean and not t2.clean)
+        t2.close()
+        # break the FMEs of region 1, the summary of region 2 and the head of the big record
+        region = t._region(1)
+        t._mmap[region.offset:region.offset + 8] = struct.pack(">HHHH", 0, 200, 0, 0)
+        t._mmap[db48._TABLE_REGION_SUMMARY_OFF + 2] = 1
+        big_region, big_offset = t._locate(big)
+        t._mmap[big_offset + 4:big_offset + 6] = b"\x00\x00"
+        t._regions = [None] * t.num_regions
+        # a byte in the free space of region 3 flipped since the table was closed
+        t._mmap[t._region(3).offset + db48._REGION_SZ - 1] = 1
+        report = t.verify(workers=2)
+        self.assertTrue(report["bad_fmes"] == [1] and report["bad_summaries"] == [2])
+        self.assertTrue(report["bad_checksums"] == [1, 2, 3] or report["bad_checksums"] == [1, 3])
+        self.assertTrue(len(report["orphans"]) == 2 and report["records"] == 3500)
+        report = t.verify(repair=True)
+        self.assertTrue(t._region(1)._free_map().offsets[0] != 0)
+        report = t.verify(workers=1)
+        self.assertTrue(not any(report[k] for k in ("bad_fmes", "bad_summaries", "bad_checksums", "orphans")))
+        self.assertTrue([r for r, _ in t.scan(fields=[])] == records[1:3000:2] + records[3000:])
+        rid = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"c" * 150000),)))
+        self.assertTrue(t.lookup(rid).fls[0].value == b"c" * 150000)
+        self.assertTrue(all(t.lookup(r).fls[0].value == i for i, r in enumerate(records) if i >= 3000))
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(t.clean and not t.verify(workers=1)["bad_checksums"])
+        t.close()
+
+
+class TestSnapshot(TableTestCase):
+    def test_snapshot(self):
+        t = self._create()
+        records = t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, i),
+                                                     db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * 1000)))
+                                 for i in range(300)])
+        ndxs = sorted(set(r // db48._REGION_USABLE_SZ for r in records))
+        # empty a region, it is initialized but left out of the export
+        t.delete_many([r for r in records if r // db48._REGION_USABLE_SZ == ndxs[1]])
+        live = [r for r in records if r // db48._REGION_USABLE_SZ != ndxs[1]]
+        snapshot = t.snapshot()
+        self.assertTrue(not os.path.exists(snapshot.path))
+        t.update(live[0], db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1000),)))
+        t.delete(live[-1])
+        t.insert_many([db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"y" * 5000),)) for _ in range(50)])
+        self.assertTrue(os.path.exists(snapshot.path) and t.metrics(space=False)["counters"]["snapshot_copies"] > 2)
+        out = io.BytesIO()
+        size = snapshot.export(out)
+        self.assertTrue(size == len(out.getvalue()) < (len(ndxs) - 1) * db48._REGION_SZ)
+        snapshot.close()
+        self.assertTrue(not os.path.exists(snapshot.path) and not t._segments[0].snapshots)
+        self.assertTrue(t.lookup(live[0]).fls[0].value == 1000)
+        t.close()
+        restored = db48.Table()
+        restored.restore(self.path + ".restored", io.BytesIO(out.getvalue()))
+        self.assertTrue(restored.clean and [r for r, _ in restored.scan(fields=[0])] == live)
+        self.assertTrue(restored.lookup(live[0]).fls[0].value == 0 and restored.lookup(live[-1]).fls[0].value == 299)
+        self.assertTrue([i for i in range(ndxs[-1] + 2) if restored._segments[0].region_initialized(i)] ==
+                        ndxs[:1] + ndxs[2:])
+        report = restored.verify(workers=1)
+        self.assertTrue(report["records"] == len(live))
+        self.assertTrue(not any(report[k] for k in ("bad_fmes", "bad_summaries", "bad_checksums", "orphans")))
+        restored.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 1),)))
+        restored.close()
+        self.assertRaises(FileExistsError, db48.Table().restore, self.path, io.BytesIO(out.getvalue()))
+        corrupt = bytearray(out.getvalue())
+        corrupt[-100] ^= 1
+        self.assertRaises(ValueError, db48.Table().restore, self.path + ".corrupt", io.BytesIO(bytes(corrupt)))
+
+
+class TestIndex(TableTestCase):
+    def test_lookup_and_range(self):
+        t = self._create()
+        records = [t.insert(self._fls(i % 10, ("name %03d" % i).encode())) for i in range(100)]
+        t.create_index(0, db48.FL_TYPE_INT)  # indexes existing records
+        t.create_index(1, db48.FL_TYPE_BYTES)
+        self.assertRaises(db48.IndexExists, t.create_index, 0, db48.FL_TYPE_INT)
+        self.assertTrue(sorted(t.index_lookup(0, 3)) == [records[i] for i in range(3, 100, 10)])
+        self.assertTrue(t.index_lookup(0, 10) == [])
+        self.assertTrue(sorted(t.index_range(0, 2, 4)) == sorted(records[i] for i in range(100) if i % 10 in (2, 3)))
+        self.assertTrue(len(t.index_range(0, lo=8)) == 20)
+        self.assertTrue(len(t.index_range(0, hi=1)) == 10)
+        self.assertTrue(t.index_range(1, b"name 010", b"name 013") == records[10:13])
+        rid = t.insert(self._fls(42, b"new"))
+        self.assertTrue(t.index_lookup(0, 42) == [rid])
+        self.assertTrue(t.index_lookup(1, b"new") == [rid])
+        t.close()
+
+    def test_update_delete(self):
+        t = self._create()
+        t.create_index(0, db48.FL_TYPE_INT)
+        t.create_index(1, db48.FL_TYPE_BYTES)
+        records = [t.insert(self._fls(i, b"x")) for i in range(10)]
+        new_rid = t.update(records[3], db48.FieldList.set((db48.Field(db48.FL_TYPE_INT, 0, 100),)))
+        self.assertTrue(new_rid == records[3])
+        self.assertTrue(t.index_lookup(0, 3) == [])
+        self.assertTrue(t.index_lookup(0, 100) == [new_rid])
+        # growing the record extends it in place
+        new_rid = t.update(records[4], db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"x" * 100),)))
+        self.assertTrue(new_rid == records[4])
+        self.assertTrue(t.index_lookup(0, 4) == [new_rid])
+        self.assertTrue(t.index_lookup(1, b"x" * 100) == [new_rid])
+        t.delete(records[5])
+        self.assertTrue(t.index_lookup(0, 5) == [])
+        self.assertTrue(len(t.index_lookup(1, b"x")) == 8)
+        # fields of another type are not indexed
+        rid = t.insert(db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 0, b"7"),)))
+        self.assertTrue(rid not in t.index_range(0))
+        t.close()
+
+    def test_reopen(self):
+        t = self._create()
+        t.create_index(0, db48.FL_TYPE_INT)
+        t.create_index(1, db48.FL_TYPE_BYTES)
+        records = [t.insert(self._fls(i, b"x")) for i in range(10)]
+        t.delete(records[0])
+        t.drop_index(1)
+        t.close()
+        t = db48.Table()
+        t.open(self.path)
+        self.assertTrue(sorted(t._indexes) == [0])
+        self.assertTrue(t.index_range(0) == records[1:])
+        self.assertTrue(t.index_lookup(0, 9) == [records[9]])
+        t.close()
+
+    def test_sorted_list(self):
+        rnd = random.Random(48)
+        sl = db48._SortedList()
+        expected = []
+        for i in range(5000):
+            item = (rnd.randrange(1000), i)
+            sl.add(item)
+            expected.append(item)
+            if rnd.random() < 0.3:
+                item = expected.pop(rnd.randrange(len(expected)))
+                sl.remove(item)
+        expected.sort()
+        self.assertTrue(len(sl) == len(expected))
+        self.assertTrue(list(sl.irange()) == expected)
+        self.assertTrue(list(sl.irange((100, ), (200, ), False)) == [x for x in expected if 100 <= x[0] < 200])
+
+
+class TestServer(TableTestCase):
+    async def _read(self, reader):
+        header = await reader.readexactly(db48._FRAME_HEADER.size)
+        body_len, req_id, status = db48._FRAME_HEADER.unpack(header)
+        return req_id, status, await reader.readexactly(body_len)
+
+    def test_protocol(self):
+        t = db48.Table()
+        t.create(self.path)
+
+        async def run():
+            server = db48.Server(t)
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            raws = [self._fls(i, ("Hello %d" % i).encode()).as_raw() for i in range(3)]
+            writer.write(db48._encode_frame(1, db48.OP_INSERT, b"".join(raws)))
+            req_id, status, body = await self._read(reader)
+            self.assertTrue((req_id, status) == (1, db48.STATUS_OK))
+            records = db48._split_rec_addrs(body)
+            self.assertTrue(len(records) == 3)
+            # pipelined requests
+            new_raw = self._fls(7, b"Hello again!").as_raw()
+            writer.write(db48._encode_frame(2, db48.OP_LOOKUP, struct.pack(">3Q", *records)) +
+                         db48._encode_frame(3, db48.OP_UPDATE, struct.pack(">Q", records[1]) + new_raw) +
+                         db48._encode_frame(4, db48.OP_DELETE, struct.pack(">Q", records[0])) +
+                         db48._encode_frame(5, db48.OP_LOOKUP, struct.pack(">Q", records[0])) +
+                         db48._encode_frame(6, db48.OP_UPDATE, struct.pack(">Q", records[0]) + new_raw) +
+                         db48._encode_frame(7, db48.OP_INSERT, b"garbage!") +
+                         db48._encode_frame(8, 99) +
+                         db48._encode_frame(9, db48.OP_SCAN, db48._encode_scan([1], [(0, ">", 1)], 1)))
+            req_id, status, body = await self._read(reader)
+            self.assertTrue((req_id, status) == (2, db48.STATUS_OK))
+            self.assertTrue(db48._split_field_lists(body) == raws)
+            req_id, status, body = await self._read(reader)
+            self.assertTrue((req_id, status) == (3, db48.STATUS_OK))
+            new_rid = struct.unpack(">Q", body)[0]
+            self.assertTrue(new_rid == records[1])
+            self.assertTrue(t.lookup(new_rid).fls[1].value == b"Hello again!")
+            self.assertTrue((await self._read(reader))[:2] == (4, db48.STATUS_OK))
+            req_id, status, body = await self._read(reader)
+            self.assertTrue((req_id, status) == (5, db48.STATUS_OK))
+            self.assertTrue(struct.unpack(">IHH", body) == (db48._FLS_MAGIC, 0, 0))
+            self.assertTrue((await self._read(reader))[:2] == (6, db48.STATUS_DELETED))
+            self.assertTrue((await self._read(reader))[:2] == (7, db48.STATUS_BAD_REQUEST))
+            self.assertTrue((await self._read(reader))[:2] == (8, db48.STATUS_BAD_REQUEST))
+            scanned = []
+            while True:
+                req_id, status, body = await self._read(reader)
+                self.assertTrue(req_id == 9)
+                if status == db48.STATUS_OK:
+                    break
+                self.assertTrue(status == db48.STATUS_MORE)
+                scanned.append((struct.unpack(">Q", body[:8])[0], db48.FieldList.load(8, body)))
+            self.assertTrue([(rid, fls.fls[0].value) for rid, fls in scanned] == [(new_rid, b"Hello again!"),
+                                                                                  (records[2], b"Hello 2")])
+            writer.close()
+            server.close()
+
+        asyncio.run(run())
+        t.close()
+
+    def test_group_commit(self):
+        t = db48.Table(durability=db48.DURABILITY_BATCH)
+        t.create(self.path)
+        commits = []
+        commit = t.commit
+        t.commit = lambda: commits.append(len(commits)) or commit()
+
+        async def run():
+            server = db48.Server(t)
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            raws = [self._fls(i, b"Hello").as_raw() for i in range(10)]
+            writer.write(b"".join(db48._encode_frame(i, db48.OP_INSERT, raw) for i, raw in enumerate(raws)) +
+                         db48._encode_frame(10, db48.OP_LOOKUP, struct.pack(">Q", 0)))
+            responses = [await self._read(reader) for _ in range(11)]
+            self.assertTrue([(req_id, status) for req_id, status, _ in responses] ==
+                            [(i, db48.STATUS_OK) for i in range(11)])
+            self.assertTrue(len(commits) == 1)
+            writer.close()
+            server.close()
+
+        asyncio.run(run())
+        self.assertTrue(os.path.getsize(self.path + ".wal") > 0)
+        t.close()
+
+
+    def test_changes(self):
+        t = db48.Table(change_feed=True)
+        t.create(self.path)
+        start = db48._get_ts()
+        records = t.insert_many([self._fls(i, b"Hello") for i in range(2000)])
+        t.delete(records[0])
+
+        async def run():
+            server = db48.Server(t)
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(db48._encode_frame(1, db48.OP_CHANGES, struct.pack(">Q", start)) +
+                         db48._encode_frame(2, db48.OP_CHANGES, b""))
+            body = b""
+            while True:
+                req_id, status, data = await self._read(reader)
+                if status != db48.STATUS_MORE:
+                    break
+                body += data
+            self.assertTrue(req_id == 1 and status == db48.STATUS_OK)
+            self.assertTrue(len(body) == 4001 * db48._ChangeFeed._ENTRY.size)
+            self.assertTrue((await self._read(reader))[1] == db48.STATUS_BAD_REQUEST)
+            writer.close()
+            server.close()
+
+        asyncio.run(run())
+        t.close()
+
+    def test_snapshot(self):
+        t = db48.Table()
+        t.create(self.path)
+        records = t.insert_many([self._fls(i, b"x" * 2000) for i in range(2000)])
+
+        async def run():
+            server = db48.Server(t)
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            reader2, writer2 = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(db48._encode_frame(1, db48.OP_SNAPSHOT))
+            body = b""
+            while True:
+                req_id, status, data = await self._read(reader)
+                if status != db48.STATUS_MORE:
+                    break
+                if not body:
+                    # writes made while the snapshot is sent are not in it
+                    writer2.write(db48._encode_frame(2, db48.OP_DELETE, struct.pack(">Q", records[-1])))
+                    self.assertTrue((await self._read(reader2))[1] == db48.STATUS_OK)
+                body += data
+            self.assertTrue(req_id == 1 and status == db48.STATUS_OK)
+            writer.close()
+            writer2.close()
+            server.close()
+            return body
+
+        body = asyncio.run(run())
+        self.assertTrue(not t._snapshots and t.metrics(space=False)["counters"]["snapshot_copies"] >= 1)
+        t.close()
+        t = db48.Table()
+        t.restore(self.path + ".restored", io.BytesIO(body))
+        self.assertTrue([r for r, _ in t.scan(fields=[])] == records)
+        t.close()
+
+
+class TestClient(TableTestCase):
+    num_nodes = 3
+
+    def setUp(self):
+        TableTestCase.setUp(self)
+        self.servers = []
+        nodes = []
+        for i in range(self.num_nodes):
+            server = subprocess.Popen(
+                [sys.executable, "db48.py", "server", "%s.node%d" % (self.path, i), "--create",
+                 "--change-feed", "--port", "0"],
+                stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(db48.__file__)))
+            self.servers.append(server)
+            nodes.append(server.stdout.readline().decode().split()[-1])
+        self.client = db48.Client(nodes, replicas=2, timeout=2.0)
+
+    def tearDown(self):
+        self.client.close()
+        for server in self.servers:
+            server.terminate()
+            server.wait()
+            server.stdout.close()
+
+    def test_replicated_reads_and_writes(self):
+        refs = [self.client.insert("key%d" % i, self._fls(i, b"Hello %d" % i)) for i in range(20)]
+        for i, item_refs in enumerate(refs):
+            self.assertTrue(len(item_refs) == 2)
+            self.assertTrue(len(set(ref.node for ref in item_refs)) == 2)
+            self.assertTrue([ref.node for ref in item_refs] == self.client.nodes_for("key%d" % i))
+        self.assertTrue(len(set(ref.node for item_refs in refs for ref in item_refs)) == 3)
+        refs.extend(self.client.insert_many([("key%d" % i, self._fls(i, b"Hello %d" % i)) for i in range(20, 100)]))
+        results = self.client.lookup_many(refs)
+        self.assertTrue([fls.fls[0].value for fls in results] == list(range(100)))
+        new_fls = db48.FieldList.set((db48.Field(db48.FL_TYPE_BYTES, 1, b"updated and longer"),))
+        refs[5] = self.client.update(refs[5], new_fls)
+        self.assertTrue(self.client.lookup(refs[5]).fls[1].value == b"updated and longer")
+        # merges keep the newer field whichever replica it comes from
+        now = db48._get_ts()
+        stale = db48.Field(db48.FL_TYPE_BYTES, 1, b"stale", (now - 60000) & 0xffffffff)
+        fresh = db48.Field(db48.FL_TYPE_INT, 2, 7, (now + 1000) & 0xffffffff)
+        self.assertTrue(self.client.merge(refs[5], db48.FieldList([stale, fresh])) == refs[5])
+        fls = self.client.lookup(refs[5])
+        self.assertTrue([fl.value for fl in fls.fls] == [5, b"updated and longer", 7])
+        self.client.delete(refs[6])
+        self.assertRaises(db48.RecordDeleted, self.client.lookup, refs[6])
+        for ref in refs[6]:
+            change = self.client.changes_since(ref.node, db48._get_ts() - 60000)[-1]
+            self.assertTrue(change.kind == db48.CHANGE_DELETE and change.rec_addr == ref.rec_addr)
+        # with a node down reads fall back to the other replica
+        self.servers[0].terminate()
+        self.servers[0].wait()
+        results = self.client.lookup_many(refs[:50])
+        self.assertTrue([fls and fls.fls[0].value for fls in results] == [i if i != 6 else None for i in range(50)])
+        refs = self.client.insert("key100", self._fls(100, b"Hello 100"))
+        self.assertTrue(all(ref.node != "127.0.0.1:%s" % self.servers[0].args[-1] for ref in refs))
+        self.assertTrue(self.client.lookup(refs).fls[0].value == 100)
+
+    def test_hash_ring(self):
+        ring = db48.HashRing()
+        for node in ("a", "b", "c"):
+            ring.add(node)
+        owners = dict((i, ring.nodes_for(i)[0]) for i in range(3000))
+        counts = collections.Counter(owners.values())
+        self.assertTrue(all(800 < count < 1200 for count in counts.values()))
+        ring.add("d", weight=2)
+        moved = [i for i in range(3000) if ring.nodes_for(i)[0] != owners[i]]
+        self.assertTrue(all(ring.nodes_for(i)[0] == "d" for i in moved))
+        self.assertTrue(1000 < len(moved) < 2000)
+        self.assertTrue(ring.nodes_for(1, 3, exclude=("d", )) == [n for n in ring.nodes_for(1, 4) if n != "d"])
+
+
+class TestBench(TableTestCase):
+    def test_run(self):
+        results = list(bench.run([100, 20000], [0.01], 200, self.path))
+        self.assertTrue([r['workload'] for r in results] == list(bench.WORKLOADS) * 2)
+        for r in results:
+            self.assertTrue(r['ops'] == 200 and r['errors'] == 0 and r['p50_us'] <= r['p99_us'] <= r['p999_us'])
+        self.assertTrue(glob.glob(self.path + "*") == [])
+
 unittest.main()